@@ -1,9 +1,18 @@
 from django import forms
 from django.db.models import Q, F
 from django.core.validators import EMPTY_VALUES
+from django.forms.models import BaseModelFormSet
 
 from . import widgets
 
+try:
+    try:
+        from ..versioning.models import validate_versioned_unique
+    except ValueError:
+        from versioning.models import validate_versioned_unique
+except ImportError:
+    validate_versioned_unique = None
+
 class BaseFilterForm(forms.Form):
     """
     A base filter form. Implementing classes should
@@ -169,6 +178,36 @@ class HiddenObjectForm(forms.ModelForm):
         fields = []
 
 
+class VersionedUniqueFormSet(BaseModelFormSet):
+    """
+    Model formset that checks the `versioned_unique` fields
+    of all its forms together, with one query per model,
+    instead of running the queries for every form.
+    """
+
+    def full_clean(self):
+        if validate_versioned_unique is None:
+            return super(VersionedUniqueFormSet, self).full_clean()
+
+        forms = [f for f in self.forms
+                 if getattr(f.instance, 'versioned_unique', None)]
+        for form in forms:
+            form.instance._batch_unique = True
+        try:
+            super(VersionedUniqueFormSet, self).full_clean()
+        finally:
+            for form in forms:
+                del form.instance._batch_unique
+
+        # Blank extra forms aren't validated
+        forms = [f for f in forms if hasattr(f, 'cleaned_data') and \
+                    not (f.empty_permitted and not f.has_changed())]
+        errors = validate_versioned_unique([f.instance for f in forms])
+        for form, form_errors in zip(forms, errors):
+            if form_errors:
+                form._update_errors(form_errors)
+
+
 class WhenForm(forms.Form):
     """
     Base form for actions that are date based.
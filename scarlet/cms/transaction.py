@@ -1,8 +1,13 @@
-
 try:
     try:
         from ..versioning.transactions import xact as commit_on_success
     except ValueError:
         from versioning.transactions import xact as commit_on_success
+
+    def savepoint_on_success(using=None):
+        # For blocks whose exceptions are caught, nested
+        # xact blocks don't get a savepoint otherwise.
+        return commit_on_success(using=using, savepoint=True)
 except ImportError:
     from django.db.transaction import commit_on_success
+    savepoint_on_success = commit_on_success
@@ -23,10 +23,19 @@ from . import helpers
 from . import renders
 from . import transaction
 from . import widgets
-from .forms import WhenForm, LazyFormSetFactory, VersionFilterForm
+from .forms import WhenForm, LazyFormSetFactory, VersionFilterForm, \
+                    VersionedUniqueFormSet
 from .models import CMSLog
 from .internal_tags import handler as tag_handler
 
+try:
+    try:
+        from ..versioning import archives
+    except ValueError:
+        from versioning import archives
+except ImportError:
+    archives = None
+
 
 class BaseView(generic.base.View):
     """
@@ -1350,7 +1359,7 @@ class DeleteView(ModelCMSMixin, SingleObjectMixin, ModelCMSView):
         msg = None
         if request.POST.get('delete'):
             try:
-                with transaction.commit_on_success():
+                with transaction.savepoint_on_success():
                     self.log_action(self.object, CMSLog.DELETE)
                     msg = "%s deleted" % self.object
                     self.object.delete()
@@ -1511,6 +1520,7 @@ class ListView(ModelCMSMixin, MultipleObjectMixin, ModelCMSView):
         form_class = self.get_formset_form_class()
         if form_class:
             kwargs['formfield_callback'] = self.formfield_for_dbfield
+            kwargs.setdefault('formset', VersionedUniqueFormSet)
             return model_forms.modelformset_factory(self.model,
                         form_class, fields=self.change_fields, extra=0,
                         **kwargs)
@@ -1900,10 +1910,15 @@ class VersionsList(PublishView):
 
         * **versions** - The versions available for this object.\
         These will be instances of the inner version class, and \
-        will not have access to the fields on the base model.
+        will not have access to the fields on the base model. \
+        Compressed archived versions are included.
         * **done_url** - The result of the `get_done_url` method.
         """
         versions = self._get_versions()
+        if archives and archives.is_enabled(versions.model):
+            versions = list(versions) + archives.get_versions(
+                                                versions.model, self.object.pk)
+            versions.sort(key=lambda v: v.date_published, reverse=True)
         return self.render(request, obj=self.object, versions=versions,
                            done_url=self.get_done_url())
 
@@ -1950,6 +1965,8 @@ class VersionsList(PublishView):
         If this method receives unexpected input, it will
         silently redirect to the result of the `get_done_url`
         method.
+
+        Compressed archived versions are restored first.
         """
 
         versions = self._get_versions()
@@ -1958,7 +1975,10 @@ class VersionsList(PublishView):
 
         try:
             vid = int(request.POST.get('version', ''))
-            version = versions.get(vid=vid)
+            version = versions.model.load_version(vid,
+                                                  object_id=self.object.pk)
+            if version.state == version.DRAFT:
+                raise versions.model.DoesNotExist
             if request.POST.get('revert'):
                 object_url = self.get_object_url()
                 msg = self.revert(version, object_url)
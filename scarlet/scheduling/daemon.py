@@ -0,0 +1,186 @@
+"""
+Long running scheduler that runs scheduled updates when they
+are due instead of waiting for the next cron run.
+
+The scheduler keeps the times of the upcoming schedules in a
+heap and sleeps until the first one. New schedules send their
+time with Postgres NOTIFY when they are saved, so a scheduler
+that is LISTENing wakes up for them right away. On other
+databases, or when listening is turned off, it falls back to
+checking the database every poll_interval seconds.
+
+Due schedules are run with
+:py:func:`run_scheduled_updates <scheduling.models.run_scheduled_updates>`,
+so several schedulers and the **do_scheduled_updates** command
+can run at the same time.
+"""
+
+import heapq
+import logging
+import select
+import time
+
+from django.db import connections, router, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import Schedule, SCHEDULE_CHANNEL, run_scheduled_updates
+
+logger = logging.getLogger(__name__)
+
+
+class Scheduler(object):
+    """
+    Runs scheduled updates as soon as they are due.
+
+    :param batch_size: How many schedules to claim at a time.
+    :param poll_interval: The most seconds to go without \
+    checking the database for due and new schedules.
+    :param listen: Wake up for new schedules with LISTEN \
+    when the database supports it.
+    :param limit: How many upcoming times to keep in memory.
+    """
+
+    def __init__(self, batch_size=50, poll_interval=60, listen=True,
+                 limit=1000, using=None):
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.listen = listen
+        self.limit = limit
+        self.using = using or router.db_for_write(Schedule)
+        self.heap = []
+        self.listener = None
+        self.last_poll = None
+        self.stopped = False
+
+    def connect(self):
+        """
+        Opens a separate connection that LISTENs for new
+        schedules. Returns False if the database can't.
+        """
+
+        connection = connections[self.using]
+        if connection.vendor != 'postgresql':
+            return False
+
+        try:
+            import psycopg2
+            from psycopg2 import extensions
+        except ImportError:
+            return False
+
+        settings_dict = connection.settings_dict
+        params = {'database': settings_dict['NAME']}
+        params.update(settings_dict['OPTIONS'])
+        params.pop('autocommit', None)
+        for key in ('USER', 'PASSWORD', 'HOST', 'PORT'):
+            if settings_dict[key]:
+                params[key.lower()] = settings_dict[key]
+
+        self.listener = psycopg2.connect(**params)
+        self.listener.set_isolation_level(
+                                extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        self.listener.cursor().execute("LISTEN %s" % SCHEDULE_CHANNEL)
+        return True
+
+    def close(self):
+        if self.listener is not None:
+            self.listener.close()
+            self.listener = None
+
+    def add(self, when):
+        heapq.heappush(self.heap, when)
+
+    def refresh(self, now=None):
+        """
+        Reloads the times of the upcoming schedules.
+        """
+
+        with transaction.commit_on_success(using=self.using):
+            self.heap = list(Schedule.objects.using(self.using
+                                ).filter(when__gt=now or timezone.now()
+                                ).order_by('when'
+                                ).values_list('when', flat=True
+                                ).distinct()[:self.limit])
+
+    def get_timeout(self, now=None):
+        """
+        Returns how many seconds to sleep before
+        the next schedule is due or the next poll.
+        """
+
+        timeout = self.poll_interval
+        if self.last_poll is not None:
+            timeout -= time.time() - self.last_poll
+        if self.heap:
+            due = self.heap[0] - (now or timezone.now())
+            timeout = min(timeout, due.total_seconds())
+        return max(timeout, 0)
+
+    def wait(self, timeout):
+        """
+        Sleeps for timeout seconds or until a
+        new schedule is saved.
+        """
+
+        if self.listener is None:
+            time.sleep(timeout)
+            return
+
+        if not self.listener.notifies and \
+                select.select([self.listener], [], [], timeout) == ([], [], []):
+            return
+
+        self.listener.poll()
+        while self.listener.notifies:
+            notify = self.listener.notifies.pop(0)
+            when = parse_datetime(notify.payload)
+            if when is not None:
+                self.add(when)
+
+    def tick(self, now=None):
+        """
+        Runs the due schedules if the first one in the
+        heap is due or it is time to poll the database.
+
+        Returns a tuple of the number of schedules that
+        were run and the number that failed.
+        """
+
+        now = now or timezone.now()
+        due = self.heap and self.heap[0] <= now
+        if not due and self.last_poll is not None and \
+                time.time() - self.last_poll < self.poll_interval:
+            return 0, 0
+
+        while self.heap and self.heap[0] <= now:
+            heapq.heappop(self.heap)
+
+        done, failed = run_scheduled_updates(batch_size=self.batch_size,
+                                             now=now, using=self.using)
+        if done or failed:
+            logger.info("Ran %s scheduled updates, %s failed", done, failed)
+
+        self.refresh(now)
+        self.last_poll = time.time()
+        return done, failed
+
+    def run(self):
+        """
+        Runs schedules as they become due until stop is called.
+        """
+
+        if self.listen and not self.connect():
+            logger.info("Can't listen for new schedules, polling "
+                        "every %s seconds", self.poll_interval)
+
+        try:
+            while not self.stopped:
+                self.tick()
+                if not self.stopped:
+                    self.wait(self.get_timeout())
+        finally:
+            self.close()
+
+    def stop(self):
+        self.stopped = True
@@ -1,20 +1,19 @@
 import json
 
-from django.db import models
+from django.conf import settings
+from django.db import models, connections
+from django.db.backends.signals import connection_created
 from django.core.serializers.json import DjangoJSONEncoder
 
 
-class JSONField(models.TextField):
-
-    # Used so to_python() is called
-    __metaclass__ = models.SubfieldBase
+class BaseJSONField(models.TextField):
 
     def __init__(self, *args, **kwargs):
         self.dump_kwargs = kwargs.pop('dump_kwargs',
                                       {'cls': DjangoJSONEncoder})
         self.load_kwargs = kwargs.pop('load_kwargs', {})
 
-        super(JSONField, self).__init__(*args, **kwargs)
+        super(BaseJSONField, self).__init__(*args, **kwargs)
 
     def to_python(self, value):
         if value is None or value == '':
@@ -42,3 +41,183 @@ class JSONField(models.TextField):
 
         # That's our definition!
         return (field_class, args, kwargs)
+
+
+class JSONField(BaseJSONField):
+
+    # Used so to_python() is called
+    __metaclass__ = models.SubfieldBase
+
+
+class LazyJSONDescriptor(object):
+    """
+    Keeps the JSON text loaded from the database
+    and only decodes it when it is first read.
+    """
+
+    def __init__(self, field):
+        self.field = field
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+
+        value = instance.__dict__.get(self.field.attname)
+        if value is None or isinstance(value, basestring):
+            value = self.field.to_python(value)
+            instance.__dict__[self.field.attname] = value
+        return value
+
+    def __set__(self, instance, value):
+        instance.__dict__[self.field.attname] = value
+
+
+class LazyJSONField(BaseJSONField):
+    """
+    JSON field that decodes its value the first time
+    it is read instead of every time a row is loaded,
+    and saves rows that were never read without encoding
+    them again.
+
+    On Postgres 9.4 or newer the column is jsonb, so
+    :py:meth:`JSONQuerySet.json_contains` can filter on
+    it in the database. Elsewhere, or when the connection
+    wasn't opened yet, it is TEXT. Existing TEXT columns on
+    Postgres keep working and are cast when filtering.
+    syncdb doesn't change existing columns, switching them
+    to jsonb needs the ALTER TABLE statements given in the
+    versioning docs.
+
+    psycopg2 decodes jsonb columns itself when rows are
+    loaded. Set **SCHEDULING_LAZY_JSONB** to True to have
+    it return them as text instead, see
+    :py:func:`register_jsonb`.
+    """
+
+    def contribute_to_class(self, cls, name):
+        super(LazyJSONField, self).contribute_to_class(cls, name)
+        setattr(cls, self.name, LazyJSONDescriptor(self))
+
+    def db_type(self, connection):
+        # Only use a version the connection already knows,
+        # Django reads it when the connection is opened.
+        if connection.vendor == 'postgresql' and \
+                getattr(connection, '_pg_version', None) >= 90400:
+            return 'jsonb'
+        return super(LazyJSONField, self).db_type(connection)
+
+    def pre_save(self, model_instance, add):
+        # Skip the descriptor so values that
+        # weren't read aren't decoded.
+        value = model_instance.__dict__.get(self.attname)
+        if not value:
+            return getattr(model_instance, self.attname)
+        return value
+
+
+def json_contains(data, value):
+    """
+    Returns True if the decoded JSON data contains value
+    the way the Postgres jsonb @> operator does it.
+    """
+
+    if isinstance(value, dict):
+        return isinstance(data, dict) and all(
+                    k in data and json_contains(data[k], v)
+                    for k, v in value.items())
+    elif isinstance(value, (list, tuple)):
+        if not isinstance(data, (list, tuple)):
+            return False
+        return all(any(json_contains(d, v) for d in data) for v in value)
+    elif isinstance(data, (list, tuple)):
+        return any(json_contains(d, value) for d in data)
+    return data == value
+
+
+class JSONQuerySet(models.query.QuerySet):
+    """
+    QuerySet for models with JSON fields.
+    """
+
+    def json_contains(self, **kwargs):
+        """
+        Filters for rows where the JSON field of each
+        keyword contains its value, for example
+        json_contains(object_args={'vid': 1}).
+
+        Uses the jsonb @> operator on Postgres and
+        decodes each row on other databases.
+        """
+
+        qs = self
+        for name, value in kwargs.items():
+            qs = qs.json_contains_any(**{name: [value]})
+        return qs
+
+    def json_contains_any(self, **kwargs):
+        """
+        Like json_contains, but each keyword takes a list of
+        values and rows match if they contain any of them.
+        """
+
+        qs = self
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        for name, values in kwargs.items():
+            field = self.model._meta.get_field(name)
+            if connection.vendor == 'postgresql':
+                column = "%s.%s" % (qn(self.model._meta.db_table),
+                                    qn(field.column))
+                qs = qs.extra(where=["%s::jsonb @> ANY(%%s::jsonb[])" % (
+                                                                column)],
+                              params=[[json.dumps(value, **field.dump_kwargs)
+                                       for value in values]])
+            else:
+                pks = [pk for pk, data in qs.values_list('pk', name)
+                       if any(json_contains(field.to_python(data), value)
+                              for value in values)]
+                qs = qs.filter(pk__in=pks)
+        return qs
+
+
+class JSONManager(models.Manager):
+
+    def get_query_set(self):
+        return JSONQuerySet(self.model, using=self._db)
+
+    def json_contains(self, **kwargs):
+        return self.get_query_set().json_contains(**kwargs)
+
+    def json_contains_any(self, **kwargs):
+        return self.get_query_set().json_contains_any(**kwargs)
+
+
+def _return_jsonb_text(value):
+    return value
+
+
+def register_jsonb(sender, connection, **kwargs):
+    """
+    Makes psycopg2 return jsonb values as text, so
+    LazyJSONField can decode them when they are read.
+
+    Only done when **SCHEDULING_LAZY_JSONB** is True.
+    This applies to every jsonb column read through the
+    connection, including those of other apps, which then
+    get strings instead of decoded values.
+    """
+
+    if connection.vendor != 'postgresql' or \
+            not getattr(settings, 'SCHEDULING_LAZY_JSONB', False):
+        return
+
+    try:
+        from psycopg2.extras import register_default_jsonb
+    except ImportError:
+        # Older versions don't decode jsonb
+        return
+    register_default_jsonb(connection.connection, loads=_return_jsonb_text)
+
+
+connection_created.connect(register_jsonb,
+                           dispatch_uid='scheduling_register_jsonb')
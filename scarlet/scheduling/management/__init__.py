@@ -0,0 +1,63 @@
+from django.core.management.color import no_style
+from django.db.models.signals import post_syncdb
+from django.db import connection, transaction
+
+from ..models import Schedule
+
+COLUMNS = "SELECT column_name FROM information_schema.columns WHERE table_schema = 'public' AND table_name = %s"
+ADD_COLUMN = "ALTER TABLE %(table)s ADD COLUMN %(column)s %(type)s NULL"
+
+
+def get_missing_columns(model=Schedule):
+    """
+    Returns a list of (name, statements) tuples for the
+    nullable fields of model that have no column in an
+    existing table, so tables made before the field was
+    added can be brought up to date. Fields that can't be
+    null need a default and are left alone.
+    """
+
+    qn = connection.ops.quote_name
+    table = model._meta.db_table
+    cursor = connection.cursor()
+    cursor.execute(COLUMNS, [table])
+    columns = set(x[0] for x in cursor.fetchall())
+    if not columns:
+        # No table yet, syncdb creates it with every column
+        return []
+
+    result = []
+    for f in model._meta.local_fields:
+        if f.column in columns or not f.null or not f.db_type(connection):
+            continue
+        statements = [ADD_COLUMN % {'table': qn(table),
+                                    'column': qn(f.column),
+                                    'type': f.db_type(connection)}]
+        statements.extend(connection.creation.sql_indexes_for_field(
+                                    model, f, no_style()))
+        result.append(('%s.%s' % (table, f.column), statements))
+    return result
+
+
+def add_missing_columns(sender=None, dry_run=False, **kwargs):
+    """
+    Adds the columns returned by get_missing_columns for
+    the Schedule table. Called after syncdb and from the
+    updateviews command.
+
+    Returns a list of (name, old definition, new definition) \
+    tuples like update_schema.
+    """
+
+    result = []
+    for name, statements in get_missing_columns(Schedule):
+        result.append((name, '', "\n".join(statements)))
+        if dry_run:
+            continue
+        with transaction.commit_on_success():
+            cursor = connection.cursor()
+            for sql in statements:
+                cursor.execute(sql)
+    return result
+
+post_syncdb.connect(add_missing_columns, dispatch_uid='add_missing_columns')
@@ -1,14 +1,46 @@
+from multiprocessing import Pool
+from optparse import make_option
+
 from django.core.management.base import BaseCommand
-from django.db import transaction
-from django.utils import timezone
+from django.db import connections
 
 from ... import models
 
 
+def _run(batch_size):
+    return models.run_scheduled_updates(batch_size=batch_size)
+
+
 class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size',
+            default=50,
+            help='How many schedules to claim at a time.'),
+        make_option('--workers', type='int', dest='workers', default=1,
+            help='How many processes run schedules at the same time.'),
+    )
+    help = 'Runs the scheduled updates that are due.'
 
     def handle(self, *args, **options):
-        with transaction.commit_on_success():
-            for obj in models.Schedule.objects.select_for_update(
-                                    ).filter(when__lte=timezone.now()):
-                obj.do_updates()
+        batch_size = options.get('batch_size')
+        workers = options.get('workers')
+
+        if workers > 1:
+            # Every process needs its own connections
+            for alias in connections:
+                connections[alias].close()
+
+            pool = Pool(workers)
+            try:
+                results = pool.map(_run, [batch_size] * workers)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [_run(batch_size)]
+
+        done = sum([r[0] for r in results])
+        failed = sum([r[1] for r in results])
+        if int(options.get('verbosity', 1)) > 1:
+            self.stdout.write("Ran %s scheduled updates, %s failed\n" % (
+                                                            done, failed))
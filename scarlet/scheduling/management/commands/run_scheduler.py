@@ -0,0 +1,33 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from ...daemon import Scheduler
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size',
+            default=50,
+            help='How many schedules to claim at a time.'),
+        make_option('--poll-interval', type='float', dest='poll_interval',
+            default=60,
+            help='The most seconds to go without checking the database.'),
+        make_option('--no-listen', action='store_false', dest='listen',
+            default=True,
+            help="Don't LISTEN for new schedules, only poll."),
+    )
+    help = 'Keeps running and runs scheduled updates as soon as they ' \
+           'are due.'
+
+    def handle(self, *args, **options):
+        scheduler = Scheduler(batch_size=options.get('batch_size'),
+                              poll_interval=options.get('poll_interval'),
+                              listen=options.get('listen'))
+        if int(options.get('verbosity', 1)) > 1:
+            self.stdout.write("Running scheduler, quit with CONTROL-C.\n")
+
+        try:
+            scheduler.run()
+        except KeyboardInterrupt:
+            scheduler.stop()
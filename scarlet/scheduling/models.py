@@ -1,13 +1,17 @@
+import json
 import logging
 
 from django.utils import timezone
-from django.db import models
+from django.utils.datastructures import SortedDict
+from django.db import models, transaction, connections, router
 from django.contrib.contenttypes.models import ContentType
 
 from . import fields
 
 logger = logging.getLogger(__name__)
 
+SCHEDULE_CHANNEL = 'scarlet_schedule'
+
 
 class Schedulable(models.Model):
     """
@@ -28,6 +32,19 @@ class Schedulable(models.Model):
             'pk': self.pk
         }
 
+    def get_schedule_key(self):
+        """
+        Hook to provide a key for schedules that replace
+        each other. When several schedules of a model with
+        the same key are due at once, only the latest one
+        runs and the others are dropped.
+
+        The default of None means schedules never
+        replace each other.
+        """
+
+        return None
+
     def schedule(self, when=None, action=None, **kwargs):
         """
         Schedule an update of this object.
@@ -52,6 +69,7 @@ class Schedulable(models.Model):
             ctype = ContentType.objects.get_for_model(self.__class__)
             Schedule(content_type=ctype,
                     object_args=self.get_scheduled_filter_args(),
+                     key=self.get_schedule_key(),
                      when=when, action=action,
                      json_args=kwargs).save()
 
@@ -78,6 +96,29 @@ class Schedulable(models.Model):
                 setattr(self, k, v)
             self.save()
 
+    @classmethod
+    def do_bulk_scheduled_update(cls, objects, action, **kwargs):
+        """
+        Do the same update on several objects that
+        were scheduled for the same time.
+
+        Calls do_scheduled_update on each object.
+        Override this to update them all at once.
+        """
+
+        for obj in objects:
+            obj.do_scheduled_update(action, **kwargs)
+
+    @classmethod
+    def drop_scheduled_updates(cls, objects, action, **kwargs):
+        """
+        Hook called with the objects of schedules that were
+        dropped because a later schedule with the same key
+        replaced them. Does nothing by default.
+        """
+
+        pass
+
 
 class Schedule(models.Model):
     """
@@ -85,16 +126,326 @@ class Schedule(models.Model):
     """
 
     content_type = models.ForeignKey(ContentType)
-    object_args = fields.JSONField()
+    object_args = fields.LazyJSONField()
+    key = models.CharField(max_length=255, null=True, blank=True,
+                           db_index=True)
 
     when = models.DateTimeField()
     action = models.CharField(max_length=255, null=True)
-    json_args = fields.JSONField()
+    json_args = fields.LazyJSONField()
+
+    objects = fields.JSONManager()
+
+    def save(self, *args, **kwargs):
+        super(Schedule, self).save(*args, **kwargs)
+        notify_scheduled([self.when], using=self._state.db)
 
-    def do_updates(self):
+    def get_objects(self):
+        klass = self.content_type.model_class()
+        return klass.objects.filter(**self.object_args)
+
+    def do_updates(self, now=None):
         # Only run if we are ready
-        if self.when <= timezone.now():
-            klass = self.content_type.model_class()
-            for obj in klass.objects.filter(**self.object_args):
+        if self.when <= (now or timezone.now()):
+            for obj in self.get_objects():
                 obj.do_scheduled_update(self.action, **self.json_args)
         self.delete()
+
+
+def notify_scheduled(whens, using=None):
+    """
+    Tells running schedulers about new schedules by sending
+    their times to SCHEDULE_CHANNEL with NOTIFY. Postgres only
+    delivers the notifications once the transaction commits.
+    Does nothing on other databases.
+    """
+
+    using = using or router.db_for_write(Schedule)
+    connection = connections[using]
+    if connection.vendor != 'postgresql' or not whens:
+        return
+
+    cursor = connection.cursor()
+    for when in sorted(set(whens)):
+        cursor.execute("SELECT pg_notify(%s, %s)",
+                       [SCHEDULE_CHANNEL, when.isoformat()])
+    transaction.commit_unless_managed(using=using)
+
+
+def delete_schedules(model, objects, using=None):
+    """
+    Deletes the schedules of objects of the given model with
+    a single statement. The schedules are found by the
+    get_scheduled_filter_args of each object.
+    """
+
+    if not objects:
+        return
+
+    using = using or router.db_for_write(Schedule)
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    ctype = ContentType.objects.db_manager(using).get_for_model(model)
+    qs = Schedule.objects.using(using).filter(content_type=ctype
+                    ).json_contains_any(object_args=[
+                        obj.get_scheduled_filter_args() for obj in objects])
+    sql, params = qs.values_list('pk').query.sql_with_params()
+    connection.cursor().execute("DELETE FROM %s WHERE %s IN (%s)" % (
+                                    qn(Schedule._meta.db_table),
+                                    qn(Schedule._meta.pk.column), sql),
+                                params)
+    transaction.commit_unless_managed(using=using)
+
+
+CLAIM_SQL = """
+    SELECT %(id)s FROM %(table)s
+    WHERE %(when)s <= %%s AND NOT (%(id)s = ANY(%%s))
+    ORDER BY %(when)s, %(id)s
+    LIMIT %%s
+    FOR UPDATE SKIP LOCKED
+"""
+
+
+def claim_due(batch_size, now=None, exclude=None, using=None):
+    """
+    Locks up to batch_size due schedules that no other
+    transaction has locked and returns them, oldest first.
+    Should be called inside a transaction, the rows stay
+    locked until it ends.
+
+    Due schedules that have the same key as one of those
+    are locked and returned too, so the latest of them
+    can replace the others.
+
+    :param exclude: Ids of schedules to leave alone.
+    """
+
+    using = using or router.db_for_write(Schedule)
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    names = {'id': qn(Schedule._meta.pk.column),
+             'table': qn(Schedule._meta.db_table),
+             'when': qn('when'),
+             'ctype': qn(Schedule._meta.get_field('content_type').column),
+             'key': qn('key')}
+    now = now or timezone.now()
+    exclude = list(exclude or [])
+
+    cursor = connection.cursor()
+    cursor.execute(CLAIM_SQL % names, [now, exclude, batch_size])
+    ids = [row[0] for row in cursor.fetchall()]
+    if not ids:
+        return []
+
+    cursor.execute(SUPERSEDED_SQL % names, [now, exclude + ids, ids])
+    ids.extend([row[0] for row in cursor.fetchall()])
+    return list(Schedule.objects.using(using).filter(pk__in=ids
+                                                     ).order_by('when', 'pk'))
+
+
+SUPERSEDED_SQL = """
+    SELECT %(id)s FROM %(table)s
+    WHERE %(when)s <= %%s AND NOT (%(id)s = ANY(%%s))
+    AND (%(ctype)s, %(key)s) IN (
+        SELECT %(ctype)s, %(key)s FROM %(table)s
+        WHERE %(id)s = ANY(%%s) AND %(key)s IS NOT NULL)
+    FOR UPDATE SKIP LOCKED
+"""
+
+DELETE_SQL = """
+    DELETE FROM %(table)s WHERE %(id)s = ANY(%%s)
+"""
+
+
+def _get_lookup_field(klass, schedules):
+    """
+    Returns the field all the schedules look up their
+    object by, or None if they don't use a single field.
+    """
+
+    keys = set([tuple(schedule.object_args.keys())
+                for schedule in schedules])
+    if len(keys) != 1:
+        return None
+    key = keys.pop()
+    if len(key) != 1:
+        return None
+
+    key = key[0]
+    if key == 'pk':
+        return klass._meta.pk
+    for field in klass._meta.fields:
+        if field.attname == key:
+            return field
+    return None
+
+
+def get_scheduled_objects(klass, schedules):
+    """
+    Returns a list of (schedule, objects) for schedules of
+    the same model. When all the schedules look up their
+    object by the same field, such as vid or pk, the
+    objects are loaded with a single query.
+    """
+
+    field = _get_lookup_field(klass, schedules)
+    if field is None:
+        return [(schedule, list(schedule.get_objects()))
+                for schedule in schedules]
+
+    key = schedules[0].object_args.keys()[0]
+    values = [field.to_python(schedule.object_args[key])
+              for schedule in schedules]
+    found = {}
+    for obj in klass.objects.filter(**{'%s__in' % key: values}):
+        found.setdefault(getattr(obj, field.attname), []).append(obj)
+    return [(schedule, found.get(value, []))
+            for schedule, value in zip(schedules, values)]
+
+
+def coalesce_schedules(schedules):
+    """
+    Splits schedules into the ones that should run and the
+    ones that are replaced by a later schedule with the same
+    content type and key.
+    """
+
+    latest = {}
+    for schedule in schedules:
+        if schedule.key is None:
+            continue
+        key = (schedule.content_type_id, schedule.key)
+        other = latest.get(key)
+        if other is None or \
+                (schedule.when, schedule.pk) > (other.when, other.pk):
+            latest[key] = schedule
+
+    run = []
+    superseded = []
+    for schedule in schedules:
+        if schedule.key is None or \
+                latest[(schedule.content_type_id, schedule.key)] is schedule:
+            run.append(schedule)
+        else:
+            superseded.append(schedule)
+    return run, superseded
+
+
+def _group_schedules(schedules):
+    groups = SortedDict()
+    for schedule in schedules:
+        key = (schedule.content_type_id, schedule.action,
+               json.dumps(schedule.json_args, sort_keys=True))
+        groups.setdefault(key, []).append(schedule)
+    return groups.values()
+
+
+def _run_group(klass, schedules, drop=False):
+    items = get_scheduled_objects(klass, schedules)
+    method = klass.do_bulk_scheduled_update
+    if drop:
+        method = klass.drop_scheduled_updates
+    method([obj for s, objects in items for obj in objects],
+           schedules[0].action, **schedules[0].json_args)
+
+
+def run_schedules(schedules, using=None):
+    """
+    Runs due schedules and deletes the ones that worked.
+
+    Schedules are grouped by model, action and arguments.
+    Each group loads its objects with one query and passes
+    them to the model's do_bulk_scheduled_update in a
+    savepoint. If that fails the group is rolled back and
+    its schedules are run one at a time, so only the ones
+    that fail are left.
+
+    Schedules that are replaced by a later one with the same
+    key are dropped instead, see :py:func:`coalesce_schedules`.
+    They are passed to the model's drop_scheduled_updates in
+    the savepoint of the schedule that replaced them, so they
+    are only dropped if that one worked and are left along
+    with it otherwise. Schedules that worked or were dropped
+    are deleted with a single statement.
+
+    Returns a tuple of the ids of the schedules that were
+    run or dropped and the ids of the ones that failed or
+    were left because the schedule replacing them failed.
+    """
+
+    using = using or router.db_for_write(Schedule)
+    run, superseded = coalesce_schedules(schedules)
+    latest = dict(((schedule.content_type_id, schedule.key), schedule.pk)
+                  for schedule in run if schedule.key is not None)
+    replaced = {}
+    for schedule in superseded:
+        replaced.setdefault(latest[(schedule.content_type_id, schedule.key)],
+                            []).append(schedule)
+
+    done = []
+    failed = []
+    ctypes = ContentType.objects.db_manager(using)
+    for group in _group_schedules(run):
+        klass = ctypes.get_for_id(group[0].content_type_id).model_class()
+        batches = [group]
+        while batches:
+            batch = batches.pop(0)
+            dropped = [schedule for winner in batch
+                       for schedule in replaced.get(winner.pk, [])]
+            sid = transaction.savepoint(using=using)
+            try:
+                _run_group(klass, batch)
+                for items in _group_schedules(dropped):
+                    _run_group(ctypes.get_for_id(items[0].content_type_id
+                                                 ).model_class(),
+                               items, drop=True)
+            except Exception:
+                transaction.savepoint_rollback(sid, using=using)
+                if len(batch) > 1:
+                    batches.extend([[schedule] for schedule in batch])
+                    continue
+                logger.exception("Scheduled update %s failed", batch[0].pk)
+                failed.extend([schedule.pk for schedule in batch + dropped])
+            else:
+                transaction.savepoint_commit(sid, using=using)
+                done.extend([schedule.pk for schedule in batch + dropped])
+
+    if done:
+        connection = connections[using]
+        qn = connection.ops.quote_name
+        connection.cursor().execute(DELETE_SQL % {
+                                    'id': qn(Schedule._meta.pk.column),
+                                    'table': qn(Schedule._meta.db_table)},
+                                    [done])
+    return done, failed
+
+
+def run_scheduled_updates(batch_size=50, now=None, using=None):
+    """
+    Runs all the due schedules.
+
+    Schedules are claimed in batches with FOR UPDATE SKIP
+    LOCKED, so several processes can run this at the same
+    time without running a schedule twice. Each batch is
+    one transaction and is run with :py:func:`run_schedules`.
+    A schedule that fails is logged, rolled back and left
+    for the next run, the others still happen.
+
+    Returns a tuple of the number of schedules that were
+    run and the number that failed.
+    """
+
+    using = using or router.db_for_write(Schedule)
+    done = 0
+    failed = []
+    while True:
+        with transaction.commit_on_success(using=using):
+            schedules = claim_due(batch_size, now=now, exclude=failed,
+                                  using=using)
+            batch_done, batch_failed = run_schedules(schedules, using=using)
+            done += len(batch_done)
+            failed.extend(batch_failed)
+
+        if not schedules:
+            break
+    return done, len(failed)
@@ -0,0 +1,470 @@
+"""
+Compressed archives.
+
+Versioned models with COMPRESS_ARCHIVES = True move their
+versions out of the version table once they are archived.
+Each version, along with everything that was cloned with
+it, is stored as a single zlib compressed record in the
+ArchivedVersion table, so the version tables and their
+indexes only hold the versions that are still in use.
+
+The records of an item form a chain ordered by vid. The
+newest record holds the full version, every older one only
+holds what is different from the next newer one. Purging
+removes the oldest records so nothing needs to be rewritten
+for that.
+
+Archived versions need to be put back with restore before
+they can be used. BaseVersionedModel.load_version and revert
+do that when they are given the vid of a compressed version.
+
+Versions are only compressed when nothing outside of what
+gets cloned with them points at them or their cloned rows,
+and no model in that tree customizes _clone or delete.
+Otherwise they stay in the version table.
+"""
+
+import base64
+import json
+import re
+import zlib
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import connections, router
+
+from . import bulk
+from .transactions import xact
+
+
+def _get_version_model(model):
+    if getattr(model._meta, '_is_view', False):
+        return model._meta._version_model
+    return model
+
+
+def is_enabled(model):
+    """
+    Returns True if the archived versions of the
+    given view or version model should be compressed.
+    """
+
+    klass = _get_version_model(model)
+    return getattr(klass._meta, '_view_model', klass).COMPRESS_ARCHIVES
+
+
+def _custom(model, name):
+    from .models import Cloneable
+    return getattr(getattr(model, name), 'im_func', None) is not \
+                    getattr(Cloneable, name).im_func
+
+
+def _is_closed(model, tracked, root=False):
+    tracked = set(tracked)
+    children = []
+    for name in bulk.get_clone_related(model):
+        rel, mod, direct, m2m = bulk._get_relation(model, name)
+        if m2m:
+            if not direct:
+                return False
+            through = rel.rel.through
+            tracked.add(bulk._relation_key(through, rel.m2m_field_name()))
+            children.append((rel.rel.to, [bulk._relation_key(through,
+                                            rel.m2m_reverse_field_name())]))
+        else:
+            tracked.add(bulk._relation_key(rel.model, rel.field.name))
+            children.append((rel.model, []))
+
+    for field in bulk.get_copied_m2ms(model):
+        tracked.add(bulk._relation_key(field.rel.through,
+                                       field.m2m_field_name()))
+
+    options = [model._meta]
+    if root and hasattr(model._meta, '_view_model'):
+        options.append(model._meta._view_model._meta)
+
+    for opts in options:
+        for rel in opts.get_all_related_objects(include_hidden=True):
+            if bulk._relation_key(rel.model, rel.field.name) in tracked:
+                continue
+            # Relations to the view that point at
+            # the item instead of a version are fine.
+            if opts is not model._meta and \
+                    rel.field.rel.field_name != model._meta.pk.name:
+                continue
+            return False
+
+    for child, keys in children:
+        if _custom(child, '_clone') or _custom(child, 'delete') or \
+                not _is_closed(child, keys):
+            return False
+    return True
+
+
+def can_compress(model):
+    """
+    Returns True if the versions of the given view or
+    version model can be moved to the archive table
+    without losing anything.
+    """
+
+    return _is_closed(_get_version_model(model), [], root=True)
+
+
+def _encode(payload):
+    return base64.b64encode(zlib.compress(json.dumps(payload,
+                                                     sort_keys=True)))
+
+
+def _decode(data):
+    return json.loads(zlib.decompress(base64.b64decode(data)))
+
+
+def _delta(doc, base):
+    return {'set': dict((k, v) for k, v in doc.items()
+                        if not k in base or base[k] != v),
+            'del': [k for k in base if not k in doc]}
+
+
+def _apply(base, delta):
+    doc = dict(base)
+    doc.update(delta['set'])
+    for k in delta['del']:
+        doc.pop(k, None)
+    return doc
+
+
+def _dump_fields(obj, exclude):
+    values = {}
+    for field in obj._meta.local_fields:
+        if field.primary_key or field in exclude:
+            continue
+
+        value = getattr(obj, field.attname)
+        if not value is None and \
+                not isinstance(value, (bool, int, long, float, basestring)):
+            value = field.value_to_string(obj)
+        values[field.attname] = value
+    return values
+
+
+def _build(model, values):
+    obj = model()
+    for field in model._meta.local_fields:
+        if field.attname in values:
+            value = values[field.attname]
+            if not value is None:
+                value = field.to_python(value)
+            setattr(obj, field.attname, value)
+    return obj
+
+
+def _serialize(klass, versions, using):
+    tree = bulk.CloneTree([(v, None) for v in versions], using=using)
+
+    docs = []
+    sets = tree._get_m2m_sets(klass, versions)
+    for version in versions:
+        doc = {}
+        for name, value in _dump_fields(version, []).items():
+            doc['f:' + name] = value
+        for name, keys in sets.get(id(version), {}).items():
+            doc['m:' + name] = sorted(keys)
+        docs.append(doc)
+
+    # Every cloned row is stored under an id made
+    # from the path of relations that leads to it.
+    rows = {None: [(doc, '') for doc in docs]}
+    for branch in tree.collect():
+        exclude = branch.field and [branch.field] or []
+        sets = tree._get_m2m_sets(branch.model, branch.objs)
+        counts = {}
+        rows[branch] = []
+        for obj, i in zip(branch.objs, branch.parents):
+            doc, parent_id = rows[branch.parent][i]
+            n = counts.get(i, 0)
+            counts[i] = n + 1
+
+            row_id = '%s/%s:%s' % (parent_id, branch.name, n)
+            doc['r:' + row_id] = {
+                'f': _dump_fields(obj, exclude),
+                'm': dict((name, sorted(keys)) for name, keys in
+                          sets.get(id(obj), {}).items())}
+            rows[branch].append((doc, row_id))
+    return docs
+
+
+def _get_records(ctype, object_ids):
+    from .models import ArchivedVersion
+
+    return ArchivedVersion.objects.filter(content_type=ctype,
+                                          object_id__in=list(object_ids))
+
+
+def _load_chains(ctype, object_ids):
+    """
+    Returns a dictionary of object ids and a list of
+    (record, vid, full version) tuples for each item.
+    """
+
+    chains = {}
+    docs = {}
+    for record in _get_records(ctype, object_ids).order_by('-vid'):
+        payload = _decode(record.data)
+        if record.base_vid is None:
+            doc = payload
+        else:
+            doc = _apply(docs[record.base_vid], payload)
+        docs[record.vid] = doc
+        chains.setdefault(record.object_id, []).append(
+                                            (record, record.vid, doc))
+    return chains
+
+
+def _save_chains(klass, ctype, chains):
+    from .models import ArchivedVersion
+
+    meta_fields = ('last_save', 'last_scheduled', 'date_published',
+                   'user_published')
+    created = []
+    for object_id, entries in chains.items():
+        entries = sorted(entries, key=lambda e: e[1], reverse=True)
+        newer = None
+        for record, vid, doc in entries:
+            if newer is None:
+                base_vid, data = None, _encode(doc)
+            else:
+                base_vid, data = newer[0], _encode(_delta(doc, newer[1]))
+            newer = (vid, doc)
+
+            if record is None:
+                record = ArchivedVersion(content_type=ctype,
+                                         object_id=object_id, vid=vid,
+                                         base_vid=base_vid, data=data)
+                for name in meta_fields:
+                    field = klass._meta.get_field(name)
+                    value = doc.get('f:' + field.attname)
+                    if not value is None:
+                        value = field.to_python(value)
+                    setattr(record, name, value)
+                created.append(record)
+            elif record.base_vid != base_vid or record.data != data:
+                ArchivedVersion.objects.filter(pk=record.pk).update(
+                                            base_vid=base_vid, data=data)
+
+    if created:
+        ArchivedVersion.objects.bulk_create(created)
+
+
+def compress(model, vids, using=None):
+    """
+    Moves archived versions to the archive table.
+    Does nothing unless the model has COMPRESS_ARCHIVES
+    set and :py:func:`can_compress` is True.
+
+    :param model: A view or version model.
+    :param vids: The vids of the versions to move.
+
+    Returns the number of versions that were moved.
+    """
+
+    vids = list(vids)
+    if not vids or not is_enabled(model) or not can_compress(model):
+        return 0
+
+    klass = _get_version_model(model)
+    with xact(using=using):
+        versions = list(klass._base_manager.using(using).filter(
+                            vid__in=vids, state=klass.ARCHIVED
+                            ).order_by('vid'))
+        if not versions:
+            return 0
+
+        ctype = ContentType.objects.get_for_model(klass)
+        chains = _load_chains(ctype, set(v.object_id for v in versions))
+        for version, doc in zip(versions,
+                                _serialize(klass, versions, using)):
+            chains.setdefault(version.object_id, []).append(
+                                            (None, version.vid, doc))
+        _save_chains(klass, ctype, chains)
+        bulk.DeleteTree(klass, [v.vid for v in versions], using).delete()
+    return len(versions)
+
+
+def _insert_m2ms(model, objs, sets, using):
+    for field in bulk.get_copied_m2ms(model):
+        key = field.m2m_target_field_name()
+        bulk.insert_m2m(field, [(getattr(obj, key), to_id)
+                                for obj, values in zip(objs, sets)
+                                for to_id in values.get(field.name, [])],
+                        using)
+
+
+def restore(model, vids, using=None, object_ids=None):
+    """
+    Moves compressed versions back to the version table
+    as archived versions, along with everything that was
+    cloned with them. Vids that aren't in the archive
+    table are ignored.
+
+    :param model: A view or version model.
+    :param vids: The vids of the versions to restore.
+    :param object_ids: Only restore versions of these items.
+
+    Returns the restored instances of the version model.
+    """
+
+    from .models import ArchivedVersion
+
+    klass = _get_version_model(model)
+    ctype = ContentType.objects.get_for_model(klass)
+    vids = set(vids)
+    with xact(using=using):
+        records = ArchivedVersion.objects.filter(content_type=ctype,
+                                                 vid__in=vids)
+        if object_ids is not None:
+            records = records.filter(object_id__in=object_ids)
+        object_ids = set(records.values_list('object_id', flat=True))
+        if not object_ids:
+            return []
+
+        chains = _load_chains(ctype, object_ids)
+        docs = []
+        for object_id, entries in chains.items():
+            docs.extend((vid, doc) for record, vid, doc in entries
+                        if vid in vids)
+            chains[object_id] = [e for e in entries if not e[1] in vids]
+
+        versions = []
+        for vid, doc in docs:
+            obj = _build(klass, dict((k[2:], v) for k, v in doc.items()
+                                     if k.startswith('f:')))
+            obj.vid = vid
+            versions.append(obj)
+        klass._base_manager.using(using).bulk_create(versions)
+        _insert_m2ms(klass, versions,
+                     [dict((k[2:], v) for k, v in doc.items()
+                           if k.startswith('m:')) for vid, doc in docs],
+                     using)
+
+        # Restore the cloned rows a relation at a time,
+        # parents before their children.
+        groups = {}
+        for i, (vid, doc) in enumerate(docs):
+            for key, row in doc.items():
+                if key.startswith('r:'):
+                    path = re.sub(r':\d+', '', key[2:])
+                    groups.setdefault(path, []).append((i, key[2:], row))
+
+        objs = [{'': version} for version in versions]
+        models = {'': klass}
+        for path in sorted(groups, key=lambda p: p.count('/')):
+            parent_path, name = path.rsplit('/', 1)
+            rel, mod, direct, m2m = bulk._get_relation(models[parent_path],
+                                                       name)
+            child = m2m and rel.rel.to or rel.model
+            models[path] = child
+
+            rows = sorted(groups[path], key=lambda r: r[1])
+            children = []
+            parents = []
+            for i, row_id, row in rows:
+                obj = _build(child, row['f'])
+                parent = objs[i][row_id.rsplit('/', 1)[0]]
+                if not m2m:
+                    setattr(obj, rel.field.attname,
+                            getattr(parent, rel.field.rel.field_name))
+                objs[i][row_id] = obj
+                children.append(obj)
+                parents.append(parent)
+
+            ids = bulk.allocate_ids(child, len(children), using)
+            for obj, pk in zip(children, ids):
+                obj.pk = pk
+            child._base_manager.using(using).bulk_create(children)
+            _insert_m2ms(child, children, [r[2]['m'] for r in rows], using)
+            if m2m:
+                bulk.insert_m2m(rel, [
+                    (getattr(parent, rel.m2m_target_field_name()),
+                     getattr(obj, rel.m2m_reverse_target_field_name()))
+                    for parent, obj in zip(parents, children)], using)
+
+        _get_records(ctype, object_ids).filter(vid__in=vids).delete()
+        _save_chains(klass, ctype, chains)
+    return versions
+
+
+def get_versions(model, object_id):
+    """
+    Returns unsaved instances of the version model for the
+    compressed versions of an item, newest first. Only the
+    fields that describe the version are set, use restore
+    to get the full version.
+    """
+
+    klass = _get_version_model(model)
+    ctype = ContentType.objects.get_for_model(klass)
+    return [klass(vid=r.vid, object_id=r.object_id, state=klass.ARCHIVED,
+                  last_save=r.last_save, last_scheduled=r.last_scheduled,
+                  date_published=r.date_published,
+                  user_published=r.user_published)
+            for r in _get_records(ctype, [object_id]).order_by('-vid')]
+
+
+def discard(model, object_ids):
+    """
+    Deletes the compressed versions of the given items.
+    """
+
+    if is_enabled(model):
+        klass = _get_version_model(model)
+        _get_records(ContentType.objects.get_for_model(klass),
+                     object_ids).delete()
+
+
+def purge(model, keep, object_ids=None):
+    """
+    Deletes the oldest compressed versions of each item
+    past the number that should be kept, and those of items
+    that no longer exist. Archived versions that are still
+    in the version table count towards keep.
+
+    Returns the number of compressed versions deleted.
+    """
+
+    if not is_enabled(model):
+        return 0
+
+    from .models import ArchivedVersion
+
+    klass = _get_version_model(model)
+    ctype = ContentType.objects.get_for_model(klass)
+    using = router.db_for_write(ArchivedVersion)
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    table = qn(ArchivedVersion._meta.db_table)
+    base = klass._meta.get_field('object').rel.to._meta
+
+    where = "content_type_id = %s"
+    params = [ctype.pk]
+    if object_ids is not None:
+        where += " AND object_id = ANY(%s)"
+        params.append(list(object_ids))
+
+    with xact(using=using):
+        cursor = connection.cursor()
+        cursor.execute("DELETE FROM %(table)s WHERE id IN (SELECT id FROM "
+                       "(SELECT id, object_id, row_number() OVER (PARTITION "
+                       "BY object_id ORDER BY vid DESC) AS num FROM "
+                       "%(table)s WHERE %(where)s) AS a WHERE num > %%s - "
+                       "(SELECT count(*) FROM %(versions)s WHERE "
+                       "%(versions)s.object_id = a.object_id AND "
+                       "%(versions)s.state = %%s)) OR "
+                       "(%(where)s AND NOT EXISTS (SELECT 1 FROM %(base)s "
+                       "WHERE %(base)s.%(pk)s = %(table)s.object_id))" % {
+                            'table': table,
+                            'where': where,
+                            'versions': qn(klass._meta.db_table),
+                            'base': qn(base.db_table),
+                            'pk': qn(base.pk.column)},
+                       params + [keep, klass.ARCHIVED] + params)
+        return cursor.rowcount
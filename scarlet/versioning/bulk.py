@@ -0,0 +1,688 @@
+"""
+Set based helpers for copying versioned rows.
+
+These work directly against the underlying tables with
+raw SQL so that many rows can be copied with a fixed
+number of statements instead of loading and saving each
+instance. Because of that no model signals are sent for
+the rows they create.
+
+All of these should be called from within an xact block.
+"""
+
+import copy
+import hashlib
+
+from django.db import connections, DEFAULT_DB_ALIAS
+from django.db.models import signals
+from django.db.models.fields import FieldDoesNotExist
+from django.dispatch.dispatcher import _make_id
+
+from .instrumentation import span
+
+
+def _get_connection(using):
+    return connections[using or DEFAULT_DB_ALIAS]
+
+
+def _values_sql(rows):
+    """
+    Returns the sql and params for a VALUES list
+    with a row for every tuple in rows.
+    """
+
+    row_sql = "(%s)" % ", ".join(["%s"] * len(rows[0]))
+    params = []
+    for row in rows:
+        params.extend(row)
+    return "VALUES %s" % ", ".join([row_sql] * len(rows)), params
+
+
+def allocate_ids(model, count, using=None):
+    """
+    Reserves `count` new primary key values from the
+    sequence of the given model's table.
+
+    Reserving the keys up front lets us copy rows with an
+    INSERT ... SELECT and still know which new row came from
+    which old one.
+    """
+
+    if not count:
+        return []
+
+    connection = _get_connection(using)
+    opts = model._meta
+    cursor = connection.cursor()
+    cursor.execute("SELECT nextval(pg_get_serial_sequence(%s, %s)) "
+                   "FROM generate_series(1, %s)",
+                   [connection.ops.quote_name(opts.db_table),
+                    opts.pk.column, count])
+    return [row[0] for row in cursor.fetchall()]
+
+
+def copy_rows(model, rows, columns=(), overrides=None, using=None):
+    """
+    Copies rows of the given model's table with a single
+    INSERT ... SELECT statement.
+
+    :param model: The model whose table should be copied.
+
+    :param rows: A list of tuples. The first item in each tuple \
+    is the primary key of the row to copy, the second is the \
+    primary key the copy should get. Any other items are values \
+    for the fields named in `columns`.
+
+    :param columns: Names of fields that get a different \
+    value for each row, taken from `rows`.
+
+    :param overrides: A dictionary of field names and values \
+    that should be set on every copied row.
+    """
+
+    if not rows:
+        return
+
+    connection = _get_connection(using)
+    qn = connection.ops.quote_name
+    opts = model._meta
+    overrides = overrides or {}
+
+    row_columns = dict((opts.get_field(name).column, i + 2)
+                       for i, name in enumerate(columns))
+
+    insert_cols = [qn(opts.pk.column)]
+    select_cols = ['m.c1']
+    params = []
+    for field in opts.local_fields:
+        if field.primary_key:
+            continue
+
+        insert_cols.append(qn(field.column))
+        if field.name in overrides:
+            select_cols.append('%s')
+            params.append(field.get_db_prep_save(overrides[field.name],
+                                                 connection=connection))
+        elif field.column in row_columns:
+            # VALUES loses the column types when a
+            # value is NULL so always cast.
+            select_cols.append('CAST(m.c%s AS %s)' % (
+                                        row_columns[field.column],
+                                        field.db_type(connection)))
+        else:
+            select_cols.append('t.%s' % qn(field.column))
+
+    if columns:
+        fields = [opts.get_field(name) for name in columns]
+        rows = [tuple(row[:2]) + tuple(
+                    f.get_db_prep_save(v, connection=connection)
+                    for f, v in zip(fields, row[2:])) for row in rows]
+
+    values, value_params = _values_sql(rows)
+    value_names = ", ".join(["c%s" % i for i in range(len(rows[0]))])
+
+    sql = "INSERT INTO %(table)s (%(insert_cols)s) " \
+          "SELECT %(select_cols)s FROM %(table)s t " \
+          "INNER JOIN (%(values)s) AS m (%(value_names)s) " \
+          "ON t.%(pk)s = m.c0" % {
+                'table': qn(opts.db_table),
+                'insert_cols': ", ".join(insert_cols),
+                'select_cols': ", ".join(select_cols),
+                'values': values,
+                'value_names': value_names,
+                'pk': qn(opts.pk.column)}
+
+    cursor = connection.cursor()
+    cursor.execute(sql, params + value_params)
+
+
+def copy_m2m(field, pairs, using=None):
+    """
+    Copies the through table rows of a many to many field
+    from each old key to its new key.
+
+    :param field: A ManyToManyField.
+
+    :param pairs: A list of (old, new) tuples for the column \
+    that points to the model the field is on.
+    """
+
+    pairs = list(pairs)
+    if not pairs:
+        return
+
+    connection = _get_connection(using)
+    qn = connection.ops.quote_name
+    through = field.rel.through._meta
+
+    values, params = _values_sql(pairs)
+    sql = "INSERT INTO %(table)s (%(from)s, %(to)s) " \
+          "SELECT m.c1, t.%(to)s FROM %(table)s t " \
+          "INNER JOIN (%(values)s) AS m (c0, c1) " \
+          "ON t.%(from)s = m.c0" % {
+                'table': qn(through.db_table),
+                'from': qn(field.m2m_column_name()),
+                'to': qn(field.m2m_reverse_name()),
+                'values': values}
+
+    cursor = connection.cursor()
+    cursor.execute(sql, params)
+
+
+def insert_m2m(field, pairs, using=None):
+    """
+    Adds through table rows for a many to many field.
+
+    :param pairs: A list of (from, to) tuples.
+    """
+
+    pairs = list(pairs)
+    if not pairs:
+        return
+
+    connection = _get_connection(using)
+    qn = connection.ops.quote_name
+    values, params = _values_sql(pairs)
+    cursor = connection.cursor()
+    cursor.execute("INSERT INTO %s (%s, %s) %s" % (
+                        qn(field.rel.through._meta.db_table),
+                        qn(field.m2m_column_name()),
+                        qn(field.m2m_reverse_name()),
+                        values), params)
+
+
+def get_clone_related(model):
+    """
+    Returns the names of the relations that should
+    be cloned along with the given model.
+    """
+
+    if hasattr(model._meta, '_view_model'):
+        return getattr(model._meta._view_model, '_clone_related', [])
+    return getattr(model, '_clone_related', [])
+
+
+def get_shared_related(model):
+    """
+    Returns the names of the cloned many to many relations
+    whose unchanged rows can be shared between versions
+    instead of being copied.
+    """
+
+    if hasattr(model._meta, '_view_model'):
+        return getattr(model._meta._view_model, '_clone_shared', [])
+    return getattr(model, '_clone_shared', [])
+
+
+def fingerprint(obj, m2m_sets=None):
+    """
+    Returns a hash of the content of a row, made from the
+    values of its get_fingerprint_values method and the
+    targets of its copied many to many fields.
+
+    :param m2m_sets: A dictionary of field names and the \
+    keys the instance is linked to by that field.
+    """
+
+    values = list(obj.get_fingerprint_values())
+    for name, keys in sorted((m2m_sets or {}).items()):
+        values.append((name, sorted(keys)))
+    return hashlib.sha1(repr(values)).hexdigest()
+
+
+def get_copied_m2ms(model):
+    """
+    Returns the many to many fields whose through rows
+    are copied, not cloned, when an instance is cloned.
+    """
+
+    related = get_clone_related(model)
+    return [field for field in model._meta.local_many_to_many
+            if field.rel.through and
+                field.rel.through._meta.auto_created and
+                not field.name in related]
+
+
+def _get_relation(model, name):
+    # Version models look for reverse relations
+    # on their view model too.
+    options = [model._meta]
+    if hasattr(model._meta, '_view_model'):
+        options.append(model._meta._view_model._meta)
+
+    for opts in options:
+        try:
+            return opts.get_field_by_name(name)
+        except FieldDoesNotExist:
+            pass
+    raise FieldDoesNotExist('%s has no field named %r' % (
+                                    model._meta.object_name, name))
+
+
+def _has_receivers(signal, model):
+    # Signal.has_listeners isn't in django 1.4
+    return bool(signal._live_receivers(_make_id(model)))
+
+
+class _Branch(object):
+    """
+    All the rows of one model that are reached through
+    one relation while cloning.
+
+    Every row is stored along with the index of the parent
+    row it belongs to. A row can appear more than once
+    when it is shared by several parents, each parent
+    will get its own copy.
+
+    Rows that don't need to be copied because an identical
+    row can be shared have that row stored in `shared`.
+    """
+
+    def __init__(self, model, parent, field=None, m2m=None):
+        self.model = model
+        self.name = None
+        self.parent = parent
+        self.field = field
+        self.m2m = m2m
+        self.objs = []
+        self.parents = []
+        self.shared = []
+        self.clones = []
+
+        # Classes that customize _clone or save, or that have
+        # save signal receivers, are cloned the slow way
+        from .models import Cloneable
+        self.per_object = getattr(model._clone, 'im_func', None) is not \
+                                Cloneable._clone.im_func or \
+                          getattr(model.save, 'im_func', None) is not \
+                                Cloneable.save.im_func or \
+                          _has_receivers(signals.pre_save, model) or \
+                          _has_receivers(signals.post_save, model)
+
+    def add(self, obj, parent_index):
+        self.objs.append(obj)
+        self.parents.append(parent_index)
+        self.shared.append(None)
+
+
+class CloneTree(object):
+    """
+    Clones the relations of a list of instances that
+    have already been copied.
+
+    The whole tree of rows that need to be cloned is
+    collected first, using one query per relation. Then
+    each level is written with a bulk insert, reusing
+    ids reserved up front so the foreign keys of the next
+    level can be pointed at the new rows.
+
+    :param pairs: A list of (old instance, new instance) \
+    tuples. All instances should be of the same model.
+
+    :param sources: An optional list with an instance for \
+    each pair, or None. Rows of the relations returned by \
+    get_shared_related that have the same fingerprint as a \
+    row of that instance are linked to that row instead of \
+    being copied. The new instances and the sources must \
+    not be edited afterwards, since they share rows.
+    """
+
+    def __init__(self, pairs, using=None, sources=None):
+        self.pairs = list(pairs)
+        self.using = using
+        self.sources = sources and list(sources)
+        self.branches = []
+
+    def _keys(self, objs, name):
+        return [getattr(obj, name) for obj in objs]
+
+    def _collect(self, model, objs, parent):
+        for name in get_clone_related(model):
+            rel, mod, direct, m2m = _get_relation(model, name)
+            if m2m:
+                if not direct:
+                    assert False, \
+                        "cloning reverse m2m is not currently supported"
+                branch = self._collect_m2m(rel, objs, parent)
+                if parent is None and self.sources and \
+                        name in get_shared_related(model) and \
+                        not branch.per_object and \
+                        not get_clone_related(branch.model):
+                    self._share(branch)
+            else:
+                branch = self._collect_reverse(rel, objs, parent)
+
+            branch.name = name
+            self.branches.append(branch)
+            if not branch.per_object and branch.objs:
+                self._collect(branch.model, branch.objs, branch)
+
+    def _collect_m2m(self, field, objs, parent):
+        branch = _Branch(field.rel.to, parent, m2m=field)
+        keys = self._keys(objs, field.m2m_target_field_name())
+
+        connection = _get_connection(self.using)
+        qn = connection.ops.quote_name
+        cursor = connection.cursor()
+        cursor.execute("SELECT %(from)s, %(to)s FROM %(table)s "
+                       "WHERE %(from)s = ANY(%%s) ORDER BY %(to)s" % {
+                            'table': qn(field.rel.through._meta.db_table),
+                            'from': qn(field.m2m_column_name()),
+                            'to': qn(field.m2m_reverse_name())},
+                       [list(set(keys))])
+
+        links = {}
+        for from_id, to_id in cursor.fetchall():
+            links.setdefault(from_id, []).append(to_id)
+
+        related = set()
+        for v in links.values():
+            related.update(v)
+        instances = branch.model._base_manager.using(self.using
+                                                     ).in_bulk(list(related))
+
+        for i, key in enumerate(keys):
+            for to_id in links.get(key, []):
+                branch.add(instances[to_id], i)
+        return branch
+
+    def _get_m2m_sets(self, model, objs):
+        connection = _get_connection(self.using)
+        qn = connection.ops.quote_name
+        cursor = connection.cursor()
+
+        sets = {}
+        for field in get_copied_m2ms(model):
+            keys = self._keys(objs, field.m2m_target_field_name())
+            cursor.execute("SELECT %(from)s, %(to)s FROM %(table)s "
+                           "WHERE %(from)s = ANY(%%s)" % {
+                                'table': qn(field.rel.through._meta.db_table),
+                                'from': qn(field.m2m_column_name()),
+                                'to': qn(field.m2m_reverse_name())},
+                           [list(set(keys))])
+            links = {}
+            for from_id, to_id in cursor.fetchall():
+                links.setdefault(from_id, []).append(to_id)
+
+            for obj, key in zip(objs, keys):
+                sets.setdefault(id(obj), {})[field.name] = links.get(key, [])
+        return sets
+
+    def _share(self, branch):
+        """
+        Finds the rows of the source instances that have the
+        same content as the rows of the branch, only looking
+        at the rows of the source of each row's own parent.
+        Each source row is shared at most once per parent.
+        """
+
+        present = [(i, source) for i, source in enumerate(self.sources)
+                   if source is not None]
+        if not present or not branch.objs:
+            return
+
+        found = self._collect_m2m(branch.m2m,
+                                  [source for i, source in present], None)
+        sets = self._get_m2m_sets(branch.model, branch.objs + found.objs)
+
+        candidates = {}
+        for obj, j in zip(found.objs, found.parents):
+            key = (present[j][0], fingerprint(obj, sets.get(id(obj))))
+            candidates.setdefault(key, []).append(obj)
+
+        for n, (obj, i) in enumerate(zip(branch.objs, branch.parents)):
+            matches = candidates.get((i, fingerprint(obj, sets.get(id(obj)))))
+            if matches:
+                branch.shared[n] = matches.pop(0)
+
+    def _collect_reverse(self, rel, objs, parent):
+        field = rel.field
+        branch = _Branch(rel.model, parent, field=field)
+        keys = self._keys(objs, field.rel.field_name)
+
+        qn = _get_connection(self.using).ops.quote_name
+        where = "%s.%s = ANY(%%s)" % (qn(rel.model._meta.db_table),
+                                      qn(field.column))
+        children = {}
+        for obj in rel.model._base_manager.using(self.using).extra(
+                        where=[where], params=[list(set(keys))]
+                        ).order_by(rel.model._meta.pk.name):
+            children.setdefault(getattr(obj, field.attname), []).append(obj)
+
+        for i, key in enumerate(keys):
+            for obj in children.get(key, []):
+                branch.add(obj, i)
+        return branch
+
+    def _write(self, branch):
+        if branch.parent is None:
+            parents = [new for old, new in self.pairs]
+        else:
+            parents = branch.parent.clones
+
+        if branch.m2m:
+            parent_key = branch.m2m.m2m_target_field_name()
+        else:
+            parent_key = branch.field.rel.field_name
+
+        if branch.per_object:
+            for obj, i in zip(branch.objs, branch.parents):
+                clone = copy.copy(obj)
+                attrs = {}
+                if branch.field:
+                    attrs[branch.field.column] = getattr(parents[i],
+                                                         parent_key)
+                clone._clone(**attrs)
+                branch.clones.append(clone)
+        else:
+            copied = []
+            ids = iter(allocate_ids(branch.model,
+                                    branch.shared.count(None), self.using))
+            for obj, i, shared in zip(branch.objs, branch.parents,
+                                      branch.shared):
+                if shared is not None:
+                    branch.clones.append(shared)
+                    continue
+
+                clone = copy.copy(obj)
+                clone._state = copy.copy(obj._state)
+                if branch.field:
+                    setattr(clone, branch.field.attname,
+                            getattr(parents[i], parent_key))
+                clone.prep_for_clone()
+                clone.pk = ids.next()
+                branch.clones.append(clone)
+                copied.append((obj, clone))
+
+            if copied:
+                branch.model._base_manager.using(self.using).bulk_create(
+                                        [clone for obj, clone in copied])
+            for field in get_copied_m2ms(branch.model):
+                key = field.m2m_target_field_name()
+                copy_m2m(field, [(getattr(obj, key), getattr(clone, key))
+                                 for obj, clone in copied], self.using)
+
+        if branch.m2m:
+            key = branch.m2m.m2m_reverse_target_field_name()
+            insert_m2m(branch.m2m, [(getattr(parents[i], parent_key),
+                                     getattr(clone, key))
+                        for i, clone in zip(branch.parents, branch.clones)],
+                       self.using)
+
+    def collect(self):
+        """
+        Reads the tree of rows that would be cloned for the
+        old instances without writing anything.
+
+        Returns a list of branches, parents come before their
+        children. Each branch has the related model, the name
+        of the relation, the parent branch (None for the old
+        instances), and lists of the rows and the index of
+        the parent each row belongs to.
+        """
+
+        if self.pairs and not self.branches:
+            model = self.pairs[0][0].__class__
+            self._collect(model, [old for old, new in self.pairs], None)
+        return self.branches
+
+    def clone(self):
+        """
+        Copies the many to many rows of the given instances
+        and clones all their registered relations.
+        """
+
+        if not self.pairs:
+            return
+
+        model = self.pairs[0][0].__class__
+        for field in get_copied_m2ms(model):
+            key = field.m2m_target_field_name()
+            copy_m2m(field, [(getattr(old, key), getattr(new, key))
+                             for old, new in self.pairs], self.using)
+
+        with span('clone.collect', model=model._meta.object_name):
+            branches = self.collect()
+
+        for branch in branches:
+            with span('clone.write', model=branch.model._meta.object_name,
+                      relation=branch.name, objects=len(branch.objs)):
+                self._write(branch)
+
+
+def _relation_key(model, name):
+    # Views and their version models have separate through
+    # models for the same table so compare by table.
+    return (model._meta.db_table, model._meta.get_field(name).column)
+
+
+class DeleteTree(object):
+    """
+    Deletes rows along with everything that would have
+    been cloned with them.
+
+    Each relation is deleted with a single
+    DELETE ... WHERE ... IN (subquery) statement, starting
+    from the bottom of the tree. Rows that have relations
+    that are not part of the tree are handed to the normal
+    django delete collector so they still cascade, and
+    classes that customize delete are deleted one at a time.
+
+    :param model: The model of the rows to delete.
+
+    :param pks: A list of primary keys of the rows to delete.
+    """
+
+    def __init__(self, model, pks, using=None):
+        self.model = model
+        self.pks = list(pks)
+        self.using = using
+        self.connection = _get_connection(using)
+
+    def _execute(self, sql, params):
+        cursor = self.connection.cursor()
+        cursor.execute(sql, params)
+
+    def _select(self, model, name, where):
+        qn = self.connection.ops.quote_name
+        return "SELECT %s FROM %s WHERE %s" % (
+                                qn(model._meta.get_field(name).column),
+                                qn(model._meta.db_table), where)
+
+    def _custom_delete(self, model):
+        from .models import Cloneable
+        return getattr(model.delete, 'im_func', None) is not \
+                                Cloneable.delete.im_func
+
+    def _delete(self, model, where, params, tracked, root=False):
+        qn = self.connection.ops.quote_name
+        tracked = set(tracked)
+
+        if not root and self._custom_delete(model):
+            for obj in model._base_manager.using(self.using).extra(
+                                where=[where], params=params):
+                obj.delete()
+            return
+
+        shared = get_shared_related(model)
+        for name in get_clone_related(model):
+            rel, mod, direct, m2m = _get_relation(model, name)
+            if m2m:
+                if not direct:
+                    assert False, \
+                        "cloning reverse m2m is not currently supported"
+                through = rel.rel.through
+                link_where = "%s IN (%s)" % (qn(rel.m2m_column_name()),
+                            self._select(model, rel.m2m_target_field_name(),
+                                         where))
+                target = "%s.%s" % (qn(rel.rel.to._meta.db_table),
+                                    qn(rel.rel.to._meta.get_field(
+                                    rel.m2m_reverse_target_field_name()
+                                    ).column))
+                child_keys = [_relation_key(through,
+                                            rel.m2m_reverse_field_name())]
+                if name in shared:
+                    # Unlink first, then only delete the rows
+                    # that no other version links to.
+                    cursor = self.connection.cursor()
+                    cursor.execute("DELETE FROM %s WHERE %s RETURNING %s" % (
+                                        qn(through._meta.db_table), link_where,
+                                        qn(rel.m2m_reverse_name())), params)
+                    linked = list(set(row[0] for row in cursor.fetchall()))
+                    if linked:
+                        self._delete(rel.rel.to, "%(target)s = ANY(%%s) AND "
+                                "NOT EXISTS (SELECT 1 FROM %(table)s s "
+                                "WHERE s.%(to)s = %(target)s)" % {
+                                    'target': target,
+                                    'table': qn(through._meta.db_table),
+                                    'to': qn(rel.m2m_reverse_name())},
+                                [linked], child_keys)
+                else:
+                    child_where = "%s IN (SELECT %s FROM %s WHERE %s)" % (
+                        target, qn(rel.m2m_reverse_name()),
+                        qn(through._meta.db_table), link_where)
+                    self._delete(rel.rel.to, child_where, params, child_keys)
+                    self._execute("DELETE FROM %s WHERE %s" % (
+                                        qn(through._meta.db_table),
+                                        link_where), params)
+                tracked.add(_relation_key(through, rel.m2m_field_name()))
+            else:
+                field = rel.field
+                child_where = "%s IN (%s)" % (qn(field.column),
+                            self._select(model, field.rel.field_name, where))
+                self._delete(rel.model, child_where, params, [])
+                tracked.add(_relation_key(rel.model, field.name))
+
+        for field in get_copied_m2ms(model):
+            through = field.rel.through
+            self._execute("DELETE FROM %s WHERE %s IN (%s)" % (
+                            qn(through._meta.db_table),
+                            qn(field.m2m_column_name()),
+                            self._select(model,
+                                    field.m2m_target_field_name(), where)),
+                          params)
+            tracked.add(_relation_key(through, field.m2m_field_name()))
+
+        untracked = [rel for rel in model._meta.get_all_related_objects(
+                                                    include_hidden=True)
+                     if not _relation_key(rel.model,
+                                          rel.field.name) in tracked]
+        if untracked:
+            model._base_manager.using(self.using).extra(
+                                where=[where], params=params).delete()
+        else:
+            self._execute("DELETE FROM %s WHERE %s" % (
+                                qn(model._meta.db_table), where), params)
+
+    def delete(self):
+        """
+        Deletes the rows and their registered relations.
+        """
+
+        if not self.pks:
+            return
+
+        opts = self.model._meta
+        qn = self.connection.ops.quote_name
+        where = "%s.%s = ANY(%%s)" % (qn(opts.db_table), qn(opts.pk.column))
+        self._delete(self.model, where, [self.pks], [], root=True)
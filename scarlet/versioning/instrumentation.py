@@ -0,0 +1,157 @@
+"""
+Timing and query counts for versioning operations.
+
+Publishing, cloning, unpublishing, making drafts and purging
+archives run inside spans. Each span records how long it took,
+how many queries it ran and how many rows those queries
+returned or changed, including the work of the spans nested
+inside it.
+
+Spans are only recorded while something is connected to the
+`span_finished` signal, which is sent with the span when it
+ends. Connect :py:func:`log_span` to it, or set
+**VERSIONING_LOG_SPANS** to True, to log every span to the
+`scarlet.versioning` logger. The **versioning_profile** command
+prints the spans of a single publish.
+"""
+
+import logging
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from django import dispatch
+from django.conf import settings
+
+from .state import get_store
+
+span_finished = dispatch.Signal(providing_args=['span'])
+
+logger = logging.getLogger('scarlet.versioning')
+
+
+class Span(object):
+    """
+    One timed operation.
+
+    :param name: The name of the operation, such as 'publish'.
+    :param tags: Extra details, such as the model.
+    :param parent: The span this one runs in, or None.
+    :param children: The spans that ran inside this one.
+    :param duration: Wall time in seconds, once finished.
+    :param queries: The number of queries run.
+    :param rows: The number of rows returned or changed.
+    """
+
+    def __init__(self, name, parent=None, **tags):
+        self.name = name
+        self.tags = tags
+        self.parent = parent
+        self.children = []
+        self.queries = 0
+        self.rows = 0
+        self.error = False
+        self.start = time.time()
+        self.duration = None
+
+    def __repr__(self):
+        return "<Span %s>" % self.describe()
+
+    def describe(self):
+        tags = " ".join(["%s=%s" % item for item in sorted(self.tags.items())])
+        return "%s %s %.1fms %s queries %s rows%s" % (
+                        self.name, tags, (self.duration or 0) * 1000,
+                        self.queries, self.rows,
+                        self.error and " (failed)" or "")
+
+    def walk(self, depth=0):
+        """
+        Yields (depth, span) for this span and
+        all the spans inside it.
+        """
+
+        yield depth, self
+        for child in self.children:
+            for item in child.walk(depth + 1):
+                yield item
+
+
+def is_enabled():
+    return bool(span_finished.receivers)
+
+
+def _get_stack():
+    return get_store().get('spans') or []
+
+
+def get_current():
+    """
+    Returns the innermost open span, or None.
+    """
+
+    stack = _get_stack()
+    return stack and stack[-1] or None
+
+
+def record_query(rows=0):
+    """
+    Counts a query in all open spans.
+    """
+
+    for s in _get_stack():
+        s.queries += 1
+        s.rows += rows
+
+
+@contextmanager
+def span(name, **tags):
+    """
+    Context manager that records a span. Yields the
+    span, or None when nothing collects spans.
+    """
+
+    if not is_enabled():
+        yield None
+        return
+
+    stack = list(_get_stack())
+    s = Span(name, parent=stack and stack[-1] or None, **tags)
+    if s.parent:
+        s.parent.children.append(s)
+    get_store().set('spans', stack + [s])
+    try:
+        yield s
+    except:
+        s.error = True
+        raise
+    finally:
+        s.duration = time.time() - s.start
+        get_store().set('spans', stack)
+        span_finished.send(sender=Span, span=s)
+
+
+def instrument(name):
+    """
+    Decorator for model methods that runs
+    them in a span tagged with the model.
+    """
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(self, *args, **kwargs):
+            with span(name, model=self._meta.object_name):
+                return func(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def log_span(sender, span, **kwargs):
+    """
+    Logs a finished span at the debug level.
+    """
+
+    logger.debug(span.describe())
+
+
+if getattr(settings, 'VERSIONING_LOG_SPANS', False):
+    span_finished.connect(log_span, dispatch_uid='versioning_log_span')
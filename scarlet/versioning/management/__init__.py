@@ -1,11 +1,32 @@
+import hashlib
+
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
 from django.db.models.signals import post_syncdb
-from django.db import connection, transaction, utils
+from django.db import connection, utils
+from django.db.backends.util import truncate_name
+
+from ..transactions import xact
 
 
 VIEW_SQL = "CREATE OR REPLACE VIEW %(schema)s.%(model_table)s as select * from %(version_model)s inner join %(base_model)s on %(base_model)s.id = %(version_model)s.object_id"
-DROP_SQL = "DROP VIEW IF EXISTS %(schema)s.%(model_table)s;"
+DROP_SQL = "DROP %(kind)s IF EXISTS %(schema)s.%(model_table)s;"
+SNAPSHOT_SQL = "CREATE TABLE %(schema)s.%(model_table)s AS SELECT * FROM public.%(model_table)s"
+SNAPSHOT_PK = "ALTER TABLE %(schema)s.%(model_table)s ADD PRIMARY KEY (id)"
+SNAPSHOT_INDEX = "CREATE UNIQUE INDEX %(index_name)s ON %(schema)s.%(model_table)s (vid)"
+RELATIONS = "SELECT n.nspname || '.' || c.relname, c.relkind FROM pg_class c INNER JOIN pg_namespace n ON n.oid = c.relnamespace WHERE c.relkind IN ('r', 'v') AND n.nspname NOT IN ('pg_catalog', 'information_schema')"
 EXISTS = "SELECT exists(select schema_name FROM information_schema.schemata WHERE schema_name = %s)"
+EXISTS_TABLE = "SELECT exists(select table_name FROM information_schema.tables WHERE table_schema = 'public' AND table_name = %s)"
+DDL_TABLE = "versioning_schema_objects"
+CREATE_DDL_TABLE = "CREATE TABLE IF NOT EXISTS public.%s (name varchar(255) PRIMARY KEY, fingerprint varchar(40) NOT NULL, definition text NOT NULL)"
+INDEX_SQL = "CREATE INDEX %(index_name)s ON %(version_model)s (%(columns)s)"
+INDEXES = "SELECT indexname FROM pg_indexes WHERE schemaname = 'public' AND tablename = %s"
+PARTITIONED = "SELECT exists(SELECT 1 FROM pg_class c INNER JOIN pg_namespace n ON n.oid = c.relnamespace WHERE n.nspname = 'public' AND c.relname = %s AND c.relkind = 'p')"
+TABLE_FKS = "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint WHERE conrelid = %s::regclass AND contype = 'f'"
+REFERENCING_FKS = "SELECT conrelid::regclass || '.' || conname FROM pg_constraint WHERE confrelid = %s::regclass AND contype = 'f' ORDER BY 1"
+TABLE_INDEXES = "SELECT indexdef FROM pg_indexes WHERE schemaname = 'public' AND tablename = %s AND indexdef NOT LIKE 'CREATE UNIQUE %%'"
+SEQUENCE = "SELECT pg_get_serial_sequence(%s, %s)"
+PARTITION_SQL = "CREATE TABLE %(partition)s PARTITION OF %(version_model)s FOR VALUES IN ('%(value)s')"
 TRIGGER = "CREATE TRIGGER %(trigger_name)s INSTEAD OF UPDATE OR DELETE ON %(schema)s.%(model_table)s FOR EACH ROW EXECUTE PROCEDURE %(function_name)s();"
 
 def trigger_function(base_model, version_model, args):
@@ -40,47 +61,334 @@ def trigger_function(base_model, version_model, args):
     $function$;
     """ % local_args
 
-def update_schema(app, created_models, verbosity, **kwargs):
+def get_indexes(model):
+    """
+    Returns a list of (index name, sql, params) tuples for
+    the indexes the version table of a view model should have.
+
+    That is an index on object_id for each state that gets
+    its own view and one for looking up the versions of an
+    item by state and date. Tables partitioned by state don't
+    need the per state indexes.
+    """
+
+    qn = connection.ops.quote_name
+    version_model = model._meta._version_model
+    table = version_model._meta.db_table
+    max_length = connection.ops.max_name_length()
+
+    indexes = []
+    states = version_model.UNIQUE_STATES
+    if getattr(model._meta, '_partition_by_state', False):
+        states = []
+
+    for schema in states:
+        name = truncate_name('%s_%s_object_id' % (table, schema), max_length)
+        sql = INDEX_SQL % {'index_name': qn(name),
+                           'version_model': qn(table),
+                           'columns': qn('object_id')}
+        indexes.append((name, sql + " WHERE %s = %%s" % qn('state'),
+                        [schema]))
+
+    name = truncate_name('%s_object_id_state' % table, max_length)
+    sql = INDEX_SQL % {'index_name': qn(name),
+                       'version_model': qn(table),
+                       'columns': ', '.join([qn('object_id'), qn('state'),
+                                             qn('last_save')])}
+    indexes.append((name, sql, []))
+    return indexes
+
+def get_missing_indexes(model):
+    """
+    Returns the indexes from get_indexes that
+    don't exist in the database yet.
+    """
+
+    cursor = connection.cursor()
+    cursor.execute(INDEXES, [model._meta._version_model._meta.db_table])
+    existing = set(row[0] for row in cursor.fetchall())
+    return [x for x in get_indexes(model) if not x[0] in existing]
+
+def get_partition_name(model, state):
+    """
+    Returns the name of the partition of the version
+    table of a view model that holds the given state.
+    """
+
+    return truncate_name('%s_%s' % (model._meta._version_model._meta.db_table,
+                                    state), connection.ops.max_name_length())
+
+def get_partition_statements(model, cursor):
+    """
+    Returns a list of the sql statements that turn the
+    version table of a view model into a table partitioned
+    by state, with a partition for each state and a default
+    one. Empty if the table is already partitioned.
+
+    The rows, indexes and foreign keys of the table are kept.
+    The primary key becomes (vid, state) since it has to
+    include the state, so nothing can reference vid anymore.
+    Raises ImproperlyConfigured naming the foreign keys that
+    point at the table if there are any, rather than dropping
+    them. The views on the table are dropped.
+    """
+
+    qn = connection.ops.quote_name
+    version_model = model._meta._version_model
+    table = version_model._meta.db_table
+    pk = version_model._meta.pk.column
+
+    cursor.execute(PARTITIONED, [table])
+    if cursor.fetchone()[0]:
+        return []
+
+    cursor.execute(REFERENCING_FKS, [qn(table)])
+    referencing = [row[0] for row in cursor.fetchall()]
+    if referencing:
+        raise ImproperlyConfigured("%s can't be partitioned by state, "
+                                   "these foreign keys reference it: %s" % (
+                                        table, ", ".join(referencing)))
+
+    cursor.execute(TABLE_FKS, [qn(table)])
+    foreign_keys = cursor.fetchall()
+    cursor.execute(TABLE_INDEXES, [table])
+    indexes = [row[0] for row in cursor.fetchall()]
+    cursor.execute(SEQUENCE, [qn(table), pk])
+    sequence = cursor.fetchone()[0]
+
+    args = {'version_model': qn(table),
+            'old': qn(truncate_name('%s_unpartitioned' % table,
+                                    connection.ops.max_name_length())),
+            'pk': qn(pk),
+            'state': qn('state'),
+            'sequence': sequence}
+
+    statements = [
+        "ALTER TABLE %(version_model)s RENAME TO %(old)s" % args,
+        "CREATE TABLE %(version_model)s (LIKE %(old)s INCLUDING DEFAULTS) "
+        "PARTITION BY LIST (%(state)s)" % args]
+    for state, label in version_model.STATES:
+        args.update({'partition': qn(get_partition_name(model, state)),
+                     'value': state.replace("'", "''")})
+        statements.append(PARTITION_SQL % args)
+    statements.extend([
+        "CREATE TABLE %s PARTITION OF %s DEFAULT" % (
+                        qn(get_partition_name(model, 'other')), qn(table)),
+        "ALTER SEQUENCE %(sequence)s OWNED BY %(version_model)s.%(pk)s" % args,
+        "INSERT INTO %(version_model)s SELECT * FROM %(old)s" % args,
+        "DROP TABLE %(old)s CASCADE" % args,
+        "ALTER TABLE %(version_model)s ADD PRIMARY KEY (%(pk)s, %(state)s)" % args])
+    statements.extend(indexes)
+    statements.extend(["ALTER TABLE %s ADD CONSTRAINT %s %s" % (
+                                        qn(table), qn(name), definition)
+                       for name, definition in foreign_keys])
+    return statements
+
+def get_schema_objects(model):
+    """
+    Returns a list of (name, kind, definition, statements)
+    tuples for the database objects a view model needs. That
+    is its trigger function and a view with an INSTEAD OF
+    trigger in public and in the schema of each state.
+
+    Models with _published_snapshot set in their Meta get a
+    table in the published schema instead of a view. The state
+    views of models with _partition_by_state read from the
+    partition of their state.
+
+    Kind is one of 'function', 'view' or 'table'. The definition
+    is the text used to fingerprint the object, statements is a
+    list of (sql, params) that create it.
+    """
+
+    qn = connection.ops.quote_name
+    base_model = model._meta._base_model
+    version_model = model._meta._version_model
+    args = {'base_model': qn(base_model._meta.db_table),
+            'version_model': qn(version_model._meta.db_table),
+            'model_table': qn(model._meta.db_table),
+            'function_name' : qn(model._meta.db_table + '_func'),
+            'trigger_name' : qn(model._meta.db_table + '_trigger'),
+            'schema': qn('public'),
+            'state': qn('state')}
+
+    function_sql = trigger_function(base_model, version_model, args)
+    objects = [(model._meta.db_table + '_func', 'function',
+                function_sql.strip(), [(function_sql, [])])]
+
+    # The views select *, so they need to be recreated
+    # when the columns change.
+    columns = "-- columns: %s" % ", ".join(
+                    [f.column for f in version_model._meta.local_fields] +
+                    [f.column for f in base_model._meta.local_fields])
+
+    for schema in ['public'] + list(version_model.UNIQUE_STATES):
+        name = '%s.%s' % (schema, model._meta.db_table)
+        args['schema'] = qn(schema)
+        where = "WHERE %(version_model)s.%(state)s = '%%s'" % args % \
+                                        schema.replace("'", "''")
+
+        if schema == version_model.PUBLISHED and \
+                getattr(model._meta, '_published_snapshot', False):
+            args['index_name'] = qn(truncate_name('%s_vid' % (
+                                        model._meta.db_table),
+                                        connection.ops.max_name_length()))
+            table_sql = SNAPSHOT_SQL % args + " WHERE %s = '%s'" % (
+                                    qn('state'), schema.replace("'", "''"))
+            statements = [table_sql, SNAPSHOT_PK % args,
+                          SNAPSHOT_INDEX % args]
+            objects.append((name, 'table',
+                            "\n".join(statements + [columns]),
+                            [(sql, []) for sql in statements]))
+            continue
+
+        view_args = args
+        if schema != 'public' and \
+                getattr(model._meta, '_partition_by_state', False):
+            view_args = dict(args, version_model=qn(
+                                    get_partition_name(model, schema)))
+            where = "WHERE %(version_model)s.%(state)s = '%%s'" % \
+                                view_args % schema.replace("'", "''")
+
+        view_sql = VIEW_SQL % view_args
+        if schema != 'public':
+            view_sql = " ".join([view_sql, where])
+        trigger_sql = TRIGGER % args
+
+        objects.append((name, 'view',
+                        "\n".join([view_sql, trigger_sql, columns]),
+                        [(view_sql, []), (trigger_sql, [])]))
+    return objects
+
+def _fingerprint(definition):
+    return hashlib.sha1(definition).hexdigest()
+
+def _get_stored_objects(cursor):
+    cursor.execute(EXISTS_TABLE, [DDL_TABLE])
+    if not cursor.fetchone()[0]:
+        return {}
+
+    cursor.execute("SELECT name, fingerprint, definition FROM %s" % (
+                                    connection.ops.quote_name(DDL_TABLE)))
+    return dict((name, (fingerprint, definition))
+                for name, fingerprint, definition in cursor.fetchall())
+
+def _get_relations(cursor):
+    cursor.execute(RELATIONS)
+    return dict((name, kind == 'v' and 'view' or 'table')
+                for name, kind in cursor.fetchall())
+
+def get_schema_changes(model, stored, relations):
+    """
+    Returns a list of (name, kind, old definition, new
+    definition, statements) tuples for the objects of a view
+    model that are missing or whose definition changed.
+
+    :param stored: The stored fingerprints, by object name.
+    :param relations: A dictionary of the kind of every \
+    'schema.name' view or table that exists.
+    """
 
+    changes = []
+    for name, kind, definition, statements in get_schema_objects(model):
+        old_fingerprint, old_definition = stored.get(name, (None, ''))
+        if kind != 'function' and relations.get(name) != kind:
+            old_fingerprint, old_definition = None, ''
+
+        if old_fingerprint != _fingerprint(definition):
+            changes.append((name, kind, old_definition, definition,
+                            statements))
+    return changes
+
+def update_schema(app, created_models, verbosity, dry_run=False, **kwargs):
+    """
+    Creates or updates the views, trigger functions, triggers
+    and indexes of view models.
+
+    A fingerprint of every view and trigger function is kept
+    in a bookkeeping table so only objects whose definition
+    changed are issued again. Each model is updated in its
+    own transaction. Version tables of models with
+    _partition_by_state are partitioned first if they aren't yet.
+
+    :param dry_run: Don't change anything, only find what \
+    would be changed.
+
+    Returns a list of (name, old definition, new definition) \
+    tuples for the objects that were or would be changed. \
+    Missing indexes are included with an empty old definition.
+    """
+
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    stored = _get_stored_objects(cursor)
+    if not dry_run:
+        # Commit it even when no model changes
+        with xact():
+            connection.cursor().execute(CREATE_DDL_TABLE % qn(DDL_TABLE))
+
+    relations = _get_relations(cursor)
+
+    result = []
     for m in created_models:
-        if getattr(m._meta, '_is_view', None):
-            qn = connection.ops.quote_name
-            args = {'base_model': qn(m._meta._base_model._meta.db_table),
-                    'version_model': qn(m._meta._version_model._meta.db_table),
-                    'model_table': qn(m._meta.db_table),
-                    'function_name' : qn(m._meta.db_table + '_func'),
-                    'trigger_name' : qn(m._meta.db_table + '_trigger'),
-                    'schema': qn('public'),
-                    'state': qn('state')}
-
-            base_sql = VIEW_SQL % args
-            cursor = connection.cursor()
+        if not getattr(m._meta, '_is_view', None):
+            continue
 
-            cursor.execute(DROP_SQL % args)
-            cursor.execute(base_sql)
+        partition = []
+        model_relations = relations
+        if getattr(m._meta, '_partition_by_state', False):
+            partition = get_partition_statements(m, cursor)
+        if partition:
+            # Partitioning drops the views on the table
+            model_relations = dict((name, kind) for name, kind in
+                                   relations.items() if kind != 'view' or
+                                   name.split('.')[1] != m._meta.db_table)
+            result.append(('public.%s' % m._meta._version_model._meta.db_table,
+                           '', ";\n".join(partition)))
+
+        changes = get_schema_changes(m, stored, model_relations)
+        indexes = get_missing_indexes(m)
+        result.extend([(x[0], x[2], x[3]) for x in changes])
+        result.extend([(name, '', sql % tuple("'%s'" % p for p in params))
+                       for name, sql, params in indexes])
+        if dry_run or not (partition or changes or indexes):
+            continue
+
+        with xact():
+            cursor = connection.cursor()
+            for sql in partition:
+                cursor.execute(sql)
 
-            trigger_sql = trigger_function(m._meta._base_model,
-                                           m._meta._version_model, args)
-            cursor.execute(trigger_sql)
-            cursor.execute(TRIGGER % args)
-            for schema in m._meta._version_model.UNIQUE_STATES:
-                qn_schema = qn(schema)
+            for name, kind, old, definition, statements in changes:
+                if kind != 'function':
+                    schema, table = name.split('.')
+                    if schema != 'public':
+                        # Make sure schema exists
+                        cursor.execute(EXISTS, (schema,))
+                        if not cursor.fetchone()[0]:
+                            cursor.execute("CREATE SCHEMA %s" % qn(schema))
 
-                # Make sure schema exists
-                cursor.execute("SELECT exists(select schema_name FROM information_schema.schemata WHERE schema_name = %s)", (schema,))
-                if not cursor.fetchone()[0]:
-                    cursor.execute("CREATE SCHEMA %s" % qn_schema)
+                    # Drop whatever is there now, a snapshot
+                    # might be replacing a view or the other way.
+                    if name in model_relations:
+                        cursor.execute(DROP_SQL % {
+                                    'kind': model_relations[name].upper(),
+                                    'schema': qn(schema),
+                                    'model_table': qn(table)})
 
-                args['schema'] = qn_schema
+                for sql, params in statements:
+                    cursor.execute(sql, params)
 
-                cursor.execute(DROP_SQL % args)
-                where = "WHERE %(version_model)s.%(state)s = %%s" % args
+                cursor.execute("DELETE FROM %s WHERE name = %%s" % (
+                                                qn(DDL_TABLE)), [name])
+                cursor.execute("INSERT INTO %s (name, fingerprint, "
+                               "definition) VALUES (%%s, %%s, %%s)" % (
+                                                qn(DDL_TABLE)),
+                               [name, _fingerprint(definition), definition])
 
-                base_sql = VIEW_SQL % args
-                sql = " ".join([base_sql, where])
-                cursor.execute(sql, (schema,))
-                cursor.execute(TRIGGER % args)
+            for name, sql, params in indexes:
+                cursor.execute(sql, params)
 
-            transaction.commit_unless_managed()
+    return result
 
 post_syncdb.connect(update_schema, dispatch_uid='update_schema')
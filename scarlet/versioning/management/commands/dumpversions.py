@@ -0,0 +1,32 @@
+import sys
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', type='int', dest='chunk_size',
+            default=1000,
+            help='How many rows to read from the database at a time.'),
+        make_option('-o', '--output', dest='output', default=None,
+            help='File to write to, defaults to stdout.'),
+    )
+    help = 'Streams the base, version and many to many rows of ' \
+           'versioned models as newline delimited JSON.'
+    args = '[appname ...]'
+
+    def handle(self, *app_labels, **options):
+        from ...transfer import dump, get_versioned_models
+
+        models = get_versioned_models(app_labels)
+        output = options.get('output')
+        stream = output and open(output, 'w') or self.stdout
+        try:
+            count = dump(models, stream, chunk_size=options.get('chunk_size'))
+        finally:
+            if output:
+                stream.close()
+
+        if int(options.get('verbosity', 1)) > 1:
+            sys.stderr.write("Dumped %s rows\n" % count)
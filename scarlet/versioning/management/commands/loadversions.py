@@ -0,0 +1,25 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size',
+            default=1000,
+            help='How many rows of a table to copy at a time.'),
+    )
+    help = 'Loads rows written by dumpversions.'
+    args = 'filename'
+
+    def handle(self, filename=None, **options):
+        from ...transfer import load
+
+        if not filename:
+            raise CommandError("Enter the file to load.")
+
+        with open(filename) as lines:
+            count = load(lines, batch_size=options.get('batch_size'))
+
+        if int(options.get('verbosity', 1)) > 0:
+            self.stdout.write("Loaded %s rows\n" % count)
@@ -0,0 +1,55 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--keep', action='append', dest='keep', default=[],
+            help='How many archived versions to keep for a model, '
+                 'as app_label.ModelName=N. Can be used multiple times. '
+                 'Models default to their NUM_KEEP_ARCHIVED attribute.'),
+        make_option('--batch-size', type='int', dest='batch_size',
+            default=500,
+            help='How many versions to delete in each transaction.'),
+    )
+    help = 'Deletes old archived versions of all versioned models.'
+    args = '[appname appname.ModelName ...]'
+
+    def _get_keep(self, values):
+        keep = {}
+        for value in values:
+            try:
+                label, num = value.split('=')
+                keep[label.lower()] = int(num)
+            except ValueError:
+                raise CommandError("Invalid --keep value %r, use "
+                                   "app_label.ModelName=N" % value)
+        return keep
+
+    def handle(self, *labels, **options):
+        from django.db.models import get_models
+        from ...models import BaseVersionedModel, purge_archives
+
+        keep = self._get_keep(options.get('keep'))
+        batch_size = options.get('batch_size')
+        verbosity = int(options.get('verbosity', 1))
+        labels = [l.lower() for l in labels]
+
+        for m in get_models():
+            # Version models of views are purged through their view
+            if not issubclass(m, BaseVersionedModel) or \
+                    hasattr(m._meta, '_view_model'):
+                continue
+
+            app_label = m._meta.app_label
+            label = "%s.%s" % (app_label, m._meta.object_name)
+            if labels and not app_label in labels and \
+                    not label.lower() in labels:
+                continue
+
+            deleted = purge_archives(m, keep=keep.get(label.lower()),
+                                     batch_size=batch_size)
+            if verbosity > 0:
+                self.stdout.write("Purged %s archived versions of %s\n" % (
+                                                            deleted, label))
@@ -1,10 +1,56 @@
-from ...management import update_schema
+import difflib
+from optparse import make_option
+
+from ...management import update_schema, get_missing_indexes
+
+try:
+    from ....scheduling.management import add_missing_columns
+except ValueError:
+    from scheduling.management import add_missing_columns
 
 from django.core.management.base import BaseCommand
 
 
 class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--indexes', action='store_true', dest='indexes',
+            default=False,
+            help='Only report the version table indexes that are missing.'),
+        make_option('--dry-run', action='store_true', dest='dry_run',
+            default=False,
+            help='Print a diff of the views, triggers and indexes that '
+                 'would be changed without changing them.'),
+    )
 
     def handle(self, *app_labels, **options):
         from django.db import models
-        update_schema(None, models.get_models(), True)
+
+        if options.get('indexes'):
+            missing = 0
+            for m in models.get_models():
+                if getattr(m._meta, '_is_view', None):
+                    for name, sql, params in get_missing_indexes(m):
+                        missing += 1
+                        self.stdout.write("%s.%s: %s\n" % (
+                                m._meta.app_label, m._meta.object_name, name))
+            if not missing:
+                self.stdout.write("No missing indexes\n")
+            return
+
+        dry_run = options.get('dry_run')
+        changes = add_missing_columns(dry_run=dry_run)
+        changes.extend(update_schema(None, models.get_models(), True,
+                                     dry_run=dry_run))
+        verbosity = int(options.get('verbosity', 1))
+        if dry_run:
+            for name, old, new in changes:
+                diff = difflib.unified_diff(old.splitlines(),
+                                            new.splitlines(),
+                                            name + ' (current)', name,
+                                            lineterm='')
+                self.stdout.write("\n".join(diff) + "\n")
+            if not changes:
+                self.stdout.write("No changes\n")
+        elif verbosity > 0:
+            for name, old, new in changes:
+                self.stdout.write("Updated %s\n" % name)
@@ -0,0 +1,60 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+
+class _Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--rollback', action='store_true', dest='rollback',
+            default=False,
+            help='Roll back the publish once it is done. Signals '
+                 'are not sent in that case.'),
+    )
+    help = 'Publishes the draft of an item and prints how long each ' \
+           'step took and how many queries it ran.'
+    args = 'app_label.ModelName object_id'
+
+    def handle(self, label=None, object_id=None, **options):
+        from django.db.models import get_model
+        from ...instrumentation import span_finished
+        from ...models import BaseVersionedModel
+        from ...transactions import xact
+
+        if not label or not object_id:
+            raise CommandError("Enter a model and the id of an item.")
+
+        model = None
+        if '.' in label:
+            model = get_model(*label.split('.', 1))
+        if model is None or not issubclass(model, BaseVersionedModel):
+            raise CommandError("%s is not a versioned model." % label)
+
+        try:
+            draft = model.normal.get(object_id=object_id, state=model.DRAFT)
+        except model.DoesNotExist:
+            raise CommandError("%s %s has no draft." % (label, object_id))
+
+        spans = []
+
+        def collect(sender, span, **kwargs):
+            if span.parent is None:
+                spans.append(span)
+
+        span_finished.connect(collect, dispatch_uid='versioning_profile')
+        try:
+            with xact(savepoint=True):
+                draft.publish()
+                if options.get('rollback'):
+                    raise _Rollback()
+        except _Rollback:
+            pass
+        finally:
+            span_finished.disconnect(dispatch_uid='versioning_profile')
+
+        for root in spans:
+            for depth, s in root.walk():
+                self.stdout.write("%s%s\n" % ("  " * depth, s.describe()))
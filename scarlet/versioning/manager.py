@@ -1,37 +1,136 @@
-from threading import local
-
 from django.db import models
 from django.db import connections
 
-_mode = local()
+from .state import get_store
+from .transactions import xact
 
 
 def activate(state):
     """
-    Activate a state in this thread.
+    Activate a state in the current context. That is
+    the current thread or greenlet, see
+    :py:mod:`versioning.state`.
     """
 
-    _mode.current_state = state
-    _mode.schema = state
+    store = get_store()
+    store.set('current_state', state)
+    store.set('schema', state)
 
 
 def deactivate():
     """
-    Deactivate a state in this thread.
+    Deactivate a state in the current context.
     """
 
-    if hasattr(_mode, "current_state"):
-        del _mode.current_state
-    if hasattr(_mode, "schema"):
-        del _mode.schema
+    store = get_store()
+    store.delete('current_state')
+    store.delete('schema')
 
     for k in connections:
         con = connections[k]
         if hasattr(con, 'reset_schema'):
             con.reset_schema()
 
+
+def get_state():
+    """
+    Returns the state active in the current context, or None.
+    """
+
+    return get_store().get('current_state')
+
+
 def get_schema():
-    return getattr(_mode, 'schema', None)
+    """
+    Returns the schema active in the current context, or None.
+    """
+
+    return get_store().get('schema')
+
+
+class VersionViewQuerySet(models.query.QuerySet):
+    """
+    QuerySet for view models that updates the underlying
+    tables directly instead of going through the views.
+    """
+
+    def _split_values(self, kwargs):
+        base_model = self.model._meta._base_model
+        version_model = self.model._meta._version_model
+        base_fields = dict((f.column, f.name)
+                           for f in base_model._meta.local_fields)
+        version_fields = dict((f.column, f.name)
+                              for f in version_model._meta.local_fields)
+
+        base_values = {}
+        version_values = {}
+        for name, value in kwargs.items():
+            column = self.model._meta.get_field(name).column
+            if column in version_fields:
+                version_values[version_fields[column]] = value
+            else:
+                base_values[base_fields[column]] = value
+        return base_values, version_values
+
+    def update(self, **kwargs):
+        """
+        Updates the matching rows with at most one UPDATE
+        statement on the version table and one on the
+        base table, instead of letting the INSTEAD OF
+        trigger of the view rewrite both tables once per row.
+
+        Returns the number of rows updated. That is the
+        number of base rows when only base fields are given.
+        """
+
+        from . import snapshots
+
+        if not getattr(self.model._meta, '_is_view', False):
+            return super(VersionViewQuerySet, self).update(**kwargs)
+
+        assert self.query.can_filter(), \
+                "Cannot update a query once a slice has been taken."
+        self._for_write = True
+
+        base_model = self.model._meta._base_model
+        version_model = self.model._meta._version_model
+        base_values, version_values = self._split_values(kwargs)
+        snapshot = snapshots.get_snapshot_model(self.model)
+        count = 0
+
+        if not snapshot and not (base_values and version_values):
+            # A single statement with the filter as a subquery
+            if version_values:
+                count = version_model.normal.using(self.db).filter(
+                                vid__in=self.values('vid')
+                                ).update(**version_values)
+            elif base_values:
+                count = base_model.objects.using(self.db).filter(
+                                pk__in=self.values('id')
+                                ).update(**base_values)
+            self._result_cache = None
+            return count
+
+        with xact(using=self.db):
+            # The first UPDATE could change what the filter
+            # matches, so read the rows once up front.
+            rows = list(self.values_list('vid', 'id'))
+            vids = [r[0] for r in rows]
+            object_ids = set([r[1] for r in rows])
+            count = len(rows)
+
+            if version_values:
+                version_model.normal.using(self.db).filter(
+                                vid__in=vids).update(**version_values)
+            if base_values:
+                base_model.objects.using(self.db).filter(
+                                pk__in=object_ids).update(**base_values)
+            if snapshot:
+                snapshots.refresh(snapshot, object_ids, using=self.db)
+
+        self._result_cache = None
+        return count
+    update.alters_data = True
 
 
 class VersionManager(models.Manager):
@@ -44,12 +143,107 @@ class VersionManager(models.Manager):
     use_for_related_fields = True
 
     def get_query_set(self):
-        current_state = getattr(_mode, "current_state", None)
-        q = super(VersionManager, self).get_query_set()
+        current_state = get_state()
+        q = VersionViewQuerySet(self.model, using=self._db)
         if current_state:
             q = q.filter(state=current_state)
         return q
 
+    def cached_get(self, pk):
+        """
+        Returns the published version of the item with the
+        given id from the cache, querying the database and
+        caching it on a miss. See :py:mod:`versioning.object_cache`.
+
+        When a state other than published is active
+        the cache is skipped.
+        """
+
+        from . import object_cache
+
+        state = get_state()
+        if state and state != self.model.PUBLISHED:
+            return self.get(object_id=pk)
+        return object_cache.get(self.model, pk)
+
+
+class BaseModelQuerySet(models.query.QuerySet):
+    """
+    QuerySet for base models that can load the
+    current versions of all its items at once.
+    """
+
+    _version_args = None
+
+    def with_versions(self, state=None, date=None):
+        """
+        Loads the current version of every item in
+        this queryset with a single query, instead of
+        one query per item when current_version is used.
+
+        Takes the same arguments as
+        :py:meth:`get_version <versioning.models.BaseModel.get_version>`.
+
+        :param state: The state you want to get.
+        :param date: Get the versions that were published before \
+        or on this date.
+        """
+
+        c = self._clone()
+        c._version_args = (state, date)
+        return c
+
+    def _clone(self, *args, **kwargs):
+        c = super(BaseModelQuerySet, self)._clone(*args, **kwargs)
+        c._version_args = self._version_args
+        return c
+
+    def _set_versions(self, objs):
+        state, date = self._version_args
+        version_model = self.model._meta._version_model
+
+        q = version_model.objects.all()
+        if state:
+            q = version_model.normal.filter(state=state)
+
+        if date:
+            q = q.filter(date_published__lte=date)
+
+        # Version models call the field object_id or object
+        name = [f.name for f in version_model._meta.local_fields
+                if f.attname == 'object_id'][0]
+
+        # Same ordering as get_version, but only the
+        # first version of each item.
+        q = q.using(self.db).filter(**{'%s__in' % name: [o.pk for o in objs]}
+                            ).order_by(name, '-date_published'
+                            ).distinct(name)
+
+        versions = dict((v.object_id, v) for v in q)
+        for obj in objs:
+            obj._set_version(versions.get(obj.pk))
+            obj._version_fetched = True
+
+    def iterator(self):
+        objs = super(BaseModelQuerySet, self).iterator()
+        if self._version_args is not None:
+            objs = list(objs)
+            if objs:
+                self._set_versions(objs)
+        return iter(objs)
+
+
+class BaseModelManager(models.Manager):
+    """
+    Default Manager for base models.
+    """
+
+    def get_query_set(self):
+        return BaseModelQuerySet(self.model, using=self._db)
+
+    def with_versions(self, *args, **kwargs):
+        return self.get_query_set().with_versions(*args, **kwargs)
+
 
 class SwitchSchema(object):
     """
@@ -61,7 +255,7 @@ class SwitchSchema(object):
         self.schema = schema
 
     def __enter__(self):
-        _mode.schema = self.schema
+        get_store().set('schema', self.schema)
 
     def __exit__(self, etype, value, traceback):
-        _mode.schema = self.old_schema
+        get_store().set('schema', self.old_schema)
@@ -1,5 +1,6 @@
 from . import manager
 from . import models
+from . import routers
 
 SESSION_KEY = 'show_drafts'
 
@@ -9,6 +10,10 @@ class StateMiddleware:
     Middleware that sets state to published unless
     an active staff user is logged in and has flagged
     show drafts in their session.
+
+    Reads of staff users always go to the default database
+    when :py:class:`StateRouter <versioning.routers.StateRouter>`
+    is used.
     """
 
     def process_request(self, request):
@@ -16,9 +21,11 @@ class StateMiddleware:
         if request.user.is_staff:
             state = request.session.get(SESSION_KEY,
                         models.BaseVersionedModel.DRAFT)
+            routers.use_primary()
 
         manager.activate(state)
 
     def process_response(self, request, response):
         manager.deactivate()
+        routers.use_primary(False)
         return response
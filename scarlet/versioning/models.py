@@ -1,20 +1,30 @@
 import copy
 
 from django.utils import timezone
-from django.db import models
+from django.db import models, connections, router
 from django.db.models.fields import FieldDoesNotExist, related, Field
 from django import dispatch
 from django.utils.datastructures import SortedDict
 from django.utils import formats
 from django.core.exceptions import ValidationError
 
+from django.contrib.contenttypes.models import ContentType
+
 try:
-    from ..scheduling.models import Schedulable
+    from ..scheduling.models import Schedulable, Schedule, \
+        notify_scheduled, delete_schedules
 except ValueError:
-    from scheduling.models import Schedulable
+    from scheduling.models import Schedulable, Schedule, \
+        notify_scheduled, delete_schedules
 
-from .transactions import xact
+from .transactions import xact, on_commit
 from . import manager
+from . import bulk
+from . import snapshots
+from . import archives
+from . import routers
+from . import object_cache
+from .instrumentation import instrument, span
 
 
 class Cloneable(models.Model):
@@ -29,6 +39,13 @@ class Cloneable(models.Model):
     attribute. Any reverse relations must also
     implement Cloneable.
 
+    Many to many relations in _clone_related can also
+    be listed in _clone_shared. When an item is published
+    the rows of those relations that didn't change since
+    the last published version are shared with that
+    version instead of being copied. Only use this for
+    rows that aren't edited once they are published.
+
     This model adds the following field:
 
     **last_save:** Datetime that gets updated every time the object gets saved.
@@ -123,18 +140,33 @@ class Cloneable(models.Model):
         """
         self.pk = None
 
-    def _clone(self, **attrs):
+    def get_fingerprint_values(self):
+        """
+        Hook so implementing classes can customize what
+        is compared to decide if a row can be shared
+        instead of copied. By default every field except
+        the pk and last_save.
+        """
+        return [(f.attname, getattr(self, f.attname))
+                for f in self._meta.local_fields
+                if not f.primary_key and f.name != 'last_save']
+
+    @instrument('clone')
+    def _clone(self, share_from=None, **attrs):
         """
         Makes a copy of an model instance.
 
         for every key in **attrs value will
         be set on the new instance.
+
+        If share_from is given, unchanged rows of its
+        _clone_shared relations are shared with it.
         """
 
         with xact():
-            # Gather objs we'll need save after
-            old_m2ms = self._gather_m2ms()
-            old_reverses = self._gather_reverses()
+            # Keep what we are cloning from so the
+            # related rows can be found after the save
+            old = copy.copy(self)
 
             for k, v in attrs.items():
                 setattr(self, k, v)
@@ -144,13 +176,8 @@ class Cloneable(models.Model):
             # Prevent last save from changing
             self.save(last_save=self.last_save)
 
-            # save m2ms
-            self._set_m2ms(old_m2ms)
-            # Prevent last save from changing
-            self.save(last_save=self.last_save)
-
-            # save reverses
-            self._clone_reverses(old_reverses)
+            # Copy m2ms and clone reverses in bulk
+            bulk.CloneTree([(old, self)], sources=[share_from]).clone()
 
     def _delete_reverses(self):
         """
@@ -185,6 +212,15 @@ class Cloneable(models.Model):
         # Have to do this the slow way so all possible
         # objects are deleted
         for obj in manager.all():
+            if m2m and reverse in bulk.get_shared_related(self.__class__):
+                # Shared rows are only unlinked while
+                # other versions still use them.
+                links = rel.rel.through._default_manager.filter(**{
+                                rel.m2m_reverse_field_name(): obj.pk})
+                if links.exclude(**{rel.m2m_field_name():
+                        getattr(self, rel.m2m_target_field_name())}).exists():
+                    manager.remove(obj)
+                    continue
             obj.delete()
 
     def delete(self, *args, **kwargs):
@@ -302,6 +338,12 @@ class VersionViewMeta(SharedMeta):
         # List of non field attrs we want to copy
         copy_attrs = attrs.pop('_copy_extra_attrs', [])
 
+        # Keep a table of published rows instead of a view
+        published_snapshot = getattr(meta, '_published_snapshot', False)
+
+        # Partition the version table by state
+        partition_by_state = getattr(meta, '_partition_by_state', False)
+
         # Construct the base class.
 
         # An abstract version of the base model
@@ -416,10 +458,13 @@ class VersionViewMeta(SharedMeta):
 
         version_model._meta._view_model = mod
         version_model._meta._base_model = base_model
+        version_model._meta._partition_by_state = partition_by_state
 
         mod._meta._version_model = version_model
         mod._meta._base_model = base_model
         mod._meta._is_view = True
+        mod._meta._published_snapshot = published_snapshot
+        mod._meta._partition_by_state = partition_by_state
 
         # Register signals
         published_delete_signal.connect(mod.handle_published_delete_signal,
@@ -488,6 +533,9 @@ class BaseModel(models.Model):
 
     `v_last_save`: When the current live item was last saved,
     may be null.
+
+    To load the current versions of a list of items at once
+    use `BaseModel.objects.with_versions()`.
     """
 
     is_published = models.BooleanField(editable=False)
@@ -498,6 +546,11 @@ class BaseModel(models.Model):
     v_last_save = models.DateTimeField(null=True, editable=False)
 
     _version = None
+    # Set when the version was loaded by with_versions,
+    # even if there wasn't one.
+    _version_fetched = False
+
+    objects = manager.BaseModelManager()
 
     class Meta:
         abstract = True
@@ -526,7 +579,7 @@ class BaseModel(models.Model):
         return None
 
     def _get_version(self):
-        if self._version is None:
+        if self._version is None and not self._version_fetched:
             self._version = self.get_version()
         return self._version
 
@@ -548,6 +601,14 @@ class BaseVersionedModel(Cloneable, Schedulable):
     # How many archived versions should we keep?
     NUM_KEEP_ARCHIVED = 5
 
+    # Should archived versions be moved to
+    # the compressed archive table?
+    COMPRESS_ARCHIVES = False
+
+    # Related objects to cache along with
+    # items in objects.cached_get
+    CACHE_SELECT_RELATED = ()
+
     # Supported States
     PUBLISHED = 'published'
     DRAFT = 'draft'
@@ -586,6 +647,7 @@ class BaseVersionedModel(Cloneable, Schedulable):
         self.vid = None
         self.user_published = None
 
+    @instrument('unpublish')
     def unpublish(self):
         """
         Unpublish this item.
@@ -605,6 +667,7 @@ class BaseVersionedModel(Cloneable, Schedulable):
                                             state=self.SCHEDULED):
                 obj.delete()
 
+    @instrument('publish')
     def publish(self, user=None, when=None):
         """
         Publishes a item and any sub items.
@@ -637,6 +700,9 @@ class BaseVersionedModel(Cloneable, Schedulable):
                                         last_scheduled=self.last_scheduled,
                                         state=self.SCHEDULED):
                     when = self.date_published
+                    # Its schedule would only find nothing to publish
+                    delete_schedules(self.__class__,
+                                     [self.__class__(vid=obj.vid)])
                     obj.delete()
 
             when = when or now
@@ -648,7 +714,7 @@ class BaseVersionedModel(Cloneable, Schedulable):
                 self.date_published = when
                 self.save(last_save=now)
 
-            self._clone()
+            self._clone(share_from=self._get_share_source())
 
             self.user_published = user_published
             self.state = self.SCHEDULED
@@ -692,6 +758,7 @@ class BaseVersionedModel(Cloneable, Schedulable):
             return getattr(self._meta._view_model, '_clone_related', [])
         return getattr(self, '_clone_related', [])
 
+    @instrument('make_draft')
     def make_draft(self):
         """
         Make this version the draft
@@ -718,12 +785,59 @@ class BaseVersionedModel(Cloneable, Schedulable):
             self.last_save = self.last_scheduled
             self._clone()
 
+    @classmethod
+    def load_version(cls, vid, object_id=None):
+        """
+        Returns the version with the given vid, restoring it
+        first if it is a compressed archived version.
+
+        :param object_id: Only find versions of this item.
+        """
+        klass = cls
+        if getattr(cls._meta, '_is_view', False):
+            klass = cls._meta._version_model
+
+        filter_args = {'vid': vid}
+        if object_id is not None:
+            filter_args['object_id'] = object_id
+
+        with xact():
+            if archives.is_enabled(klass) and \
+                    not klass.normal.filter(**filter_args).exists():
+                archives.restore(klass, [vid], object_ids=object_id
+                                 is not None and [object_id] or None)
+            return klass.normal.get(**filter_args)
+
+    @classmethod
+    def revert(cls, vid, object_id=None):
+        """
+        Makes the version with the given vid the draft,
+        restoring it first if it was compressed.
+
+        Returns the new draft.
+        """
+        with xact():
+            version = cls.load_version(vid, object_id=object_id)
+            version.make_draft()
+        return version
+
+    def _get_share_source(self):
+        """
+        Returns the latest version that isn't a draft, which
+        a new version published from this draft can share
+        unchanged rows with, or None.
+        """
+        klass = self.get_version_class()
+        return get_share_sources(klass, [self.object_id]
+                                 ).get(self.object_id)
+
     def get_version_class(self):
         klass = self.__class__
         if getattr(self._meta, '_is_view', False):
             klass = self._meta._version_model
         return klass
 
+    @instrument('_publish')
     def _publish(self, published=True, **kwargs):
         with xact():
             filter_args = {
@@ -732,8 +846,14 @@ class BaseVersionedModel(Cloneable, Schedulable):
             }
 
             klass = self.get_version_class()
-            klass.normal.filter(**filter_args).update(
-                                  state=self.ARCHIVED)
+            current = klass.normal.filter(**filter_args)
+            if archives.is_enabled(klass):
+                archived = list(current.values_list('vid', flat=True))
+                klass.normal.filter(vid__in=archived
+                                    ).update(state=self.ARCHIVED)
+                archives.compress(klass, archived)
+            else:
+                current.update(state=self.ARCHIVED)
 
             now = timezone.now()
 
@@ -754,12 +874,14 @@ class BaseVersionedModel(Cloneable, Schedulable):
             self.is_published = published
             self.v_last_save = self.last_scheduled
 
+            snapshots.refresh(self.__class__, [self.object_id])
+
         # Send published signal
         klass = self.__class__
         if hasattr(self._meta, '_view_model'):
             klass = self.__class__
 
-        published_signal.send(sender=klass, instance=self)
+        send_on_commit(published_signal, klass, self)
 
     def purge_archives(self):
         """
@@ -769,14 +891,7 @@ class BaseVersionedModel(Cloneable, Schedulable):
         how many items are kept.
         """
 
-        klass = self.get_version_class()
-        qs = klass.normal.filter(object_id=self.object_id,
-                        state=self.ARCHIVED
-                        ).order_by('-last_save')[self.NUM_KEEP_ARCHIVED:]
-
-        for obj in qs:
-            obj._delete_reverses()
-            klass.normal.filter(vid=obj.vid).delete()
+        purge_archives(self.__class__, object_ids=[self.object_id])
 
     def status_line(self):
         """
@@ -821,6 +936,7 @@ class BaseVersionedModel(Cloneable, Schedulable):
                              formats.date_format(date, "SHORT_DATE_FORMAT"))
         return status
 
+    @instrument('schedule')
     def schedule(self, when=None, action=None, **kwargs):
         """
         Schedule this item to be published.
@@ -831,6 +947,30 @@ class BaseVersionedModel(Cloneable, Schedulable):
         super(BaseVersionedModel, self).schedule(when=when, action=action,
                                                  **kwargs)
 
+    def get_schedule_key(self):
+        """
+        A later scheduled version of the same item
+        replaces any earlier ones.
+        """
+        object_id = self.object_id
+        if object_id is None and getattr(self._meta, '_is_view', False):
+            object_id = self.pk
+        return str(object_id)
+
+    @classmethod
+    def drop_scheduled_updates(cls, objects, action, **kwargs):
+        """
+        Deletes the scheduled versions whose schedules were
+        replaced by a later one, they would never be live.
+        """
+        klass = cls
+        if getattr(cls._meta, '_is_view', False):
+            klass = cls._meta._version_model
+
+        vids = [obj.vid for obj in objects if obj.state == cls.SCHEDULED]
+        if vids:
+            bulk.DeleteTree(klass, vids).delete()
+
 
 class VersionView(BaseVersionedModel):
     """
@@ -846,6 +986,17 @@ class VersionView(BaseVersionedModel):
     filter parameters to filter out the states/versions that you
     are not interested in wherever this model is used in a query.
 
+    Read heavy models can set `_published_snapshot = True` in
+    their Meta class. The published schema then has a table with
+    a copy of the published rows instead of a view, so reading
+    published items doesn't need a join. Publishing refreshes the
+    copied rows, see `versioning.snapshots`.
+
+    Models with a lot of history can set `_partition_by_state = True`
+    in their Meta class to have their version table partitioned
+    by state. The draft and published views then read their
+    partition directly, so they never touch archived rows.
+
     Inherits from `BaseVersionedModel`
 
     Contains the following fields:
@@ -879,10 +1030,10 @@ class VersionView(BaseVersionedModel):
             'vid': self.vid
         }
 
-    def _clone(self):
+    def _clone(self, **kwargs):
         # We should only clone from a draft view in that mode
         assert self.state == self.DRAFT
-        return super(VersionView, self)._clone()
+        return super(VersionView, self)._clone(**kwargs)
 
     def delete(self, **kwargs):
         with xact():
@@ -950,6 +1101,10 @@ class VersionView(BaseVersionedModel):
             self._state = version._state
             self.state = version.state
             self.last_save = version.last_save
+
+            # Published items show the base data too
+            if self.should_save_base and self.is_published:
+                snapshots.refresh(self.__class__, [self.pk])
         models.signals.post_save.send(sender=self.__class__, instance=self,
             raw=kwargs.get('raw'), using=kwargs.get('using'))
 
@@ -968,12 +1123,9 @@ class VersionView(BaseVersionedModel):
         """
 
         super(BaseVersionedModel, self).validate_unique(*args, **kwargs)
-        if hasattr(self, 'versioned_unique'):
-            unique_checks = []
-            for field in self.versioned_unique:
-                unique_checks.append((self.__class__, (field,)))
-            errors = self._perform_unique_checks(unique_checks)
-
+        if hasattr(self, 'versioned_unique') and \
+                not getattr(self, '_batch_unique', False):
+            errors = validate_versioned_unique([self])[0]
             if errors:
                 raise ValidationError(errors)
 
@@ -1007,10 +1159,12 @@ class VersionView(BaseVersionedModel):
             klass = cls._meta._version_model
             for obj in klass.normal.filter(object_id=instance.object_id):
                 obj._delete_reverses()
+            archives.discard(klass, [instance.object_id])
 
     @classmethod
     def handle_post_delete_signal(cls, sender, instance, **kwargs):
-        published_delete_signal.send(sender, instance=instance)
+        snapshots.refresh(cls, [instance.object_id])
+        send_on_commit(published_delete_signal, sender, instance)
 
 
 class VersionModel(BaseVersionedModel):
@@ -1072,23 +1226,9 @@ class VersionModel(BaseVersionedModel):
         """
 
         super(BaseVersionedModel, self).validate_unique(*args, **kwargs)
-        if hasattr(self, 'versioned_unique'):
-            errors = {}
-
-            for field in self.versioned_unique:
-                lookup_kwargs = {field: getattr(self, field)}
-                qs = self.__class__._default_manager.filter(**lookup_kwargs)
-
-                # Exclude the current object from the query if we are editing an
-                # instance (as opposed to creating a new one)
-                if self.object_id:
-                    qs = qs.exclude(object_id=self.object_id)
-
-                if qs.exists():
-                    msg = self.unique_error_message(self.__class__,
-                                                            (field,))
-                    errors[field] = msg
-
+        if hasattr(self, 'versioned_unique') and \
+                not getattr(self, '_batch_unique', False):
+            errors = validate_versioned_unique([self])[0]
             if errors:
                 raise ValidationError(errors)
 
@@ -1110,6 +1250,351 @@ class VersionModel(BaseVersionedModel):
 
             super(VersionModel, self).save(*args, **kwargs)
 
+class ArchivedVersion(models.Model):
+    """
+    Model to store compressed archived versions.
+
+    See versioning.archives for how the data is stored.
+    """
+
+    content_type = models.ForeignKey(ContentType)
+    object_id = models.IntegerField(db_index=True)
+    vid = models.IntegerField()
+
+    last_save = models.DateTimeField()
+    last_scheduled = models.DateTimeField(null=True)
+    date_published = models.DateTimeField(null=True)
+    user_published = models.CharField(max_length=255, null=True)
+
+    # The newer version data is a delta against,
+    # null when data holds the full version.
+    base_vid = models.IntegerField(null=True)
+    data = models.TextField()
+
+    class Meta:
+        unique_together = (('content_type', 'vid'),)
+
+
 # Setup signal for published
 published_signal = dispatch.Signal(providing_args=['instance'])
 published_delete_signal = dispatch.Signal(providing_args=['instance'])
+
+# Keep reads on the primary while replicas catch up
+published_signal.connect(routers.handle_published_signal,
+                         dispatch_uid='versioning_router_publish')
+published_delete_signal.connect(routers.handle_published_signal,
+                                dispatch_uid='versioning_router_delete')
+
+# Drop cached published items
+published_signal.connect(object_cache.handle_published_signal,
+                         dispatch_uid='versioning_cache_publish')
+published_delete_signal.connect(object_cache.handle_published_signal,
+                                dispatch_uid='versioning_cache_delete')
+
+
+def send_on_commit(signal, sender, instance):
+    """
+    Sends a signal for a versioned item once the current
+    transaction is committed, or right away when there
+    isn't one. The signal is dropped if the transaction
+    is rolled back.
+
+    Each signal is only sent once per item and transaction
+    with the last instance it was queued with, so publishing
+    many items invalidates their caches in one batch after
+    the data is committed.
+    """
+
+    def send():
+        with span('signal', model=sender._meta.object_name):
+            signal.send(sender=sender, instance=instance)
+
+    on_commit(send, key=(signal, sender, instance.object_id))
+
+
+def validate_versioned_unique(instances):
+    """
+    Checks the `versioned_unique` fields of many instances
+    with a single query per model, such as all the forms of
+    a formset. A value is taken if an item other than the
+    instance itself has it in the current state.
+
+    Returns a list with a dictionary of errors for each
+    instance, mapping field names to a list of messages.
+    Instances without errors get an empty dictionary.
+    """
+
+    results = [{} for obj in instances]
+    by_model = SortedDict()
+    for i, obj in enumerate(instances):
+        if getattr(obj, 'versioned_unique', None):
+            by_model.setdefault(obj.__class__, []).append(i)
+
+    for klass, indexes in by_model.items():
+        fields = [klass._meta.get_field(name)
+                  for name in klass.versioned_unique]
+
+        q = None
+        for field in fields:
+            values = set([getattr(instances[i], field.attname)
+                          for i in indexes])
+            values.discard(None)
+            if values:
+                new_q = models.Q(**{'%s__in' % field.name: list(values)})
+                if q:
+                    q = q | new_q
+                else:
+                    q = new_q
+        if q is None:
+            continue
+
+        # value -> object ids that have it, for each field
+        taken = [{} for field in fields]
+        rows = klass._default_manager.filter(q).values_list(
+                    'object_id', *[f.name for f in fields])
+        for row in rows:
+            for n, value in enumerate(row[1:]):
+                taken[n].setdefault(value, set()).add(row[0])
+
+        for i in indexes:
+            obj = instances[i]
+            for n, field in enumerate(fields):
+                value = getattr(obj, field.attname)
+                others = taken[n].get(value, set()) - set([obj.object_id])
+                if value is not None and others:
+                    results[i][field.name] = [obj.unique_error_message(
+                                                klass, (field.name,))]
+    return results
+
+
+def get_share_sources(klass, object_ids, exclude=None):
+    """
+    Returns a dictionary of object ids and the latest version
+    of each item that isn't a draft. Nothing is looked up for
+    models without _clone_shared relations.
+
+    :param exclude: vids of versions to skip.
+    """
+
+    if not bulk.get_shared_related(klass) or not object_ids:
+        return {}
+
+    versions = klass.normal.filter(object__in=object_ids
+                                   ).exclude(state=klass.DRAFT)
+    if exclude:
+        versions = versions.exclude(vid__in=exclude)
+    versions = versions.order_by('object', '-last_save', '-vid'
+                                 ).distinct('object')
+    return dict((v.object_id, v) for v in versions)
+
+
+def publish_many(queryset, user=None, when=None):
+    """
+    Publishes all the draft versions in a queryset using a
+    fixed number of statements per table instead of calling
+    publish on each item.
+
+    Works for both VersionView and VersionModel querysets.
+    Items in the queryset that aren't drafts are ignored.
+    Scheduling follows the same rules as
+    :py:meth:`publish <versioning.models.BaseVersionedModel.publish>`
+    and published_signal is sent once for each item that went live.
+
+    :param queryset: The items to publish.
+    :param user: The user publishing these items.
+    :param when: Date/time when these items should go live. \
+    None means now.
+
+    Returns a list of the new versions.
+    """
+
+    model = queryset.model
+    klass = model
+    if getattr(model._meta, '_is_view', False):
+        klass = model._meta._version_model
+
+    user_published = 'code'
+    if user:
+        user_published = user.username
+
+    now = timezone.now()
+
+    with xact():
+        vids = list(queryset.values_list('vid', flat=True))
+        drafts = list(klass.normal.filter(vid__in=vids, state=klass.DRAFT
+                            ).values_list('vid', 'object_id', 'last_scheduled',
+                                          'date_published',
+                                          'object__is_published'))
+        if not drafts:
+            return []
+
+        # Same as publish, items that haven't gone live yet
+        # and have no new date replace their scheduled version
+        # and keep its date.
+        replaced = {}
+        if not when:
+            pending = dict(((object_id, last_scheduled), date_published)
+                    for vid, object_id, last_scheduled, date_published, \
+                        published in drafts if last_scheduled and not published)
+            if pending:
+                replaced_vids = []
+                for vid, object_id, last_scheduled in klass.normal.filter(
+                            state=klass.SCHEDULED,
+                            object_id__in=[k[0] for k in pending.keys()]
+                            ).values_list('vid', 'object_id',
+                                          'last_scheduled'):
+                    key = (object_id, last_scheduled)
+                    if key in pending:
+                        replaced[object_id] = pending[key]
+                        replaced_vids.append(vid)
+                if replaced_vids:
+                    delete_schedules(model, [model(vid=vid)
+                                             for vid in replaced_vids])
+                    bulk.DeleteTree(klass, replaced_vids).delete()
+
+        rows = []
+        by_date = {}
+        for vid, object_id, last_scheduled, date_published, published in drafts:
+            item_when = replaced.get(object_id, when) or now
+            rows.append((vid, object_id, item_when))
+            by_date.setdefault(item_when, []).append(vid)
+
+        # Drafts get preserved so save the
+        # time we last cloned them
+        for item_when, group in by_date.items():
+            klass.normal.filter(vid__in=group).update(last_scheduled=now,
+                                                      date_published=item_when,
+                                                      last_save=now)
+
+        live_objects = [object_id for vid, object_id, item_when in rows
+                        if item_when <= now]
+        archived = []
+        if live_objects:
+            current = klass.normal.filter(state=klass.PUBLISHED,
+                                          object_id__in=live_objects)
+            if archives.is_enabled(klass):
+                archived = list(current.values_list('vid', flat=True))
+                klass.normal.filter(vid__in=archived
+                                    ).update(state=klass.ARCHIVED)
+            else:
+                current.update(state=klass.ARCHIVED)
+
+        # Copy the drafts straight into their new state
+        id_map = {}
+        copies = []
+        scheduled = []
+        new_vids = bulk.allocate_ids(klass, len(rows))
+        for (vid, object_id, item_when), new_vid in zip(rows, new_vids):
+            id_map[vid] = new_vid
+            if item_when <= now:
+                copies.append((vid, new_vid, klass.PUBLISHED, now))
+            else:
+                copies.append((vid, new_vid, klass.SCHEDULED, item_when))
+                scheduled.append((new_vid, object_id, item_when))
+
+        bulk.copy_rows(klass, copies, columns=('state', 'date_published'),
+                       overrides={'last_scheduled': now,
+                                  'last_save': now,
+                                  'user_published': user_published})
+
+        # Copy m2ms and clone reverses in bulk
+        old_versions = klass.normal.in_bulk(id_map.keys())
+        sources = get_share_sources(klass,
+                        [obj.object_id for obj in old_versions.values()],
+                        exclude=id_map.values())
+        pairs = []
+        for vid, new_vid in id_map.items():
+            new = klass(vid=new_vid, object_id=old_versions[vid].object_id)
+            pairs.append((old_versions[vid], new))
+        bulk.CloneTree(pairs, sources=[sources.get(old.object_id)
+                                       for old, new in pairs]).clone()
+        archives.compress(klass, archived)
+
+        # Update the base models as published and cache the
+        # scheduled date for comparisons.
+        if live_objects:
+            klass._meta._base_model.objects.filter(pk__in=live_objects
+                                    ).update(is_published=True,
+                                             v_last_save=now)
+            snapshots.refresh(model, live_objects)
+
+        if scheduled:
+            ctype = ContentType.objects.get_for_model(model)
+            schedules = []
+            for new_vid, object_id, item_when in scheduled:
+                item = model(vid=new_vid, object_id=object_id)
+                schedules.append(Schedule(content_type=ctype, when=item_when,
+                                 action='_publish', json_args={},
+                                 object_args=item.get_scheduled_filter_args(),
+                                 key=item.get_schedule_key()))
+            Schedule.objects.bulk_create(schedules)
+            notify_scheduled([item_when for n, o, item_when in scheduled])
+
+    with manager.SwitchSchema('public'):
+        versions = list(model.normal.filter(vid__in=id_map.values()))
+
+    for version in versions:
+        if version.state == version.PUBLISHED:
+            send_on_commit(published_signal, model, version)
+
+    return versions
+
+
+@instrument('purge_archives')
+def purge_archives(model, keep=None, object_ids=None, batch_size=None):
+    """
+    Deletes archived versions that are past the number that
+    should be kept, along with everything that was cloned
+    with them, using a fixed number of statements per batch.
+
+    :param model: A VersionView or VersionModel class.
+    :param keep: How many archived versions to keep for \
+    each item, compressed or not. Defaults to the \
+    NUM_KEEP_ARCHIVED attribute of the model.
+    :param object_ids: Only purge the versions of these items. \
+    None means all items.
+    :param batch_size: How many versions to delete in each \
+    transaction. None deletes everything in one go.
+
+    Returns the number of versions deleted.
+    """
+
+    klass = model
+    if getattr(model._meta, '_is_view', False):
+        klass = model._meta._version_model
+
+    if keep is None:
+        keep = model.NUM_KEEP_ARCHIVED
+
+    using = router.db_for_write(klass)
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    where = "state = %s"
+    params = [klass.ARCHIVED]
+    if object_ids is not None:
+        where += " AND object_id = ANY(%s)"
+        params.append(list(object_ids))
+
+    sql = "SELECT vid FROM (SELECT vid, row_number() OVER " \
+          "(PARTITION BY object_id ORDER BY last_save DESC, vid DESC) " \
+          "AS num FROM %s WHERE %s) AS v WHERE num > %%s" % (
+                                    qn(klass._meta.db_table), where)
+    params.append(keep)
+    if batch_size:
+        sql += " LIMIT %s"
+        params.append(batch_size)
+
+    deleted = 0
+    while True:
+        with xact(using=using):
+            cursor = connection.cursor()
+            cursor.execute(sql, params)
+            vids = [row[0] for row in cursor.fetchall()]
+            if vids:
+                bulk.DeleteTree(klass, vids, using=using).delete()
+                deleted += len(vids)
+
+        if not vids or not batch_size:
+            break
+
+    return deleted + archives.purge(klass, keep, object_ids=object_ids)
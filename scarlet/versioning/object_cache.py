@@ -0,0 +1,159 @@
+"""
+Read-through cache for published items.
+
+`Model.objects.cached_get(pk)` looks up the published version
+of an item in the django cache and only queries the database
+when it isn't there. Related objects named in the model's
+CACHE_SELECT_RELATED attribute are loaded with select_related
+and cached along with it.
+
+Entries are removed when an item is published, unpublished or
+deleted, for all the items of a transaction at once after it
+commits. When the model is registered with a group of the
+cache app the key also contains the version of that group, so
+invalidating the group invalidates the cached items too.
+The key doesn't contain the published version, finding it
+would take the query the cache is there to avoid, so a
+republished item is only fresh once its entry is removed.
+
+The cache that is used can be set with the **VERSIONING_CACHE**
+setting, and how long items are kept with
+**VERSIONING_CACHE_TIMEOUT**.
+
+Hits and misses are counted per thread or greenlet in the
+store of :py:mod:`versioning.state`, see get_stats.
+"""
+
+from django.conf import settings
+from django.core.cache import get_cache, DEFAULT_CACHE_ALIAS
+from django.utils.datastructures import SortedDict
+
+from .manager import SwitchSchema
+from .state import get_store
+from .transactions import on_commit
+
+
+def get_cache_backend():
+    return get_cache(getattr(settings, 'VERSIONING_CACHE',
+                             DEFAULT_CACHE_ALIAS))
+
+
+def get_stats():
+    """
+    Returns a dictionary with the hits and misses
+    counted in the current thread or greenlet.
+    """
+
+    store = get_store()
+    stats = store.get('object_cache_stats')
+    if stats is None:
+        stats = {'hits': 0, 'misses': 0}
+        store.set('object_cache_stats', stats)
+    return stats
+
+
+def reset_stats():
+    """
+    Sets the hit and miss counters back to zero.
+    """
+
+    get_store().delete('object_cache_stats')
+
+
+def _get_group_versions(model):
+    try:
+        try:
+            from ..cache import cache_manager
+        except ValueError:
+            from cache import cache_manager
+    except ImportError:
+        return []
+
+    return [group.get_version() for key, group in
+            sorted(cache_manager._registry.items())
+            if model in group.models]
+
+
+def _get_prefix(model):
+    versions = _get_group_versions(model) or ['0']
+    return 'versioning.%s.%s.%s' % (model._meta.app_label,
+                                    model._meta.object_name.lower(),
+                                    ':'.join(versions))
+
+
+def get_key(model, pk):
+    """
+    Returns the cache key for an item.
+    """
+
+    return '%s.%s' % (_get_prefix(model), pk)
+
+
+def get(model, pk):
+    """
+    Returns the published version of the item with
+    the given id, from the cache when possible.
+
+    Raises DoesNotExist if the item isn't published.
+    """
+
+    cache = get_cache_backend()
+    key = get_key(model, pk)
+    obj = cache.get(key)
+    stats = get_stats()
+    if obj is not None:
+        stats['hits'] += 1
+        return obj
+
+    stats['misses'] += 1
+    qs = model.normal.filter(state=model.PUBLISHED)
+    related = getattr(model, 'CACHE_SELECT_RELATED', None)
+    if related:
+        qs = qs.select_related(*related)
+
+    with SwitchSchema(model.PUBLISHED):
+        obj = qs.get(object_id=pk)
+
+    cache.set(key, obj, getattr(settings, 'VERSIONING_CACHE_TIMEOUT', None))
+    return obj
+
+
+def invalidate(model, pk):
+    """
+    Removes an item from the cache.
+    """
+
+    get_cache_backend().delete(get_key(model, pk))
+
+
+def invalidate_many(model, pks):
+    """
+    Removes several items of a model from the cache at once.
+    """
+
+    prefix = _get_prefix(model)
+    get_cache_backend().delete_many(['%s.%s' % (prefix, pk) for pk in pks])
+
+
+def _invalidate_queued():
+    store = get_store()
+    queued = store.get('object_cache_queued') or SortedDict()
+    store.delete('object_cache_queued')
+    for model, pks in queued.items():
+        invalidate_many(model, pks)
+
+
+def handle_published_signal(sender, instance, **kwargs):
+    model = sender
+    if not getattr(sender._meta, '_is_view', False):
+        model = getattr(sender._meta, '_view_model', sender)
+
+    # The signals of a transaction are sent one after the other
+    # once it commits, the items are removed after the last one.
+    store = get_store()
+    queued = store.get('object_cache_queued')
+    if queued is None:
+        queued = SortedDict()
+        store.set('object_cache_queued', queued)
+    queued.setdefault(model, set()).add(instance.object_id)
+    on_commit(_invalidate_queued, key='versioning_object_cache')
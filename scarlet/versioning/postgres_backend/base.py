@@ -1,5 +1,61 @@
+from django.conf import settings
 from django.db.backends.postgresql_psycopg2.base import DatabaseWrapper, \
                                                         DatabaseCreation
+from django.db.backends.postgresql_psycopg2.operations import \
+                                                        DatabaseOperations
+from django.db.backends.postgresql_psycopg2.introspection import \
+                                                    DatabaseIntrospection
+
+
+class ViewDatabaseOperations(DatabaseOperations):
+    compiler_module = __name__.rsplit('.', 1)[0] + '.compiler'
+
+
+class ViewDatabaseIntrospection(DatabaseIntrospection):
+
+    def get_table_list(self, cursor):
+        # Include version tables that are partitioned by state
+        cursor.execute("""
+            SELECT c.relname
+            FROM pg_catalog.pg_class c
+            LEFT JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace
+            WHERE c.relkind IN ('r', 'v', 'p')
+                AND n.nspname NOT IN ('pg_catalog', 'pg_toast')
+                AND pg_catalog.pg_table_is_visible(c.oid)""")
+        return [row[0] for row in cursor.fetchall()]
+
+
+class InstrumentedCursor(object):
+    """
+    Counts queries and rows in the open
+    versioning instrumentation spans.
+    """
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def execute(self, sql, params=None):
+        from ..instrumentation import record_query
+
+        try:
+            return self.cursor.execute(sql, params)
+        finally:
+            record_query(max(self.cursor.rowcount, 0))
+
+    def executemany(self, sql, param_list):
+        from ..instrumentation import record_query
+
+        try:
+            return self.cursor.executemany(sql, param_list)
+        finally:
+            record_query(max(self.cursor.rowcount, 0))
+
 
 class DatabaseWrapper(DatabaseWrapper):
     UNTOUCHED = 1
@@ -7,24 +63,81 @@ class DatabaseWrapper(DatabaseWrapper):
     def __init__(self, *args, **kwargs):
         super(DatabaseWrapper, self).__init__(*args, **kwargs)
         self.creation = ViewDatabaseCreation(self)
+        self.ops = ViewDatabaseOperations(self)
+        self.introspection = ViewDatabaseIntrospection(self)
         self.schema = self.UNTOUCHED
 
+        # When set view tables are qualified with the
+        # current schema in the sql instead of changing
+        # the search_path of the connection.
+        self.qualify_schemas = getattr(settings,
+                                       'VERSIONING_QUALIFY_SCHEMAS', False)
+
     def _cursor(self):
         from ..manager import get_schema
+        from ..instrumentation import get_current
+
+        # The search path belongs to the database session, so
+        # a new connection starts without a known schema. The
+        # schema that is wanted comes from the current context.
+        if self.connection is None:
+            self.reset_schema()
 
         cursor = super(DatabaseWrapper, self)._cursor()
-        schema = get_schema()
-        if schema != self.schema:
-            self.schema = schema
-            if schema:
-                cursor.execute('SET search_path = %s, public', [schema])
-            else:
-                cursor.execute('SET search_path = public')
+        if not self.qualify_schemas:
+            schema = get_schema()
+            if schema != self.schema:
+                self.schema = schema
+                if schema:
+                    cursor.execute('SET search_path = %s, public', [schema])
+                else:
+                    cursor.execute('SET search_path = public')
+
+        if get_current() is not None:
+            cursor = InstrumentedCursor(cursor)
         return cursor
 
     def reset_schema(self):
         self.schema = self.UNTOUCHED
 
+    # Calls queued with versioning.transactions.on_commit
+    # inside a managed transaction wait for it to commit.
+
+    def commit(self):
+        from ..transactions import committed
+
+        super(DatabaseWrapper, self).commit()
+        committed(self.alias)
+
+    def rollback(self):
+        from ..transactions import rolled_back
+
+        super(DatabaseWrapper, self).rollback()
+        rolled_back(self.alias)
+
+    def savepoint(self):
+        from ..transactions import savepoint_created
+
+        sid = super(DatabaseWrapper, self).savepoint()
+        savepoint_created(self.alias, sid)
+        return sid
+
+    def savepoint_rollback(self, sid):
+        from ..transactions import rolled_back
+
+        super(DatabaseWrapper, self).savepoint_rollback(sid)
+        rolled_back(self.alias, sid)
+
+    def leave_transaction_management(self):
+        from ..transactions import rolled_back
+
+        try:
+            super(DatabaseWrapper, self).leave_transaction_management()
+        finally:
+            if not self.transaction_state:
+                # Nothing is left that could commit them
+                rolled_back(self.alias)
+
 class ViewDatabaseCreation(DatabaseCreation):
 
     def sql_for_inline_foreign_key_references(self, field, known_models,
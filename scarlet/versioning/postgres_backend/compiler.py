@@ -0,0 +1,77 @@
+from django.db.models.sql import compiler
+from django.db.models import loading
+
+_view_schemas = {}
+
+
+def get_view_schemas():
+    """
+    Returns a dictionary of the table names of all the
+    view models and the schemas each of them has a view in.
+    """
+
+    if _view_schemas:
+        return _view_schemas
+
+    schemas = {}
+    for m in loading.get_models():
+        if getattr(m._meta, '_is_view', False):
+            version_model = m._meta._version_model
+            schemas[m._meta.db_table] = set(version_model.UNIQUE_STATES)
+
+    # Don't cache until all the models are known
+    if loading.app_cache_ready():
+        _view_schemas.update(schemas)
+    return schemas
+
+
+class SchemaCompilerMixin(object):
+    """
+    Qualifies the names of view tables with the schema
+    that is active when the query is compiled, so no
+    search_path needs to be set on the connection.
+
+    Only used when the connection has qualify_schemas set.
+    """
+
+    def quote_name_unless_alias(self, name):
+        if name in self.quote_cache:
+            return self.quote_cache[name]
+
+        r = super(SchemaCompilerMixin, self).quote_name_unless_alias(name)
+        if r != name and getattr(self.connection, 'qualify_schemas', False):
+            from ..manager import get_schema
+
+            schemas = get_view_schemas().get(name)
+            if schemas is not None:
+                schema = get_schema()
+                if not schema in schemas:
+                    schema = 'public'
+                r = "%s.%s" % (self.connection.ops.quote_name(schema), r)
+                self.quote_cache[name] = r
+        return r
+
+
+class SQLCompiler(SchemaCompilerMixin, compiler.SQLCompiler):
+    pass
+
+
+class SQLInsertCompiler(SchemaCompilerMixin, compiler.SQLInsertCompiler):
+    pass
+
+
+class SQLDeleteCompiler(SchemaCompilerMixin, compiler.SQLDeleteCompiler):
+    pass
+
+
+class SQLUpdateCompiler(SchemaCompilerMixin, compiler.SQLUpdateCompiler):
+    pass
+
+
+class SQLAggregateCompiler(SchemaCompilerMixin,
+                           compiler.SQLAggregateCompiler):
+    pass
+
+
+class SQLDateCompiler(SchemaCompilerMixin, compiler.SQLDateCompiler):
+    pass
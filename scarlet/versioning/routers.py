@@ -0,0 +1,104 @@
+"""
+Database router that sends published reads to replicas.
+
+Most traffic only reads published items, which can be served
+by read replicas. Add the router to your settings and list the
+replica aliases in **VERSIONING_READ_REPLICAS**::
+
+    DATABASE_ROUTERS = ['scarlet.versioning.routers.StateRouter']
+    VERSIONING_READ_REPLICAS = ['replica1', 'replica2']
+
+Reads go to a random replica when the published schema is
+active. Everything else goes to the default database: writes,
+reads in any other state, reads inside an xact() block, reads
+of staff requests and all reads for a few seconds after an item
+was published or unpublished in this process, so they don't see
+a replica that hasn't caught up yet. How long that is can be
+set with **VERSIONING_REPLICA_STICKY_SECONDS**.
+
+Replicas should use the versioning backend too, each connection
+switches its own search path.
+"""
+
+import random
+import time
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+from .state import get_store
+
+_sticky_until = 0
+
+
+def stick_to_primary(seconds=None):
+    """
+    Sends all reads in this process to the default
+    database for the given number of seconds, or for
+    VERSIONING_REPLICA_STICKY_SECONDS.
+    """
+
+    global _sticky_until
+    if seconds is None:
+        seconds = getattr(settings, 'VERSIONING_REPLICA_STICKY_SECONDS', 5)
+    _sticky_until = max(_sticky_until, time.time() + seconds)
+
+
+def use_primary(value=True):
+    """
+    Sends all reads in the current context to
+    the default database until it is turned off.
+    """
+
+    get_store().set('use_primary', value)
+
+
+def handle_published_signal(sender, instance, **kwargs):
+    stick_to_primary()
+
+
+class StateRouter(object):
+    """
+    Routes reads of the published state to the
+    databases in VERSIONING_READ_REPLICAS.
+    """
+
+    def __init__(self):
+        self.replicas = list(getattr(settings, 'VERSIONING_READ_REPLICAS',
+                                     []))
+
+    def use_replica(self):
+        """
+        Returns True if reads can go to a replica.
+        """
+
+        from .manager import get_schema
+        from .models import BaseVersionedModel
+        from .transactions import in_xact
+
+        if not self.replicas:
+            return False
+        if get_schema() != BaseVersionedModel.PUBLISHED:
+            return False
+        if get_store().get('use_primary') or in_xact(DEFAULT_DB_ALIAS):
+            return False
+        return time.time() >= _sticky_until
+
+    def db_for_read(self, model, **hints):
+        if self.use_replica():
+            return random.choice(self.replicas)
+        return DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        dbs = [DEFAULT_DB_ALIAS] + self.replicas
+        if obj1._state.db in dbs and obj2._state.db in dbs:
+            return True
+        return None
+
+    def allow_syncdb(self, db, model):
+        if db in self.replicas:
+            return False
+        return None
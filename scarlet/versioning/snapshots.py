@@ -0,0 +1,80 @@
+"""
+Published snapshot tables.
+
+A VersionView with _published_snapshot = True in its Meta
+gets a real table in the published schema instead of a view
+that joins the version and base tables. Reads of published
+items then don't need a join, but the rows need to be copied
+again whenever the published data of an item changes.
+
+The versioning code refreshes the rows when items are
+published, unpublished, deleted or their base data changes.
+If you change the underlying tables some other way, such
+as with raw sql or loaddata, call refresh yourself.
+"""
+
+from django.db import connections, router
+
+from .transactions import xact
+
+
+def get_snapshot_model(model):
+    """
+    Returns the view model for the given version or view
+    model if it keeps a published snapshot, otherwise None.
+    """
+
+    view_model = model
+    if not getattr(model._meta, '_is_view', False):
+        view_model = getattr(model._meta, '_view_model', None)
+
+    if view_model and getattr(view_model._meta, '_published_snapshot',
+                              False):
+        return view_model
+    return None
+
+
+def refresh(model, object_ids=None, using=None):
+    """
+    Copies the published rows of the given items
+    from the public view to the snapshot table.
+
+    :param model: A view or version model. Nothing is done \
+    if it doesn't keep a snapshot.
+    :param object_ids: The ids of the items to refresh. \
+    None refreshes every item.
+    """
+
+    model = get_snapshot_model(model)
+    if model is None:
+        return
+
+    if object_ids is not None:
+        object_ids = list(object_ids)
+        if not object_ids:
+            return
+
+    connection = connections[using or router.db_for_write(model)]
+    qn = connection.ops.quote_name
+    version_model = model._meta._version_model
+    args = {'snapshot': "%s.%s" % (qn(version_model.PUBLISHED),
+                                   qn(model._meta.db_table)),
+            'view': "%s.%s" % (qn('public'), qn(model._meta.db_table)),
+            'id': qn(model._meta.pk.column),
+            'state': qn('state')}
+
+    delete_sql = "DELETE FROM %(snapshot)s" % args
+    insert_sql = "INSERT INTO %(snapshot)s SELECT * FROM %(view)s " \
+                 "WHERE %(state)s = %%s" % args
+    delete_params = []
+    insert_params = [version_model.PUBLISHED]
+    if object_ids is not None:
+        delete_sql += " WHERE %(id)s = ANY(%%s)" % args
+        insert_sql += " AND %(id)s = ANY(%%s)" % args
+        delete_params.append(object_ids)
+        insert_params.append(object_ids)
+
+    with xact(using=connection.alias):
+        cursor = connection.cursor()
+        cursor.execute(delete_sql, delete_params)
+        cursor.execute(insert_sql, insert_params)
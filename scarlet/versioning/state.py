@@ -0,0 +1,112 @@
+"""
+Storage for the active state and schema.
+
+The state that :py:func:`versioning.manager.activate` sets
+has to belong to the request that set it. With threaded
+workers a thread local is enough, but greenlets from gevent
+or eventlet share a thread, so a thread local would let one
+request see the state of another.
+
+The store that is used can be set with the
+**VERSIONING_STATE_STORE** setting, a dotted path to a class
+with get, set and delete methods. The stores here are
+GreenletStore, used by default when greenlet is installed,
+and ThreadStore, a thread local used otherwise.
+"""
+
+import weakref
+from threading import local
+
+from django.conf import settings
+from django.utils.importlib import import_module
+
+try:
+    from greenlet import getcurrent
+except ImportError:
+    getcurrent = None
+
+
+class ThreadStore(object):
+    """
+    Keeps values per thread.
+    """
+
+    def __init__(self):
+        self._local = local()
+
+    def get(self, key, default=None):
+        return getattr(self._local, key, default)
+
+    def set(self, key, value):
+        setattr(self._local, key, value)
+
+    def delete(self, key):
+        if hasattr(self._local, key):
+            delattr(self._local, key)
+
+
+class GreenletStore(object):
+    """
+    Keeps values per greenlet. Every thread has its own
+    main greenlet, so this is also safe with threads.
+    Values go away with the greenlet that set them.
+    """
+
+    def __init__(self):
+        self._values = weakref.WeakKeyDictionary()
+
+    def _get_values(self, create=False):
+        current = getcurrent()
+        values = self._values.get(current)
+        if values is None and create:
+            values = {}
+            self._values[current] = values
+        if values is None:
+            return {}
+        return values
+
+    def get(self, key, default=None):
+        return self._get_values().get(key, default)
+
+    def set(self, key, value):
+        self._get_values(create=True)[key] = value
+
+    def delete(self, key):
+        self._get_values().pop(key, None)
+
+
+def get_default_store_class():
+    if getcurrent is not None:
+        return GreenletStore
+    return ThreadStore
+
+
+_store = None
+
+
+def get_store():
+    """
+    Returns the store for the current process, creating
+    it the first time it is needed.
+    """
+
+    global _store
+    if _store is None:
+        path = getattr(settings, 'VERSIONING_STATE_STORE', None)
+        if path:
+            module, name = path.rsplit('.', 1)
+            klass = getattr(import_module(module), name)
+        else:
+            klass = get_default_store_class()
+        _store = klass()
+    return _store
+
+
+def set_store(store):
+    """
+    Replaces the store. Values kept by the
+    old store are not copied.
+    """
+
+    global _store
+    _store = store
@@ -15,10 +15,154 @@
 """
 
 from functools import wraps
+from threading import local
 
 import psycopg2.extensions
 
 from django.db import transaction, DEFAULT_DB_ALIAS, connections
+from django.utils.datastructures import SortedDict
+
+
+_local = local()
+
+
+class _State(object):
+
+    """
+    Book keeping for the xact blocks open on one connection in
+    this thread.  Reset every time an outermost block starts,
+    except for the calls that wait for a django managed
+    transaction to commit and what was pending at each
+    savepoint.
+    """
+
+    def __init__(self):
+        self.depth = 0
+        self.savepoints = 0
+        self.needs_rollback = False
+        self.pending = SortedDict()
+        self.deferred = SortedDict()
+        self.marks = {}
+        self.running = None
+
+
+def _get_state(using):
+    if not hasattr(_local, 'states'):
+        _local.states = {}
+    if not using in _local.states:
+        _local.states[using] = _State()
+    return _local.states[using]
+
+
+def savepoint_count(using=None):
+    """
+    Returns the number of savepoints that were issued since the
+    outermost xact() block on this connection started.
+    """
+
+    return _get_state(using or DEFAULT_DB_ALIAS).savepoints
+
+
+def in_xact(using=None):
+    """
+    Returns True if an xact() block is open on
+    this connection.
+    """
+
+    return _get_state(using or DEFAULT_DB_ALIAS).depth > 0
+
+
+def _run(state, callbacks):
+    # Calls queued while these run are added to the end
+    state.running = callbacks
+    try:
+        i = 0
+        while i < len(callbacks.keyOrder):
+            callbacks[callbacks.keyOrder[i]]()
+            i += 1
+    finally:
+        state.running = None
+
+
+def _queue(state, using, callbacks):
+    # Runs committed callbacks, unless the work is part of a
+    # django managed transaction that still has to commit.
+    if state.running is not None:
+        state.running.update(callbacks)
+    elif transaction.is_managed(using):
+        state.deferred.update(callbacks)
+    else:
+        _run(state, callbacks)
+
+
+def on_commit(func, key=None, using=None):
+    """
+    Calls func once the outermost xact() block on this
+    connection is done, or right away if no block is open.
+    Nothing is called if the block is rolled back.
+
+    If the block is part of a transaction managed by django,
+    like those of TransactionMiddleware or commit_on_success,
+    func is called when that transaction commits instead.
+
+    :param key: Calls queued with the same key are only made \
+    once per transaction, the last func queued for a key wins.
+    """
+
+    using = using or DEFAULT_DB_ALIAS
+    state = _get_state(using)
+    if key is None:
+        key = object()
+
+    if state.depth:
+        state.pending[key] = func
+    else:
+        _queue(state, using, SortedDict([(key, func)]))
+
+
+def committed(using):
+    """
+    Runs the calls that were waiting for the django managed
+    transaction on this connection. Called by the versioning
+    database backend after it commits.
+    """
+
+    state = _get_state(using)
+    deferred, state.deferred = state.deferred, SortedDict()
+    state.marks = {}
+    _run(state, deferred)
+
+
+def rolled_back(using, sid=None):
+    """
+    Drops the calls that were waiting for the django managed
+    transaction on this connection, or only those queued
+    after the savepoint sid. Called by the versioning database
+    backend after it rolls back.
+
+    Rolling back to a savepoint also undoes the failures of
+    nested xact blocks after it, so the enclosing block can
+    still commit.
+    """
+
+    state = _get_state(using)
+    if sid is None:
+        state.deferred = SortedDict()
+        state.marks = {}
+    elif sid in state.marks:
+        deferred, state.needs_rollback = state.marks[sid]
+        state.deferred = deferred.copy()
+
+
+def savepoint_created(using, sid):
+    """
+    Remembers the waiting calls and whether the open xact block
+    has to roll back, so rolling back to the savepoint sid can
+    restore them. Called by the versioning database backend.
+    """
+
+    state = _get_state(using)
+    state.marks[sid] = (state.deferred.copy(), state.needs_rollback)
 
 
 class _Transaction(object):
@@ -28,22 +172,56 @@ class _Transaction(object):
     context manager-style __enter__ and __exit__ statements.  We don't use it
     directly (for reasons noted below), but as a delegate for the
     _TransactionWrapper class.
+
+    Blocks nested inside another xact() block don't create a savepoint
+    unless one was asked for, since most of them never need to be rolled
+    back on their own.  If one of those blocks raises and the exception
+    is caught before it reaches a block that can roll back, the enclosing
+    block is rolled back and raises TransactionManagementError when it
+    exits instead of committing half of the work.
     """
 
-    def __init__(self, using):
+    def __init__(self, using, savepoint=False):
         self.using = using
+        self.savepoint = savepoint
         self.sid = None
+        self.elided = False
 
     def __enter__(self):
+        state = _get_state(self.using)
+        outermost = not state.depth
+        if outermost:
+            state.savepoints = 0
+            state.needs_rollback = False
+            state.pending = SortedDict()
+
         if transaction.is_managed(self.using):
-            # We're already in a transaction; create a savepoint.
-            self.sid = transaction.savepoint(self.using)
+            if outermost or self.savepoint:
+                # We're already in a transaction; create a savepoint.
+                self.sid = transaction.savepoint(self.using)
+                state.savepoints += 1
+                self.outer_pending = state.pending.copy()
+                self.outer_needs_rollback = state.needs_rollback
+                state.needs_rollback = False
+            else:
+                # Part of the enclosing block
+                self.elided = True
         else:
             transaction.enter_transaction_management(using=self.using)
             transaction.managed(True, using=self.using)
+        state.depth += 1
 
     def __exit__(self, exc_type, exc_value, traceback):
-        if exc_value is None:
+        state = _get_state(self.using)
+        state.depth -= 1
+
+        if self.elided:
+            if exc_value is not None:
+                state.needs_rollback = True
+            return False
+
+        failed = state.needs_rollback
+        if exc_value is None and not failed:
             # commit operation
             if self.sid is None:
                 # Outer transaction
@@ -61,15 +239,34 @@ class _Transaction(object):
                 except:
                     transaction.savepoint_rollback(self.sid, self.using)
                     raise
+                finally:
+                    state.needs_rollback = self.outer_needs_rollback
+
+            if not state.depth:
+                # The outermost block is done, run what was
+                # waiting for it.
+                pending, state.pending = state.pending, SortedDict()
+                _queue(state, self.using, pending)
         else:
             # rollback operation
             if self.sid is None:
                 # Outer transaction
                 transaction.rollback(self.using)
                 self._leave_transaction_management()
+                state.needs_rollback = False
+                state.pending = SortedDict()
             else:
                 # Inner savepoint
                 transaction.savepoint_rollback(self.sid, self.using)
+                state.needs_rollback = self.outer_needs_rollback
+                state.pending = self.outer_pending
+
+            if exc_value is None:
+                raise transaction.TransactionManagementError(
+                    "An exception raised inside a nested xact() block was "
+                    "caught without being rolled back. Use "
+                    "xact(savepoint=True) for blocks that may fail and "
+                    "be continued from.")
 
         # Returning False here means we did not gobble up the exception, so the
         # exception process should continue.
@@ -110,13 +307,14 @@ class _TransactionWrapper:
         same syntax.
     """
 
-    def __init__(self, using):
+    def __init__(self, using, savepoint=False):
         self.using = using
+        self.savepoint = savepoint
         self.transaction = None
 
     def __enter__(self):
         if self.transaction is None:
-            self.transaction = _Transaction(self.using)
+            self.transaction = _Transaction(self.using, self.savepoint)
         return self.transaction.__enter__()
 
     def __exit__(self, exc_type, exc_value, traceback):
@@ -125,12 +323,21 @@ class _TransactionWrapper:
     def __call__(self, func):
         @wraps(func)
         def inner(*args, **kwargs):
-            with _Transaction(self.using):
+            with _Transaction(self.using, self.savepoint):
                 return func(*args, **kwargs)
         return inner
 
 
-def xact(using=None):
+def xact(using=None, savepoint=False):
+    """
+    Runs a block in a transaction, or as part of the
+    transaction that is already open.
+
+    :param savepoint: Create a savepoint for this block even \
+    if it is nested in another xact block. Use it when the \
+    caller catches exceptions from the block and continues.
+    """
+
     if using is None:
         using = DEFAULT_DB_ALIAS
     if callable(using):
@@ -150,7 +357,7 @@ def xact(using=None):
         # ... or as a context manager:
         #    with xact():
         #       ...
-        return _TransactionWrapper(using)
+        return _TransactionWrapper(using, savepoint)
 
 
 
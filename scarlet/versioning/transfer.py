@@ -0,0 +1,229 @@
+"""
+Streaming dump and load of versioned data.
+
+The dumpdata command loads whole tables into memory, which
+doesn't work for large content databases. These functions
+read the base, version and many to many tables of versioned
+models, and those of the rows cloned with them, in chunks
+with server side cursors and write one JSON object per
+line, and load them back with COPY in batches, so both run
+in constant memory.
+
+Every line looks like::
+
+    {"model": "blog.post_version", "fields": {"vid": 1, ...}}
+
+Rows keep their primary keys, so the vid and object_id
+relationships between the tables stay the same.
+"""
+
+import datetime
+import decimal
+import json
+import StringIO
+
+from django.core.management.color import no_style
+from django.db import connections, DEFAULT_DB_ALIAS
+from django.db.models import get_models, get_model
+
+from . import bulk, snapshots
+from .transactions import xact
+
+
+def get_versioned_models(app_labels=None):
+    """
+    Returns the models whose tables hold versioned data
+    for the given apps, or all apps: the base and version
+    models of every versioned model, the models in their
+    _clone_related, recursively, and the auto created
+    through models of their many to many fields. Models
+    come before the models that point at them.
+    """
+
+    from .models import BaseVersionedModel
+
+    result = []
+    tables = set()
+
+    def add(model):
+        if not model._meta.db_table in tables:
+            tables.add(model._meta.db_table)
+            result.append(model)
+
+    def add_throughs(*models):
+        for model in filter(None, models):
+            for field in model._meta.local_many_to_many:
+                if field.rel.through._meta.auto_created:
+                    add(field.rel.through)
+
+    def add_cloned(model):
+        # Rows that are cloned with a version point at it
+        for name in bulk.get_clone_related(model):
+            rel, mod, direct, m2m = bulk._get_relation(model, name)
+            if m2m and not direct:
+                # Can't be cloned
+                continue
+            elif m2m:
+                related = rel.rel.to
+                add(related)
+                add(rel.rel.through)
+            else:
+                related = rel.model
+                add(related)
+            add_cloned(related)
+            add_throughs(related)
+
+    for m in get_models():
+        if not issubclass(m, BaseVersionedModel) or \
+                getattr(m._meta, '_is_view', False):
+            continue
+        if app_labels and not m._meta.app_label in app_labels:
+            continue
+
+        add(m._meta.get_field('object').rel.to)
+        add(m)
+        add_cloned(m)
+        add_throughs(m, getattr(m._meta, '_view_model', None))
+    return result
+
+
+def _label(model):
+    return "%s.%s" % (model._meta.app_label, model._meta.object_name.lower())
+
+
+def _default(value):
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, decimal.Decimal):
+        return str(value)
+    raise TypeError("%r is not JSON serializable" % value)
+
+
+def dump(models, stream, chunk_size=1000, using=None):
+    """
+    Writes every row of the tables of the given models
+    to a stream, one JSON object per line.
+
+    :param chunk_size: How many rows are read from the \
+    database at a time.
+
+    Returns the number of rows written.
+    """
+
+    connection = connections[using or DEFAULT_DB_ALIAS]
+    qn = connection.ops.quote_name
+    count = 0
+
+    # Server side cursors only live inside a transaction
+    with xact(using=using):
+        connection.cursor()
+        for model in models:
+            opts = model._meta
+            columns = [f.column for f in opts.local_fields]
+            label = _label(model)
+
+            cursor = connection.connection.cursor(
+                                        name='versioning_dump_%s' % count)
+            cursor.itersize = chunk_size
+            cursor.execute("SELECT %s FROM %s ORDER BY %s" % (
+                                ", ".join([qn(c) for c in columns]),
+                                qn(opts.db_table), qn(opts.pk.column)))
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+
+                for row in rows:
+                    stream.write(json.dumps({
+                                    'model': label,
+                                    'fields': dict(zip(columns, row))},
+                                 default=_default) + "\n")
+                count += len(rows)
+            cursor.close()
+    return count
+
+
+def _csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        value = value and 'true' or 'false'
+    if not isinstance(value, basestring):
+        value = json.dumps(value)
+    return '"%s"' % value.replace('"', '""')
+
+
+def _copy(connection, model, columns, rows):
+    qn = connection.ops.quote_name
+    data = StringIO.StringIO()
+    for row in rows:
+        line = u",".join([_csv_value(row.get(c)) for c in columns])
+        data.write(line.encode('utf-8') + "\n")
+    data.seek(0)
+
+    cursor = connection.connection.cursor()
+    cursor.copy_expert("COPY %s (%s) FROM STDIN WITH CSV" % (
+                            qn(model._meta.db_table),
+                            ", ".join([qn(c) for c in columns])), data)
+
+
+def load(lines, batch_size=1000, using=None):
+    """
+    Loads rows written by :py:func:`dump` with one COPY
+    statement per batch, then resets the sequences of the
+    loaded tables and refreshes published snapshots.
+
+    :param lines: An iterable of lines, such as an open file.
+    :param batch_size: How many rows of a table to \
+    copy at a time.
+
+    Returns the number of rows loaded.
+    """
+
+    connection = connections[using or DEFAULT_DB_ALIAS]
+    count = 0
+    models = []
+    batch = []
+    current = None
+
+    def flush():
+        if batch:
+            model, columns = current
+            _copy(connection, model, columns, batch)
+            del batch[:]
+
+    with xact(using=using):
+        connection.cursor()
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+
+            obj = json.loads(line)
+            model = get_model(*obj['model'].split('.'))
+            if model is None:
+                raise ValueError("Unknown model %s" % obj['model'])
+
+            if current is None or current[0] != model or \
+                    len(batch) >= batch_size:
+                flush()
+                if not model in models:
+                    models.append(model)
+                current = (model, [f.column for f in
+                                   model._meta.local_fields])
+
+            batch.append(obj['fields'])
+            count += 1
+        flush()
+
+        if models:
+            cursor = connection.cursor()
+            for sql in connection.ops.sequence_reset_sql(no_style(),
+                                                         models):
+                cursor.execute(sql)
+
+            for model in models:
+                view = getattr(model._meta, '_view_model', None)
+                if view:
+                    snapshots.refresh(view, using=using)
+    return count
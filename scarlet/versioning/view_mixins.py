@@ -8,8 +8,14 @@ class PreviewableObject(SingleObjectMixin):
     """
     View that can get an unpublished version of an
     object
+
+    Set use_cache to True to look up published items by pk
+    with :py:meth:`cached_get <versioning.manager.VersionManager.cached_get>`
+    when no custom queryset is given.
     """
 
+    use_cache = False
+
     def get_object(self, queryset=None):
         """
         Returns the object the view is displaying.
@@ -29,13 +35,22 @@ class PreviewableObject(SingleObjectMixin):
             except ValueError:
                 pass
 
+        pk = self.kwargs.get(self.pk_url_kwarg, None)
+        if self.use_cache and pk is not None and queryset is None and \
+                not vid and schema == self.model.PUBLISHED:
+            try:
+                return self.model.objects.cached_get(pk=pk)
+            except self.model.DoesNotExist:
+                raise http.Http404(
+                        u"No %(verbose_name)s found matching the query" %
+                         {'verbose_name': self.model._meta.verbose_name})
+
         with manager.SwitchSchema(schema):
             # Use a custom queryset if provided
             if queryset is None:
                 queryset = self.get_queryset()
 
             # Next, try looking up by primary key.
-            pk = self.kwargs.get(self.pk_url_kwarg, None)
             slug = self.kwargs.get(self.slug_url_kwarg, None)
             if pk is not None:
                 if vid:
@@ -90,6 +90,18 @@ class Image(Cloneable):
         return self.name
 
 
+class Magazine(VersionView, NameModel):
+
+    class Meta:
+        _published_snapshot = True
+
+
+class Comic(VersionView, NameModel):
+
+    class Meta:
+        _partition_by_state = True
+
+
 class CustomModel(BaseModel):
     reg_number = models.CharField(max_length=20)
 
@@ -1,13 +1,37 @@
 import unittest
+from StringIO import StringIO
 import datetime
+import tempfile
+import threading
+
+from psycopg2.extras import register_default_jsonb
 
 from django.test import TestCase, TransactionTestCase
 from django.utils import timezone, formats
-from django.core.exceptions import ValidationError
-from django.db import models as dbmodels
-
-from scarlet.versioning.models import VersionView
-from scarlet.versioning import manager
+from django.core.exceptions import ValidationError, ImproperlyConfigured
+from django.db import models as dbmodels, connection, transaction
+from django.db.transaction import TransactionManagementError
+from django.core.management import call_command
+
+from scarlet.versioning.models import VersionView, publish_many, \
+                                      purge_archives, \
+                                      validate_versioned_unique, \
+                                      published_signal, ArchivedVersion
+from scarlet.scheduling.models import Schedule, claim_due, \
+                                      run_scheduled_updates, \
+                                      get_scheduled_objects, \
+                                      coalesce_schedules, \
+                                      SCHEDULE_CHANNEL
+from scarlet.scheduling.daemon import Scheduler
+from scarlet.scheduling.management import get_missing_columns
+from scarlet.scheduling.fields import json_contains, register_jsonb
+from scarlet.versioning import manager, archives, state, routers, \
+                              object_cache, instrumentation
+from scarlet.versioning.transfer import get_versioned_models
+from scarlet.versioning.transactions import xact, savepoint_count, \
+                                            on_commit, committed
+from scarlet.versioning.management import update_schema, get_indexes, \
+                                          get_missing_indexes
 
 import models
 
@@ -177,6 +201,82 @@ class ModelTests(TestCase):
         n_gallery = models.Gallery.objects.all().count()
         self.assertEqual(n_gallery, 4)
 
+    def testCloneRelatedQueries(self):
+        """
+        cloning related objects takes the same number
+        of queries no matter how many there are
+        """
+        from django.db import connection
+
+        def count_clone_queries():
+            book = models.Book.objects.get(vid=1)
+            connection.use_debug_cursor = True
+            start = len(connection.queries)
+            book._clone()
+            connection.use_debug_cursor = None
+            return len(connection.queries) - start
+
+        few = count_clone_queries()
+        for i in range(20):
+            models.Review(book_id=1, text='review %s' % i).save()
+        self.assertEqual(count_clone_queries(), few)
+        self.assertEqual(models.Review.objects.filter(book=3).count(), 22)
+
+    def testClonePrepForClone(self):
+        """
+        prep_for_clone is still called for each cloned object
+        """
+        def prep_for_clone(obj):
+            obj.pk = None
+            obj.text = 'copy of %s' % obj.text
+
+        models.Review.prep_for_clone = prep_for_clone
+        try:
+            book = models.Book.objects.get(vid=1)
+            book._clone()
+        finally:
+            del models.Review.prep_for_clone
+
+        clone = models.Book.objects.get(vid=2)
+        self.assertEqual(sorted(r.text for r in clone.review_set.all()),
+                         ["copy of I didn't like this", 'copy of I liked this'])
+
+    def testCloneCustomSave(self):
+        """
+        children with their own save or save receivers
+        are saved one at a time so those still run
+        """
+        saved = []
+
+        def save(obj, *args, **kwargs):
+            saved.append(obj.text)
+            super(models.Review, obj).save(*args, **kwargs)
+
+        def receiver(sender, instance, **kwargs):
+            saved.append(sender)
+
+        models.Review.save = save
+        try:
+            models.Book.objects.get(vid=1)._clone()
+        finally:
+            del models.Review.save
+        self.assertEqual(sorted(saved),
+                         ["I didn't like this", 'I liked this'])
+
+        del saved[:]
+        clone = models.Book.objects.get(vid=1)
+        dbmodels.signals.post_save.connect(receiver, sender=models.Gallery)
+        try:
+            clone._clone()
+        finally:
+            dbmodels.signals.post_save.disconnect(receiver,
+                                                  sender=models.Gallery)
+        self.assertEqual(saved, [models.Gallery, models.Gallery])
+        self.assertEqual(models.Review.objects.filter(
+                                    book=clone.vid).count(), 2)
+        self.assertEqual(models.Book.galleries.through.objects.filter(
+                                    from_id=clone.vid).count(), 2)
+
     def testDeleteRelated(self):
         """
         related objects should be deleted as well
@@ -418,6 +518,10 @@ class ModelTests(TestCase):
         self.assertEqual(klass.normal.all().count(), 2)
         self.assertFalse(klass.normal.filter(
                                     state=models.Book.PUBLISHED).exists())
+        # and the schedule of the overwritten item is gone
+        vid = klass.normal.get(state=models.Book.SCHEDULED).vid
+        self.assertEqual([x.object_args for x in Schedule.objects.all()],
+                         [{'vid': vid}])
 
         # if you want to really publish it. gotta provide "when"
         book = models.Book.objects.get(vid=1)
@@ -648,6 +752,238 @@ class ModelTests(TestCase):
         self.assertEqual(klass.normal.filter(state=models.Book.ARCHIVED
                                              ).count(), 5)
         self.assertEqual(models.Gallery.objects.all().count(), 14)
+        self.assertEqual(models.Review.objects.all().count(), 14)
+
+    def testPurgeKeepsNewest(self):
+        for i in range(0, 7):
+            models.Book.objects.get(vid=1).publish()
+        book = models.Book.objects.get(vid=1)
+        book.purge_archives()
+
+        for i in range(0, 10):
+            models.Book.objects.get(vid=1).publish()
+
+        klass = book.get_version_class()
+        archived = list(klass.normal.filter(state=models.Book.ARCHIVED
+                                    ).order_by('-last_save', '-vid'
+                                    ).values_list('vid', flat=True))
+        self.assertEqual(len(archived), 15)
+        book.purge_archives()
+
+        # The newest 5 are kept and the rest are removed
+        self.assertEqual(list(klass.normal.filter(
+                                    state=models.Book.ARCHIVED
+                                    ).order_by('-last_save', '-vid'
+                                    ).values_list('vid', flat=True)),
+                         archived[:5])
+        self.assertFalse(klass.normal.filter(vid__in=archived[5:]).exists())
+        self.assertEqual(models.Gallery.objects.all().count(), 14)
+        self.assertEqual(models.Review.objects.all().count(), 14)
+
+    def testPurgeVersionsCommand(self):
+        for i in range(0, 6):
+            models.Book.objects.get(vid=1).publish()
+            models.Author.objects.get(vid=1).publish()
+
+        call_command('purge_versions', keep=['version_models.Book=2'],
+                     batch_size=1, verbosity=0)
+
+        klass = models.Book._meta._version_model
+        self.assertEqual(klass.normal.filter(state=models.Book.ARCHIVED
+                                             ).count(), 2)
+        self.assertEqual(models.Review.objects.all().count(), 8)
+        aklass = models.Author._meta._version_model
+        self.assertEqual(aklass.normal.filter(state=models.Author.ARCHIVED
+                                              ).count(), 5)
+
+    def testSharedRelated(self):
+        klass = models.Book._meta._version_model
+        models.Book._clone_shared = ['galleries']
+        try:
+            models.Book.objects.get(vid=1).publish()
+            self.assertEqual(models.Gallery.objects.all().count(), 4)
+            first = klass.normal.get(state=models.Book.PUBLISHED)
+
+            # Nothing changed so the galleries are shared
+            models.Book.objects.get(vid=1).publish()
+            self.assertEqual(models.Gallery.objects.all().count(), 4)
+            second = klass.normal.get(state=models.Book.PUBLISHED)
+            self.assertEqual(
+                sorted(first.galleries.values_list('pk', flat=True)),
+                sorted(second.galleries.values_list('pk', flat=True)))
+
+            # Only the changed gallery is copied
+            bd = models.Book.objects.get(vid=1)
+            gallery = bd.galleries.all()[0]
+            gallery.name = 'changed'
+            gallery.save()
+            bd.publish()
+            self.assertEqual(models.Gallery.objects.all().count(), 5)
+            publish_many(models.Book.objects.all())
+            self.assertEqual(models.Gallery.objects.all().count(), 5)
+            with manager.SwitchSchema('published'):
+                bp = models.Book.normal.get(object_id=1)
+                self.assertEqual(bp.galleries.all().count(), 2)
+                self.assertTrue(bp.galleries.filter(name='changed').exists())
+
+            # Shared rows stay as long as a version links to them
+            second.delete()
+            self.assertEqual(models.Gallery.objects.all().count(), 5)
+            self.assertEqual(first.galleries.all().count(), 2)
+
+            purge_archives(models.Book, keep=0)
+            self.assertEqual(models.Gallery.objects.all().count(), 4)
+            with manager.SwitchSchema('published'):
+                bp = models.Book.normal.get(object_id=1)
+                self.assertEqual(bp.galleries.all().count(), 2)
+        finally:
+            del models.Book._clone_shared
+
+    def testPurgeMixedArchives(self):
+        """
+        archived versions still in the version table count
+        towards keep along with the compressed ones
+        """
+        klass = models.Book._meta._version_model
+        for i in range(3):
+            models.Book.objects.get(vid=1).publish()
+        models.Book.COMPRESS_ARCHIVES = True
+        try:
+            for i in range(3):
+                models.Book.objects.get(vid=1).publish()
+            self.assertEqual(klass.normal.filter(
+                                state=models.Book.ARCHIVED).count(), 2)
+            self.assertEqual(ArchivedVersion.objects.count(), 3)
+
+            purge_archives(models.Book, keep=3)
+            self.assertEqual(klass.normal.filter(
+                                state=models.Book.ARCHIVED).count(), 2)
+            self.assertEqual(ArchivedVersion.objects.count(), 1)
+
+            purge_archives(models.Book, keep=1)
+            self.assertEqual(klass.normal.filter(
+                                state=models.Book.ARCHIVED).count(), 1)
+            self.assertFalse(ArchivedVersion.objects.exists())
+        finally:
+            del models.Book.COMPRESS_ARCHIVES
+
+    def testCompressArchives(self):
+        klass = models.Book._meta._version_model
+        models.Book.COMPRESS_ARCHIVES = True
+        try:
+            self.assertTrue(archives.can_compress(models.Book))
+            self.assertFalse(archives.can_compress(models.Cartoon))
+
+            for name in ('first', 'second', 'third'):
+                book = models.Book.objects.get(vid=1)
+                book.name = name
+                book.save()
+                book.publish()
+            publish_many(models.Book.objects.all())
+
+            # Archived versions are moved out of the version table
+            self.assertFalse(klass.normal.filter(
+                                    state=models.Book.ARCHIVED).exists())
+            self.assertEqual(models.Review.objects.all().count(), 4)
+            records = ArchivedVersion.objects.order_by('vid')
+            self.assertEqual([r.base_vid is None for r in records],
+                             [False, False, True])
+
+            versions = archives.get_versions(models.Book, 1)
+            self.assertEqual([v.state for v in versions],
+                             [models.Book.ARCHIVED] * 3)
+            self.assertEqual([v.vid for v in versions],
+                             [r.vid for r in records][::-1])
+
+            # Reverting to the oldest restores it first
+            self.assertRaises(klass.DoesNotExist, models.Book.load_version,
+                              versions[-1].vid, object_id=2)
+            models.Book.revert(versions[-1].vid, object_id=1)
+            version = klass.normal.get(vid=versions[-1].vid)
+            self.assertEqual(version.state, models.Book.ARCHIVED)
+            self.assertEqual(version.name, 'first')
+            self.assertEqual(models.Review.objects.filter(
+                                        book=version.vid).count(), 2)
+            self.assertEqual(version.galleries.all().count(), 2)
+            bd = models.Book.objects.get(object_id=1)
+            self.assertEqual(bd.name, 'first')
+            self.assertEqual(bd.review_set.all().count(), 2)
+
+            # The rest of the chain can still be read
+            self.assertEqual(
+                [archives.restore(models.Book, [v.vid])[0].name
+                 for v in versions[:2]], ['third', 'second'])
+            self.assertFalse(ArchivedVersion.objects.exists())
+
+            publish_many(models.Book.objects.all())
+            purge_archives(models.Book, keep=0)
+            self.assertFalse(ArchivedVersion.objects.exists())
+            self.assertFalse(klass.normal.filter(
+                                    state=models.Book.ARCHIVED).exists())
+        finally:
+            del models.Book.COMPRESS_ARCHIVES
+
+    def testPublishMany(self):
+        book2 = models.Book(name='Book2', author_id=2)
+        book2.save()
+        sent = []
+
+        def published_listener(sender, instance, **kwargs):
+            sent.append(instance.object_id)
+
+        published_signal.connect(published_listener)
+        versions = publish_many(models.Book.objects.all())
+        # The test case's transaction never commits
+        committed(connection.alias)
+        published_signal.disconnect(published_listener)
+
+        self.assertEqual(len(versions), 2)
+        self.assertEqual(sorted(sent), sorted([1, book2.pk]))
+
+        with manager.SwitchSchema('published'):
+            self.assertEqual(models.Book.normal.all().count(), 2)
+            bp = models.Book.normal.get(object_id=1)
+            self.assertTrue(bp.is_published)
+            self.assertEqual(bp.user_published, 'code')
+            self.assertEqual(bp.review_set.all().count(), 2)
+            self.assertEqual(bp.galleries.all().count(), 2)
+
+        bd = models.Book.objects.get(vid=1)
+        self._check_different_book_versions(bd, bp)
+        self.assertEqual(bd.last_scheduled, bp.last_scheduled)
+        self.assertEqual(bd.last_save, bd.v_last_save)
+        self.assertEqual(models.Review.objects.all().count(), 4)
+        self.assertEqual(models.Gallery.objects.all().count(), 4)
+
+        # Publishing again archives the current versions
+        publish_many(models.Book.objects.all())
+        with manager.SwitchSchema('public'):
+            self.assertEqual(models.Book.normal.filter(
+                                state=models.Book.ARCHIVED).count(), 2)
+            self.assertEqual(models.Book.normal.filter(
+                                state=models.Book.PUBLISHED).count(), 2)
+
+    def testPublishManyScheduled(self):
+        klass = models.Book._meta._version_model
+        t = timezone.now() + datetime.timedelta(days=7)
+        versions = publish_many(models.Book.objects.all(), when=t)
+
+        self.assertEqual(versions[0].state, models.Book.SCHEDULED)
+        self.assertEqual(versions[0].date_published, t)
+        self.assertEqual(klass.normal.all().count(), 2)
+        schedule = Schedule.objects.get()
+        self.assertEqual(schedule.object_args, {'vid': versions[0].vid})
+
+        # Publishing again with no date replaces the scheduled version
+        publish_many(models.Book.objects.all())
+        self.assertEqual(klass.normal.all().count(), 2)
+        self.assertFalse(klass.normal.filter(
+                                    state=models.Book.PUBLISHED).exists())
+        scheduled = klass.normal.get(state=models.Book.SCHEDULED)
+        self.assertEqual(scheduled.date_published, t)
+        # Only the schedule of the new version is left
+        self.assertEqual([x.object_args for x in Schedule.objects.all()],
+                         [{'vid': scheduled.vid}])
 
     def testStatus1(self):
         book = models.Book.objects.get(vid=1)
@@ -743,6 +1079,44 @@ class ModelTests(TestCase):
                                             state=a1.PUBLISHED).exists())
         a1.validate_unique()
 
+    def testBatchedVersionedUnique(self):
+        from django.forms.models import modelformset_factory
+        from scarlet.cms.forms import VersionedUniqueFormSet
+
+        a1 = models.Author.objects.get(vid=1)
+        models.Author.versioned_unique = ['name']
+        try:
+            a2 = models.Author(name='other')
+            a2.save()
+            a2 = models.Author.objects.get(vid=a2.vid)
+
+            authors = [a1, a2, models.Author(name=a1.name),
+                       models.Author(name='new')]
+            with self.assertNumQueries(1):
+                errors = validate_versioned_unique(authors)
+            self.assertEqual(errors[0], {})
+            self.assertEqual(errors[1], {})
+            self.assertEqual(errors[2].keys(), ['name'])
+            self.assertEqual(errors[3], {})
+
+            FormSet = modelformset_factory(models.Author, fields=('name',),
+                                           formset=VersionedUniqueFormSet,
+                                           extra=0)
+            queryset = models.Author.objects.filter(state='draft'
+                                                    ).order_by('vid')
+            data = {'form-TOTAL_FORMS': '2', 'form-INITIAL_FORMS': '2',
+                    'form-0-id': str(a1.pk), 'form-0-name': a1.name,
+                    'form-1-id': str(a2.pk), 'form-1-name': a1.name}
+            formset = FormSet(data, queryset=queryset)
+            formset.forms
+            # One query per id field and one for both names
+            with self.assertNumQueries(3):
+                self.assertFalse(formset.is_valid())
+            self.assertFalse(formset.forms[0].errors)
+            self.assertTrue('name' in formset.forms[1].errors)
+        finally:
+            del models.Author.versioned_unique
+
     def testCustomBaseModel(self):
         """
         custom base_model; defined by _base_model in Meta;
@@ -834,6 +1208,162 @@ class TransactionSwitchTests(TestCase):
             self.assertEqual(models.Review.objects.all().count(), 0)
             self.assertEqual(models.Gallery.objects.all().count(), 0)
 
+class QualifiedSchemaTests(TestCase):
+    fixtures = ('test_data.json',)
+
+    def setUp(self):
+        self.qualify_schemas = connection.qualify_schemas
+        connection.qualify_schemas = True
+        connection.use_debug_cursor = True
+
+    def tearDown(self):
+        connection.qualify_schemas = self.qualify_schemas
+        connection.use_debug_cursor = False
+        manager.deactivate()
+
+    def testQualifiedNames(self):
+        models.Author.objects.get(vid=1).publish()
+        models.Book.objects.get(vid=1).publish()
+
+        del connection.queries[:]
+        with manager.SwitchSchema('published'):
+            book = models.Book.objects.get(object_id=1)
+            self.assertEqual(book.state, models.Book.PUBLISHED)
+            self.assertEqual(models.Book.objects.filter(
+                                    author__name__isnull=False).count(), 1)
+        with manager.SwitchSchema('draft'):
+            self.assertEqual(models.Book.objects.get(object_id=1).state,
+                             models.Book.DRAFT)
+        with manager.SwitchSchema('public'):
+            self.assertEqual(models.Book.objects.filter(object_id=1
+                                                        ).count(), 2)
+
+        sql = [q['sql'] for q in connection.queries]
+        self.assertFalse([q for q in sql if 'search_path' in q])
+        self.assertTrue('"published"."version_models_book"' in sql[0])
+        self.assertTrue('"published"."version_models_author"' in sql[1])
+        self.assertTrue('"draft"."version_models_book"' in sql[2])
+        self.assertTrue('"public"."version_models_book"' in sql[3])
+
+    def testActivate(self):
+        models.Book.objects.get(vid=1).publish()
+
+        manager.activate('published')
+        book = models.Book.objects.get(object_id=1)
+        self.assertEqual(book.state, models.Book.PUBLISHED)
+        self.assertEqual(book.review_set.all().count(), 2)
+
+
+class XactTests(TestCase):
+    fixtures = ('test_data.json',)
+
+    def testSavepointCount(self):
+        models.Book.objects.get(vid=1).publish()
+        # Only the outermost block needs a savepoint
+        self.assertEqual(savepoint_count(), 1)
+
+    def testSavepoint(self):
+        with xact():
+            try:
+                with xact(savepoint=True):
+                    models.Gallery(name='new').save()
+                    raise ValueError
+            except ValueError:
+                pass
+            models.Gallery(name='other').save()
+
+        self.assertEqual(savepoint_count(), 2)
+        self.assertFalse(models.Gallery.objects.filter(name='new').exists())
+        self.assertTrue(models.Gallery.objects.filter(name='other').exists())
+
+    def testCaughtWithoutSavepoint(self):
+        def create():
+            with xact():
+                try:
+                    with xact():
+                        models.Gallery(name='new').save()
+                        raise ValueError
+                except ValueError:
+                    pass
+
+        self.assertRaises(TransactionManagementError, create)
+        self.assertFalse(models.Gallery.objects.filter(name='new').exists())
+
+    def testDjangoSavepoint(self):
+        with xact():
+            sid = transaction.savepoint()
+            try:
+                with xact():
+                    models.Gallery(name='new').save()
+                    raise ValueError
+            except ValueError:
+                transaction.savepoint_rollback(sid)
+            models.Gallery(name='other').save()
+
+        self.assertFalse(models.Gallery.objects.filter(name='new').exists())
+        self.assertTrue(models.Gallery.objects.filter(name='other').exists())
+
+    def testSignalsOnCommit(self):
+        sent = []
+
+        def published_listener(sender, instance, **kwargs):
+            sent.append(instance.object_id)
+
+        published_signal.connect(published_listener)
+        try:
+            with xact():
+                models.Book.objects.get(vid=1).publish()
+                models.Book.objects.get(object_id=1,
+                                        state=models.Book.DRAFT).publish()
+                self.assertEqual(sent, [])
+            # They wait for the test case's transaction
+            self.assertEqual(sent, [])
+            committed(connection.alias)
+            self.assertEqual(sent, [1])
+
+            del sent[:]
+            try:
+                with xact():
+                    models.Book.objects.get(object_id=1,
+                                            state=models.Book.DRAFT).publish()
+                    raise ValueError
+            except ValueError:
+                pass
+            committed(connection.alias)
+            self.assertEqual(sent, [])
+        finally:
+            published_signal.disconnect(published_listener)
+
+    def testOnCommitSavepoint(self):
+        called = []
+        with xact():
+            on_commit(lambda: called.append('a'), key='a')
+            try:
+                with xact(savepoint=True):
+                    on_commit(lambda: called.append('b'))
+                    raise ValueError
+            except ValueError:
+                pass
+            on_commit(lambda: called.append('c'), key='a')
+            self.assertEqual(called, [])
+        self.assertEqual(called, [])
+        committed(connection.alias)
+        self.assertEqual(called, ['c'])
+
+    def testOnCommitManaged(self):
+        called = []
+        on_commit(lambda: called.append('a'))
+        sid = transaction.savepoint()
+        with xact():
+            on_commit(lambda: called.append('b'))
+        transaction.savepoint_rollback(sid)
+        with transaction.commit_on_success():
+            on_commit(lambda: called.append('c'))
+        self.assertEqual(called, [])
+        committed(connection.alias)
+        self.assertEqual(called, ['a', 'c'])
+
+
 class ManagerTests(TestCase):
     fixtures = ('test_data.json',)
 
@@ -858,3 +1388,724 @@ class ManagerTests(TestCase):
                         object_id=book.object_id))
         schema = manager.get_schema()
         self.assertEqual(schema, None)
+
+    def _check_store(self, store, run):
+        seen = []
+        store.set('schema', 'draft')
+        run(lambda: seen.append(store.get('schema')))
+        self.assertEqual(seen, [None])
+        self.assertEqual(store.get('schema'), 'draft')
+        store.delete('schema')
+        store.delete('schema')
+        self.assertEqual(store.get('schema', 'x'), 'x')
+
+    def _run_thread(self, func):
+        t = threading.Thread(target=func)
+        t.start()
+        t.join()
+
+    def testThreadStore(self):
+        self._check_store(state.ThreadStore(), self._run_thread)
+
+    @unittest.skipIf(state.getcurrent is None, "greenlet is not installed")
+    def testGreenletStore(self):
+        import greenlet
+        store = state.GreenletStore()
+        self._check_store(store, lambda f: greenlet.greenlet(f).switch())
+        self._check_store(store, self._run_thread)
+
+    def testSetStore(self):
+        old = state.get_store()
+        store = state.ThreadStore()
+        state.set_store(store)
+        try:
+            manager.activate('draft')
+            self.assertEqual(store.get('current_state'), 'draft')
+            self.assertEqual(manager.get_state(), 'draft')
+            self.assertEqual(old.get('current_state'), None)
+            manager.deactivate()
+            self.assertEqual(manager.get_schema(), None)
+        finally:
+            state.set_store(old)
+
+    def testUpdate(self):
+        author = models.Author.objects.all()[0]
+        models.Book(name='another', author=author).save()
+        drafts = models.Book.objects.filter(state=models.Book.DRAFT)
+        count = drafts.count()
+        self.assertTrue(count > 1)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(drafts.update(name='updated'), count)
+        self.assertEqual(set(drafts.values_list('name', flat=True)),
+                         set(['updated']))
+
+        # Base and version fields: one read and two updates
+        # inside a savepoint
+        with self.assertNumQueries(5):
+            self.assertEqual(drafts.filter(name='updated').update(
+                                name='again', is_published=True), count)
+        self.assertEqual(drafts.filter(name='again',
+                                       is_published=True).count(), count)
+
+        manager.activate('draft')
+        try:
+            self.assertEqual(models.Book.objects.update(name='draft'),
+                             count)
+        finally:
+            manager.deactivate()
+        self.assertFalse(models.Book.objects.filter(
+                            state=models.Book.PUBLISHED, name='draft'))
+
+
+class RouterTests(TestCase):
+    fixtures = ('test_data.json',)
+
+    def setUp(self):
+        with self.settings(VERSIONING_READ_REPLICAS=['replica']):
+            self.router = routers.StateRouter()
+        manager.activate(models.Book.PUBLISHED)
+        # Other tests publish items
+        routers._sticky_until = 0
+
+    def tearDown(self):
+        manager.deactivate()
+        routers.use_primary(False)
+        routers._sticky_until = 0
+
+    def testReads(self):
+        self.assertEqual(self.router.db_for_read(models.Book), 'replica')
+        self.assertEqual(self.router.db_for_write(models.Book), 'default')
+
+        manager.activate(models.Book.DRAFT)
+        self.assertEqual(self.router.db_for_read(models.Book), 'default')
+        manager.activate(models.Book.PUBLISHED)
+
+        with xact():
+            self.assertEqual(self.router.db_for_read(models.Book),
+                             'default')
+        self.assertEqual(self.router.db_for_read(models.Book), 'replica')
+
+        routers.use_primary()
+        self.assertEqual(self.router.db_for_read(models.Book), 'default')
+        routers.use_primary(False)
+        self.assertEqual(self.router.db_for_read(models.Book), 'replica')
+
+        self.assertFalse(self.router.allow_syncdb('replica', models.Book))
+        self.assertEqual(self.router.allow_syncdb('default', models.Book),
+                         None)
+
+    def testStickyAfterPublish(self):
+        manager.deactivate()
+        models.Book.objects.get(vid=1).publish()
+        # The test case's transaction never commits
+        committed(connection.alias)
+        manager.activate(models.Book.PUBLISHED)
+        self.assertEqual(self.router.db_for_read(models.Book), 'default')
+
+        routers._sticky_until = 0
+        self.assertEqual(self.router.db_for_read(models.Book), 'replica')
+
+
+class ObjectCacheTests(TestCase):
+    fixtures = ('test_data.json',)
+
+    def setUp(self):
+        object_cache.get_cache_backend().clear()
+        object_cache.reset_stats()
+
+    def testCachedGet(self):
+        book = models.Book.objects.get(vid=1)
+        with self.assertRaises(models.Book.DoesNotExist):
+            models.Book.objects.cached_get(pk=book.pk)
+        book.publish()
+
+        obj = models.Book.objects.cached_get(pk=book.pk)
+        self.assertEqual(obj.state, models.Book.PUBLISHED)
+        with self.assertNumQueries(0):
+            obj = models.Book.objects.cached_get(pk=book.pk)
+            self.assertEqual(obj.name, book.name)
+        self.assertEqual(object_cache.get_stats(), {'hits': 1, 'misses': 2})
+
+        # Publishing again drops the cached item
+        book = models.Book.objects.get(pk=book.pk, state=models.Book.DRAFT)
+        book.name = 'changed'
+        book.save()
+        book = models.Book.objects.get(pk=book.pk, state=models.Book.DRAFT)
+        book.publish()
+        # The test case's transaction never commits
+        committed(connection.alias)
+        self.assertEqual(models.Book.objects.cached_get(pk=book.pk).name,
+                         'changed')
+        self.assertEqual(object_cache.get_stats()['misses'], 3)
+
+        models.Book.objects.get(pk=book.pk,
+                                state=models.Book.DRAFT).unpublish()
+        committed(connection.alias)
+        with self.assertRaises(models.Book.DoesNotExist):
+            models.Book.objects.cached_get(pk=book.pk)
+
+    def testInvalidateBatch(self):
+        book2 = models.Book(name='Book2', author_id=2)
+        book2.save()
+        publish_many(models.Book.objects.all())
+        committed(connection.alias)
+        for pk in (1, book2.pk):
+            models.Book.objects.cached_get(pk=pk)
+
+        calls = []
+        backend = object_cache.get_cache_backend().__class__
+        delete_many = backend.delete_many
+
+        def record(cache, keys, *args, **kwargs):
+            calls.append(sorted(keys))
+            return delete_many(cache, keys, *args, **kwargs)
+
+        backend.delete_many = record
+        try:
+            publish_many(models.Book.objects.filter(
+                                    state=models.Book.DRAFT))
+            committed(connection.alias)
+        finally:
+            backend.delete_many = delete_many
+        self.assertEqual(calls, [sorted([
+                            object_cache.get_key(models.Book, 1),
+                            object_cache.get_key(models.Book, book2.pk)])])
+        self.assertEqual(object_cache.get_stats()['misses'], 2)
+        models.Book.objects.cached_get(pk=1)
+        self.assertEqual(object_cache.get_stats()['misses'], 3)
+
+    def testSelectRelated(self):
+        book = models.Book.objects.get(vid=1)
+        book.publish()
+        book.author.publish()
+        models.Book.CACHE_SELECT_RELATED = ('author',)
+        try:
+            models.Book.objects.cached_get(pk=book.pk)
+            with self.assertNumQueries(0):
+                obj = models.Book.objects.cached_get(pk=book.pk)
+                self.assertEqual(obj.author.pk, book.author.pk)
+        finally:
+            del models.Book.CACHE_SELECT_RELATED
+
+    def testDraftState(self):
+        book = models.Book.objects.get(vid=1)
+        book.publish()
+        manager.activate(models.Book.DRAFT)
+        try:
+            obj = models.Book.objects.cached_get(pk=book.pk)
+        finally:
+            manager.deactivate()
+        self.assertEqual(obj.state, models.Book.DRAFT)
+        self.assertEqual(object_cache.get_stats(), {'hits': 0, 'misses': 0})
+
+
+class InstrumentationTests(TestCase):
+    fixtures = ('test_data.json',)
+
+    def testSpans(self):
+        spans = []
+
+        def collect(sender, span, **kwargs):
+            spans.append(span)
+
+        book = models.Book.objects.get(vid=1)
+        with self.assertNumQueries(0):
+            with instrumentation.span('nothing') as s:
+                self.assertEqual(s, None)
+
+        instrumentation.span_finished.connect(collect)
+        try:
+            book.publish()
+            root = spans[-1]
+            # Signals wait for the test case's
+            # transaction, which never commits
+            committed(connection.alias)
+        finally:
+            instrumentation.span_finished.disconnect(collect)
+        self.assertEqual(instrumentation.get_current(), None)
+        self.assertEqual(spans[-1].name, 'signal')
+        self.assertEqual(spans[-1].parent, None)
+
+        self.assertEqual(root.name, 'publish')
+        self.assertEqual(root.parent, None)
+        self.assertEqual(root.tags, {'model': 'Book'})
+        self.assertTrue(root.queries > 0)
+        self.assertTrue(root.rows > 0)
+        self.assertTrue(root.duration >= 0)
+
+        names = [s.name for depth, s in root.walk()]
+        for name in ('clone', 'clone.collect', 'clone.write', 'schedule',
+                     '_publish'):
+            self.assertTrue(name in names, name)
+
+        for depth, s in root.walk():
+            if s.parent:
+                self.assertTrue(s.queries <= s.parent.queries)
+
+    def testProfileCommand(self):
+        out = StringIO()
+        call_command('versioning_profile', 'version_models.Book', '1',
+                     rollback=True, stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertTrue(lines[0].startswith('publish model=Book'))
+        self.assertTrue(any(l.startswith('  clone ') for l in lines))
+        self.assertFalse(models.Book.objects.filter(
+                            object_id=1, state=models.Book.PUBLISHED))
+
+
+class ScheduleTests(TestCase):
+    fixtures = ('test_data.json',)
+
+    def _schedule(self, days=7):
+        book = models.Book.objects.get(vid=1)
+        book.publish(when=timezone.now() + datetime.timedelta(days=days))
+        return Schedule.objects.order_by('-pk')[0]
+
+    def testClaimDue(self):
+        schedule = self._schedule()
+        later = timezone.now() + datetime.timedelta(days=8)
+        self.assertEqual(claim_due(10), [])
+        self.assertEqual(claim_due(10, now=later), [schedule])
+        self.assertEqual(claim_due(10, now=later, exclude=[schedule.pk]), [])
+
+    def testRunScheduledUpdates(self):
+        self._schedule()
+        later = timezone.now() + datetime.timedelta(days=8)
+        self.assertEqual(run_scheduled_updates(now=timezone.now()), (0, 0))
+        self.assertEqual(run_scheduled_updates(batch_size=1, now=later),
+                         (1, 0))
+        self.assertFalse(Schedule.objects.exists())
+        self.assertTrue(models.Book.normal.filter(
+                            object_id=1, state=models.Book.PUBLISHED))
+
+    def testFailedUpdate(self):
+        schedule = self._schedule()
+        # No key, so the next schedule doesn't replace it
+        Schedule.objects.filter(pk=schedule.pk).update(
+                                    object_args='{"missing": 1}', key=None)
+        self._schedule(days=6)
+        later = timezone.now() + datetime.timedelta(days=8)
+
+        self.assertEqual(run_scheduled_updates(batch_size=1, now=later),
+                         (1, 1))
+        self.assertEqual(list(Schedule.objects.values_list('pk', flat=True)),
+                         [schedule.pk])
+
+    def _schedule_many(self, count, days=7):
+        author = models.Author.objects.all()[0]
+        when = timezone.now() + datetime.timedelta(days=days)
+        for i in range(count):
+            book = models.Book(name='book %s' % i, author=author)
+            book.save()
+            book.publish(when=when)
+        return list(Schedule.objects.order_by('pk'))
+
+    def testScheduledObjects(self):
+        schedules = self._schedule_many(3)
+        with self.assertNumQueries(1):
+            items = get_scheduled_objects(models.Book, schedules)
+        self.assertEqual([(s, [o.vid for o in objects])
+                          for s, objects in items],
+                         [(s, [s.object_args['vid']]) for s in schedules])
+
+    def testGroupedUpdates(self):
+        self._schedule_many(3)
+        later = timezone.now() + datetime.timedelta(days=8)
+        calls = []
+
+        def bulk(cls, objects, action, **kwargs):
+            calls.append((len(objects), action))
+            for obj in objects:
+                obj.do_scheduled_update(action, **kwargs)
+
+        models.Book.do_bulk_scheduled_update = classmethod(bulk)
+        try:
+            self.assertEqual(run_scheduled_updates(now=later), (3, 0))
+        finally:
+            del models.Book.do_bulk_scheduled_update
+
+        self.assertEqual(calls, [(3, '_publish')])
+        self.assertFalse(Schedule.objects.exists())
+        self.assertEqual(models.Book.normal.filter(
+                            state=models.Book.PUBLISHED).count(), 3)
+
+    def _schedule_twice(self):
+        first = self._schedule(days=1)
+        draft = models.Book.normal.get(object_id=1, state=models.Book.DRAFT)
+        draft.name = 'changed'
+        draft.save()
+        draft.publish(when=timezone.now() + datetime.timedelta(days=2))
+        return first, Schedule.objects.order_by('-pk')[0]
+
+    def testSupersededSchedules(self):
+        first, second = self._schedule_twice()
+        self.assertEqual(first.key, second.key)
+
+        later = timezone.now() + datetime.timedelta(days=3)
+        self.assertEqual(claim_due(1, now=later), [first, second])
+        self.assertEqual(coalesce_schedules([first, second]),
+                         ([second], [first]))
+
+        self.assertEqual(run_scheduled_updates(batch_size=1, now=later),
+                         (2, 0))
+        self.assertFalse(Schedule.objects.exists())
+        versions = models.Book.normal.filter(object_id=1)
+        self.assertFalse(versions.filter(
+                            vid=first.object_args['vid']).exists())
+        self.assertEqual(list(versions.exclude(state=models.Book.DRAFT
+                                    ).values_list('vid', 'state')),
+                         [(second.object_args['vid'],
+                           models.Book.PUBLISHED)])
+        self.assertEqual(versions.get(state=models.Book.PUBLISHED).name,
+                         'changed')
+
+    def testSupersedingScheduleFails(self):
+        first, second = self._schedule_twice()
+        later = timezone.now() + datetime.timedelta(days=3)
+
+        def bulk(cls, objects, action, **kwargs):
+            with xact():
+                raise ValueError()
+
+        # Failed groups are rolled back even inside an xact block
+        models.Book.do_bulk_scheduled_update = classmethod(bulk)
+        try:
+            with xact():
+                self.assertEqual(run_scheduled_updates(now=later), (0, 2))
+        finally:
+            del models.Book.do_bulk_scheduled_update
+
+        # Nothing was dropped, both are left for the next run
+        self.assertEqual(list(Schedule.objects.order_by('pk')),
+                         [first, second])
+        self.assertEqual(models.Book.normal.filter(object_id=1,
+                                state=models.Book.SCHEDULED).count(), 2)
+
+    def testLazyJSON(self):
+        schedule = self._schedule()
+        vid = models.Book.normal.get(state=models.Book.SCHEDULED).vid
+        self.assertEqual(Schedule.objects.get(pk=schedule.pk).object_args,
+                         {'vid': vid})
+
+        with self.settings(SCHEDULING_LAZY_JSONB=True):
+            register_jsonb(None, connection)
+        try:
+            schedule = Schedule.objects.get(pk=schedule.pk)
+            self.assertTrue(isinstance(schedule.__dict__['object_args'],
+                                       basestring))
+            schedule.save()
+            self.assertTrue(isinstance(schedule.__dict__['object_args'],
+                                       basestring))
+        finally:
+            # Go back to psycopg2 decoding jsonb
+            register_default_jsonb(connection.connection)
+
+        self.assertEqual(schedule.object_args, {'vid': vid})
+        self.assertEqual(schedule.__dict__['object_args'], {'vid': vid})
+        self.assertEqual(Schedule().json_args, {})
+
+    def testJSONContains(self):
+        schedules = self._schedule_many(2)
+        vid = schedules[1].object_args['vid']
+        self.assertEqual(list(Schedule.objects.json_contains(
+                                object_args={'vid': vid})), schedules[1:])
+        self.assertEqual(list(Schedule.objects.json_contains(
+                                object_args={'vid': 0})), [])
+        self.assertTrue(json_contains({'a': [1, {'b': 2}], 'c': 3},
+                                      {'a': [{'b': 2}]}))
+        self.assertFalse(json_contains({'a': [1]}, {'a': [2]}))
+
+    def testCommand(self):
+        self._schedule(days=1)
+        Schedule.objects.update(when=timezone.now())
+        call_command('do_scheduled_updates', workers=1)
+        self.assertFalse(Schedule.objects.exists())
+
+    def testSchedulerTick(self):
+        schedule = self._schedule(days=1)
+        later = timezone.now() + datetime.timedelta(days=2)
+        scheduler = Scheduler(listen=False, poll_interval=60)
+        scheduler.refresh()
+        self.assertEqual(scheduler.heap, [schedule.when])
+        self.assertEqual(scheduler.get_timeout(), 60)
+
+        self.assertEqual(scheduler.tick(), (0, 0))
+        self.assertEqual(scheduler.heap, [schedule.when])
+        # Not due and polled just now
+        self.assertEqual(scheduler.tick(), (0, 0))
+
+        self.assertEqual(scheduler.tick(now=later), (1, 0))
+        self.assertEqual(scheduler.heap, [])
+        self.assertTrue(59 < scheduler.get_timeout() <= 60)
+        self.assertFalse(Schedule.objects.exists())
+
+    def testSchedulerHeap(self):
+        scheduler = Scheduler(listen=False, poll_interval=60)
+        now = timezone.now()
+        for days in (3, 1, 2):
+            scheduler.add(now + datetime.timedelta(days=days))
+        self.assertEqual(scheduler.heap[0], now + datetime.timedelta(days=1))
+        self.assertEqual(scheduler.get_timeout(now=now), 60)
+        scheduler.add(now + datetime.timedelta(seconds=1))
+        self.assertEqual(scheduler.get_timeout(now=now), 1)
+
+    def testSchedulerListen(self):
+        scheduler = Scheduler(poll_interval=5)
+        if not scheduler.connect():
+            self.skipTest("LISTEN not available")
+        try:
+            # Notifications from the test connection are only
+            # sent on commit, so send one from the listener.
+            when = timezone.now() + datetime.timedelta(days=1)
+            scheduler.listener.cursor().execute(
+                    "SELECT pg_notify(%s, %s)",
+                    [SCHEDULE_CHANNEL, when.isoformat()])
+            scheduler.wait(5)
+            self.assertEqual(scheduler.heap, [when])
+        finally:
+            scheduler.close()
+
+
+class SchemaTests(TestCase):
+
+    def testIndexes(self):
+        self.assertEqual(get_missing_indexes(models.Book), [])
+
+        names = [x[0] for x in get_indexes(models.Book)]
+        self.assertEqual(len(names), 3)
+        cursor = connection.cursor()
+        cursor.execute("DROP INDEX %s" % connection.ops.quote_name(names[0]))
+        self.assertEqual([x[0] for x in get_missing_indexes(models.Book)],
+                         names[:1])
+
+        out = StringIO()
+        call_command('updateviews', indexes=True, stdout=out)
+        self.assertEqual(out.getvalue(),
+                         "version_models.Book: %s\n" % names[0])
+
+        update_schema(None, [models.Book], 0)
+        self.assertEqual(get_missing_indexes(models.Book), [])
+
+    def testMissingScheduleColumn(self):
+        self.assertEqual(get_missing_columns(Schedule), [])
+        cursor = connection.cursor()
+        cursor.execute("ALTER TABLE scheduling_schedule DROP COLUMN key")
+        self.assertEqual([x[0] for x in get_missing_columns(Schedule)],
+                         ['scheduling_schedule.key'])
+
+        out = StringIO()
+        call_command('updateviews', dry_run=True, stdout=out)
+        self.assertTrue('+++ scheduling_schedule.key' in
+                        out.getvalue().splitlines())
+
+        call_command('updateviews', verbosity=0)
+        self.assertEqual(get_missing_columns(Schedule), [])
+        cursor.execute("SELECT count(*) FROM pg_indexes WHERE "
+                       "tablename = 'scheduling_schedule' AND "
+                       "indexdef LIKE '%%(key%%'")
+        self.assertTrue(cursor.fetchone()[0])
+        self.assertFalse(Schedule.objects.filter(key='book').exists())
+
+    def testIncrementalUpdate(self):
+        self.assertEqual(update_schema(None, [models.Book], 0), [])
+
+        cursor = connection.cursor()
+        cursor.execute("UPDATE versioning_schema_objects SET "
+                       "fingerprint = '', definition = 'old' "
+                       "WHERE name = 'draft.version_models_book'")
+        cursor.execute("DROP VIEW published.version_models_book")
+
+        out = StringIO()
+        call_command('updateviews', dry_run=True, stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertTrue('--- draft.version_models_book (current)' in lines)
+        self.assertTrue('-old' in lines)
+        self.assertTrue('+++ published.version_models_book' in lines)
+        self.assertFalse([l for l in lines if 'version_models_author' in l])
+
+        changes = update_schema(None, [models.Book, models.Author], 0)
+        self.assertEqual(sorted(x[0] for x in changes),
+                         ['draft.version_models_book',
+                          'published.version_models_book'])
+        self.assertEqual(update_schema(None, [models.Book], 0), [])
+
+        with manager.SwitchSchema('published'):
+            self.assertEqual(models.Book.objects.count(), 0)
+
+    def testPartitionByState(self):
+        table = models.Comic._meta._version_model._meta.db_table
+        cursor = connection.cursor()
+        cursor.execute("SELECT relkind FROM pg_class WHERE relname = %s",
+                       [table])
+        self.assertEqual(cursor.fetchone()[0], 'p')
+        self.assertEqual(update_schema(None, [models.Comic], 0), [])
+        self.assertEqual(len(get_indexes(models.Comic)), 1)
+
+        def count(state):
+            cursor.execute("SELECT count(*) FROM %s" % (
+                connection.ops.quote_name('%s_%s' % (table, state))))
+            return cursor.fetchone()[0]
+
+        manager.activate('draft')
+        try:
+            comic = models.Comic(name='first')
+            comic.save()
+            models.Comic.objects.get(name='first').publish()
+            models.Comic.objects.get(name='first').publish()
+        finally:
+            manager.deactivate()
+
+        # Publishing moves rows between partitions
+        self.assertEqual([count(s) for s in ('draft', 'published',
+                                              'archived')], [1, 1, 1])
+        with manager.SwitchSchema('published'):
+            self.assertEqual(models.Comic.objects.get().name, 'first')
+
+        cursor.execute("SELECT definition FROM pg_views WHERE "
+                       "schemaname = 'draft' AND viewname = %s",
+                       [models.Comic._meta.db_table])
+        self.assertTrue('%s_draft' % table in cursor.fetchone()[0])
+
+    def testPartitionReferenced(self):
+        table = models.Book._meta._version_model._meta.db_table
+        cursor = connection.cursor()
+        models.Book._meta._partition_by_state = True
+        try:
+            with self.assertRaises(ImproperlyConfigured) as cm:
+                update_schema(None, [models.Book], 0)
+        finally:
+            models.Book._meta._partition_by_state = False
+        self.assertTrue(models.Review._meta.db_table in str(cm.exception))
+
+        # The foreign key from the cloned reviews is still there
+        cursor.execute("SELECT count(*) FROM pg_constraint WHERE "
+                       "conrelid = %s::regclass AND "
+                       "confrelid = %s::regclass AND contype = 'f'",
+                       [models.Review._meta.db_table, table])
+        self.assertEqual(cursor.fetchone()[0], 1)
+        cursor.execute("SELECT relkind FROM pg_class WHERE relname = %s",
+                       [table])
+        self.assertEqual(cursor.fetchone()[0], 'r')
+
+
+class SnapshotTests(TestCase):
+
+    def _get_published(self):
+        with manager.SwitchSchema('published'):
+            return list(models.Magazine.objects.values_list('name', 'vid'))
+
+    def testSnapshotTable(self):
+        cursor = connection.cursor()
+        cursor.execute("SELECT relkind FROM pg_class c INNER JOIN "
+                       "pg_namespace n ON n.oid = c.relnamespace "
+                       "WHERE n.nspname = %s AND c.relname = %s",
+                       ['published', models.Magazine._meta.db_table])
+        self.assertEqual(cursor.fetchone()[0], 'r')
+
+    def testPublish(self):
+        magazine = models.Magazine(name='one')
+        magazine.save()
+        magazine = models.Magazine.objects.get(vid=magazine.vid)
+        self.assertEqual(self._get_published(), [])
+
+        magazine.publish()
+        published = self._get_published()
+        self.assertEqual(len(published), 1)
+        self.assertEqual(published[0][0], 'one')
+
+        magazine = models.Magazine.objects.get(pk=magazine.pk,
+                                               state=models.Magazine.DRAFT)
+        magazine.name = 'two'
+        magazine.save()
+        self.assertEqual(self._get_published(), published)
+
+        magazine.publish()
+        self.assertEqual(self._get_published()[0][0], 'two')
+
+        magazine = models.Magazine.objects.get(pk=magazine.pk,
+                                               state=models.Magazine.DRAFT)
+        magazine.unpublish()
+        self.assertEqual(self._get_published(), [])
+
+    def testPublishManyAndDelete(self):
+        for name in ('one', 'two'):
+            models.Magazine(name=name).save()
+
+        publish_many(models.Magazine.objects.all())
+        self.assertEqual(sorted(x[0] for x in self._get_published()),
+                         ['one', 'two'])
+
+        models.Magazine.objects.get(name='one', state='draft').delete()
+        self.assertEqual([x[0] for x in self._get_published()], ['two'])
+
+    def testUpdate(self):
+        magazine = models.Magazine(name='one')
+        magazine.save()
+        magazine = models.Magazine.objects.get(vid=magazine.vid)
+        magazine.publish()
+
+        models.Magazine.objects.filter(state=models.Magazine.PUBLISHED
+                                       ).update(name='changed')
+        self.assertEqual(self._get_published()[0][0], 'changed')
+
+
+class TransferTests(TestCase):
+    fixtures = ('test_data.json',)
+
+    def testDumpAndLoad(self):
+        models.Book.objects.get(vid=1).publish()
+        tables = get_versioned_models(['version_models'])
+        self.assertTrue(models.Book._meta._version_model in tables)
+        self.assertTrue(tables.index(models.Book._meta._base_model) <
+                        tables.index(models.Book._meta._version_model))
+        # Cloned children come after the versions they point at
+        self.assertTrue(tables.index(models.Book._meta._version_model) <
+                        tables.index(models.Review))
+        galleries = models.Book._meta._version_model._meta.get_field(
+                                                        'galleries')
+        self.assertTrue(tables.index(models.Gallery) <
+                        tables.index(galleries.rel.through))
+        reviews = sorted(models.Review.objects.values_list('book', 'text'))
+
+        def counts():
+            return [m._base_manager.count() for m in tables]
+
+        before = counts()
+        with manager.SwitchSchema('public'):
+            books = list(models.Book.normal.values_list(
+                                    'vid', 'object_id', 'name', 'last_save'))
+
+        out = StringIO()
+        call_command('dumpversions', 'version_models', chunk_size=2,
+                     stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(len(lines), sum(before))
+
+        cursor = connection.cursor()
+        for m in reversed(tables):
+            cursor.execute("DELETE FROM %s" % connection.ops.quote_name(
+                                                        m._meta.db_table))
+        self.assertEqual(sum(counts()), 0)
+
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(out.getvalue())
+            f.flush()
+            call_command('loadversions', f.name, batch_size=2, verbosity=0)
+
+        self.assertEqual(counts(), before)
+        self.assertEqual(reviews, sorted(models.Review.objects.values_list(
+                                                        'book', 'text')))
+        with manager.SwitchSchema('public'):
+            vids = set(models.Book.normal.values_list('vid', flat=True))
+            self.assertTrue(set(r[0] for r in reviews) <= vids)
+            self.assertEqual(sorted(books), sorted(
+                    models.Book.normal.values_list('vid', 'object_id',
+                                                   'name', 'last_save')))
+        with manager.SwitchSchema('published'):
+            self.assertEqual(models.Book.normal.get().galleries.count(), 2)
+
+        # Sequences continue after the loaded rows
+        book = models.Book(name='new', author_id=1)
+        book.save()
+        self.assertTrue(book.vid > max(b[0] for b in books))
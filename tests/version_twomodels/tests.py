@@ -1,10 +1,13 @@
 import datetime
 
 from django.test import TestCase
+from django.db import connection
 from django.utils import timezone, formats
 from django.core.exceptions import ValidationError
 
-from scarlet.versioning.models import published_signal, BaseModel, VersionModel
+from scarlet.versioning.models import published_signal, BaseModel, \
+                                      VersionModel, publish_many
+from scarlet.versioning.transactions import committed
 
 import models
 
@@ -74,6 +77,32 @@ class ModelTests(TestCase):
         # Too old returns none
         self.assertEqual(a.get_version(date=a.created_date), None)
 
+    def testWithVersions(self):
+        models.Author.objects.get(pk=1).publish()
+        bases = list(models.AuthorBase.objects.all())
+
+        with self.assertNumQueries(2):
+            authors = list(models.AuthorBase.objects.with_versions(
+                                        state=models.Author.PUBLISHED))
+            versions = [a.current_version for a in authors]
+        self.assertEqual(versions, [a.get_version(
+                                        state=models.Author.PUBLISHED)
+                                    for a in authors])
+        self.assertEqual(len([v for v in versions if v is None]), 1)
+
+        with self.assertNumQueries(2):
+            authors = models.AuthorBase.objects.filter(pk__in=[
+                                        b.pk for b in bases]).with_versions()
+            versions = dict((a.pk, a.current_version) for a in authors)
+        self.assertEqual(versions, dict((a.pk, a.get_version())
+                                        for a in bases))
+
+        with self.assertNumQueries(2):
+            a = models.AuthorBase.objects.with_versions(
+                            date=timezone.now()).get(pk=1)
+            self.assertEqual(a.current_version.state,
+                             models.Author.PUBLISHED)
+
     def testPublishedSignal(self):
         book = models.Book.objects.get(pk=1)
         self.name = None
@@ -85,6 +114,8 @@ class ModelTests(TestCase):
         # connect & send the signal
         published_signal.connect(published_listener)
         book.publish()
+        # The test case's transaction never commits
+        committed(connection.alias)
         self.assertEqual(self.name, book.name)
         base_book = models.BookBase.objects.get(pk=1)
         self.assertEqual(book.last_scheduled, base_book.v_last_save)
@@ -141,6 +172,21 @@ class ModelTests(TestCase):
                               state=models.Author.PUBLISHED)
         self._check_different_book_versions(bd, bp)
 
+    def testPublishMany(self):
+        versions = publish_many(models.Book.objects.filter(pk=1))
+        self.assertEqual(len(versions), 1)
+
+        bd = models.Book.objects.get(vid=1)
+        bp = models.Book.objects.get(object_id=bd.object_id,
+                              state=models.Book.PUBLISHED)
+        self.assertEqual(bp, versions[0])
+        self.assertTrue(models.BookBase.objects.get(pk=1).is_published)
+        self._check_different_book_versions(bd, bp)
+
+        author = publish_many(models.Author.objects.filter(name='test'))[0]
+        self.assertEqual(list(author.associates.all()),
+                         [models.AuthorBase(pk=2)])
+
     def testMakeDraftBook(self):
         book = models.Book.objects.get(pk=1)
         self.assertEqual(book.name, 'Book1')